@@ -0,0 +1,192 @@
+import json
+import hashlib
+from collections import deque
+import numpy as np
+from PIL import Image, ImageSequence
+from Pipeline import *
+
+#==================================================
+# アニメーション (GIF/APNG) の各フレームを変換するモジュール
+#==================================================
+
+# 同時に処理するフレーム数 (ワーカー数に対する倍率)。メモリに置くフレームはこの数までになる
+frames_in_flight_per_worker = 2
+
+### @brief アニメーションのフレームを1枚ずつ読み込むジェネレーター
+### @param filename 画像ファイルのパス
+### @return (フレーム番号, 色の配列 (R, G, B, A), 表示時間 (ミリ秒)) を順に返す
+### @details フレームはPillowが前のフレームと合成した状態で、必要になったときに1枚ずつ展開される
+def IterateFrames(filename):
+    with Image.open(filename) as img:
+        for index, frame in enumerate(ImageSequence.Iterator(img)):
+            duration = frame.info.get("duration", 0)
+            yield index, np.asarray(frame.convert("RGBA")), duration
+
+### @brief 全フレームで共有するパレットを作成する関数
+### @param filename 画像ファイルのパス
+### @param option オプションの辞書
+### @return パレットの配列 (色数, 4)。失敗した場合はNoneを返す。
+### @details フレームは1枚ずつ処理して色の出現回数だけを集計するので、フレーム数が多くてもメモリは増えない
+def CreateSharedPalette(filename, option):
+    logger.info(f"Creating shared palette: {option['global_colors']} ({option['palette_method']})")
+
+    colors = None
+    counts = None
+    try:
+        for _, frame_array, _ in IterateFrames(filename):
+            with SuppressLogs():
+                color_array = PrepareColorArray(Image.fromarray(frame_array, "RGBA"), option)
+                if color_array is None:
+                    return None
+                color_array, _ = QuantizeColorArray(color_array, option, in_place=True)
+                if color_array is None:
+                    return None
+            colors, counts = CountColors(color_array, colors, counts)
+
+    except Exception as e:
+        logger.error(f"Error reading animation frames: {e}")
+        return None
+
+    if colors is None or len(colors) == 0:
+        return np.zeros((0, 4), dtype=np.uint8)
+
+    return CreatePaletteFromColors(colors, counts, option["global_colors"], option["palette_method"])
+
+### @brief 1フレームをMFMアートに変換する関数 (プロセスプールのワーカーでも実行)
+### @param frame_array フレームの色の配列 (R, G, B, A)
+### @param option オプションの辞書
+### @param palette 全フレームで共有するパレット。Noneならフレームごとに減色する
+### @return MFMアートの文字列。失敗した場合はNoneを返す。
+def ConvertAnimationFrame(frame_array, option, palette = None):
+    # フレームごとの処理の表示は多すぎるので、エラー以外は出力しない
+    with SuppressLogs():
+        color_array = PrepareColorArray(Image.fromarray(frame_array, "RGBA"), option)
+        if color_array is None:
+            return None
+
+        color_array, background_color = QuantizeColorArray(color_array, option, in_place=True)
+        if color_array is None:
+            return None
+
+        if palette is not None:
+            reduce_color_array = ReduceColorsGlobal(color_array, len(palette), option["palette_method"], option["color_type"], palette=palette)
+            color_array = DitherReducedColorArray(color_array, reduce_color_array, option)
+        else:
+            color_array = ReduceColorArray(color_array, option)
+        if color_array is None:
+            return None
+
+        return EncodeColorArray(color_array, background_color, option)
+
+### @brief アニメーションの各フレームをMFMアートに変換して保存する関数
+### @param filename 画像ファイルのパス
+### @param option オプションの辞書
+### @param output_name 出力するファイル名 (拡張子なし)
+### @return 各フレームの文字数のリスト。失敗した場合はNoneを返す。
+### @details animation_mode が frames の場合はフレームごとに "ファイル名_番号.txt" を、
+###          bundle の場合は全フレームを1つの "ファイル名.txt" にまとめ、位置を "ファイル名.index.json" に保存する。
+###          変換が終わったフレームから順番に保存するので、メモリに置くフレームは同時に処理する数までになる。
+def ConvertAnimationFile(filename, option, output_name):
+    mode = option["animation_mode"]
+    workers = max(1, option["workers"])
+    logger.info(f"Converting animation: {filename} ({mode}, workers: {workers})")
+
+    # 共有パレットを使う場合は先にすべてのフレームの色を数える
+    palette = None
+    if option["animation_shared_palette"] and (option["global_colors"] > 0):
+        palette = CreateSharedPalette(filename, option)
+        if palette is None:
+            logger.error("Failed to create shared palette.")
+            return None
+
+    # フレームの中でさらにプロセスを使わないようにする
+    frame_option = option | {"workers": 1}
+    pool = GetProcessPool(workers) if workers > 1 else None
+
+    bundle_file = None
+    index = []
+    char_counts = []
+    offset = 0
+    # (フレーム番号, 表示時間, 変換結果, 同じ内容のフレーム番号) を順番に保持する
+    pending = deque()
+    last_mfm_text = None
+
+    ### @brief 一番古いフレームの変換が終わるのを待って保存する関数
+    def WritePendingFrame():
+        nonlocal offset, last_mfm_text
+        frame_index, duration, result, same_as = pending.popleft()
+
+        if same_as is None:
+            mfm_text = result.result() if pool is not None else result
+            if mfm_text is None:
+                raise RuntimeError(f"Failed to convert frame {frame_index}.")
+            last_mfm_text = mfm_text
+        else:
+            # 同じ内容のフレームは直前に保存されているので、その結果を使う
+            mfm_text = last_mfm_text
+
+        if bundle_file is None:
+            if not OutputMFM(mfm_text, f"{output_name}_{frame_index:04d}"):
+                raise RuntimeError(f"Failed to save frame {frame_index}.")
+        else:
+            # フレームの前に区切りの行を入れる
+            header = f"=== frame {frame_index} ===\n"
+            if frame_index > 0:
+                header = "\n" + header
+            bundle_file.write(header + mfm_text)
+            offset += len(header)
+
+        index.append({"frame": frame_index, "duration": duration, "offset": offset, "length": len(mfm_text), "same_as": same_as})
+        offset += len(mfm_text)
+        char_counts.append(len(mfm_text))
+        logger.info(f"\tFrame {frame_index}: {len(mfm_text)} chars" + ("" if same_as is None else f" (same as frame {same_as})"))
+
+    try:
+        if mode == "bundle":
+            bundle_file = open(f"{output_name}.txt", "w", encoding="UTF-8", newline="")
+
+        previous_hash = None
+        previous_index = None
+
+        for frame_index, frame_array, duration in IterateFrames(filename):
+            # 前のフレームと同じ内容なら変換せずに結果を使い回す
+            frame_hash = None
+            if option["animation_reuse_frames"]:
+                frame_hash = (frame_array.shape, hashlib.sha256(frame_array.tobytes()).digest())
+            if (frame_hash is not None) and (frame_hash == previous_hash):
+                pending.append((frame_index, duration, None, previous_index))
+            else:
+                if pool is not None:
+                    result = pool.submit(ConvertAnimationFrame, frame_array, frame_option, palette)
+                else:
+                    result = ConvertAnimationFrame(frame_array, frame_option, palette)
+                pending.append((frame_index, duration, result, None))
+                previous_hash = frame_hash
+                previous_index = frame_index
+
+            # 同時に処理する数を超えたら古いフレームから保存する
+            while len(pending) > workers * frames_in_flight_per_worker:
+                WritePendingFrame()
+
+        while pending:
+            WritePendingFrame()
+
+    except Exception as e:
+        logger.error(f"Error converting animation: {e}")
+        return None
+
+    finally:
+        if bundle_file is not None:
+            bundle_file.close()
+
+    # まとめて保存した場合は各フレームの位置 (文字数で数えた位置) を保存する
+    if mode == "bundle":
+        try:
+            with open(f"{output_name}.index.json", "w", encoding="UTF-8") as index_file:
+                json.dump({"frames": index}, index_file, indent=1)
+        except Exception as e:
+            logger.error(f"Error saving animation index: {e}")
+            return None
+
+    logger.info(f"Converted {len(char_counts)} frames.")
+    return char_counts
\ No newline at end of file
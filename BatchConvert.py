@@ -0,0 +1,198 @@
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from LoadingFiles import *
+from Pipeline import *
+from AnimationMFM import *
+
+#==================================================
+# 複数の画像をまとめて変換するためのモジュール
+#==================================================
+
+# ディレクトリを指定した場合に変換する画像の拡張子
+image_extensions = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp")
+
+# ファイルごとのオプションを上書きするファイルの接尾辞 (例: emoji.png なら emoji.option.txt)
+sidecar_suffix = ".option.txt"
+
+### @brief 入力に指定されたファイル、ディレクトリ、globパターンを画像ファイルのリストに展開する関数
+### @param inputs 入力のリスト
+### @param recursive ディレクトリとglobパターンをサブディレクトリまで探すか
+### @return 画像ファイルのパスのリスト (重複は除く)
+def ExpandInputs(inputs, recursive = False):
+    paths = []
+
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            # ディレクトリの場合は中の画像ファイルをすべて変換する
+            search = os.path.join(pattern, "**", "*") if recursive else os.path.join(pattern, "*")
+            matches = [path for path in sorted(glob.glob(search, recursive=recursive)) if path.lower().endswith(image_extensions)]
+        elif os.path.isfile(pattern):
+            matches = [pattern]
+        else:
+            # globパターンの場合もディレクトリと同じく画像ファイルだけを変換する (*.* で上書き用オプションや出力の .txt を拾わないように)
+            matches = [path for path in sorted(glob.glob(pattern, recursive=recursive)) if path.lower().endswith(image_extensions)]
+            if not matches:
+                logger.warning(f"No image files matched: {pattern}")
+
+        paths.extend(path for path in matches if os.path.isfile(path))
+
+    # 同じファイルを2回変換しないように、最初に指定された順番のまま重複を除く
+    return list(dict.fromkeys(paths))
+
+### @brief 画像ファイルと同じ場所にある、ファイルごとの上書き用オプションを読み込む関数
+### @param path 画像ファイルのパス
+### @return "key = value" 形式の行のリスト。ファイルがない場合は空のリスト
+def LoadSidecarOptions(path):
+    sidecar_path = os.path.splitext(path)[0] + sidecar_suffix
+    if not os.path.isfile(sidecar_path):
+        return []
+
+    with open(sidecar_path, "r", encoding="UTF-8") as file:
+        return file.read().splitlines()
+
+### @brief 出力するファイル名 (拡張子なし) を作る関数
+### @param path 画像ファイルのパス
+### @param output_dir 出力先のディレクトリ。Noneの場合は画像と同じ場所
+def CreateOutputName(path, output_dir):
+    stem = os.path.splitext(path)[0]
+    if output_dir is None:
+        return stem
+    return os.path.join(output_dir, os.path.basename(stem))
+
+### @brief 1つの画像ファイルを変換する関数 (プロセスプールのワーカーで実行)
+### @param path 画像ファイルのパス
+### @param option_file 基本のオプションファイルのパス
+### @param overrides コマンドラインで指定した "key = value" 形式の行のリスト
+### @param output_dir 出力先のディレクトリ。Noneの場合は画像と同じ場所
+### @param verbose Trueなら各処理の表示を出力する
+### @param nested_workers 減色に使うプロセス数の上限 (ファイル単位で並列化している場合は1)
+### @return (パス, 文字数, 処理時間, エラー内容) のタプル。成功した場合のエラー内容はNone
+def ConvertBatchFile(path, option_file, overrides, output_dir, verbose, nested_workers):
+    start_time = time.perf_counter()
+    # 各処理の表示はログで出力する (プロセスプールのワーカーでは設定が引き継がれないのでここで設定する)
+    if verbose:
+        ConfigureLogging(logging.INFO)
+
+    # verbose でない場合は各処理の表示を出さない (フォークしたワーカーには呼び出し元のログの設定が引き継がれる)
+    with SuppressLogs(logging.INFO if verbose else logging.WARNING):
+        try:
+            # オプションファイル < コマンドラインの指定 < ファイルごとの指定 の順に優先する
+            option = LoadOptionFile(option_file, overrides + LoadSidecarOptions(path))
+            if not option:
+                return path, None, time.perf_counter() - start_time, "Invalid option file"
+
+            option["filename"] = path
+            option["workers"] = min(option["workers"], nested_workers)
+
+            # アニメーションの場合はフレームごとに変換して保存する
+            if option["animation_mode"] != "off":
+                char_counts = ConvertAnimationFile(path, option, CreateOutputName(path, output_dir))
+                if char_counts is None:
+                    return path, None, time.perf_counter() - start_time, "Animation conversion failed"
+                return path, sum(char_counts), time.perf_counter() - start_time, None
+
+            # 行の帯ごとに変換する場合は生成した行からファイルに書き込む
+            if (option["stream_rows"] > 0) and (option["max_chars"] <= 0):
+                img, resize_value = LoadImageFile(path, option)
+                if img is None:
+                    return path, None, time.perf_counter() - start_time, "Failed to load image"
+                char_count = ConvertImageStreaming(img, option, CreateOutputName(path, output_dir), resize_value)
+                if char_count is None:
+                    return path, None, time.perf_counter() - start_time, "Conversion failed"
+                return path, char_count, time.perf_counter() - start_time, None
+
+            mfm_text = ConvertImageFile(path, option)
+            if mfm_text is None:
+                return path, None, time.perf_counter() - start_time, "Conversion failed"
+
+            if not OutputMFM(mfm_text, CreateOutputName(path, output_dir)):
+                return path, None, time.perf_counter() - start_time, "Failed to save"
+
+            return path, len(mfm_text), time.perf_counter() - start_time, None
+
+        except Exception as e:
+            return path, None, time.perf_counter() - start_time, str(e)
+
+### @brief 変換結果の一覧を表形式で表示する関数
+### @param results ConvertBatchFile の戻り値のリスト
+### @param total_time 全体の処理時間
+def PrintSummary(results, total_time):
+    name_width = max([len("File")] + [len(result[0]) for result in results])
+
+    print(f"{'File':<{name_width}}  {'Chars':>8}  {'Time (s)':>8}  Status")
+    print("-" * (name_width + 30))
+    for path, chars, seconds, error in results:
+        chars_text = "-" if chars is None else str(chars)
+        print(f"{path:<{name_width}}  {chars_text:>8}  {seconds:>8.3f}  {error or 'OK'}")
+    print("-" * (name_width + 30))
+
+    succeeded = [result for result in results if result[3] is None]
+    total_chars = sum(result[1] for result in succeeded)
+    print(f"Converted {len(succeeded)}/{len(results)} files, {total_chars} chars, {total_time:.3f} s")
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Convert many images to MFM art at once.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default=None, help="directory to write outputs (default: next to each input)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="number of files converted in parallel")
+    parser.add_argument("--option", default="option.txt", help="base option file (default: option.txt)")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE", help="override an option for every file")
+    parser.add_argument("-r", "--recursive", action="store_true", help="search directories and ** patterns recursively")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of each conversion step")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = ParseArguments(argv)
+    # 進捗とエラーはログで出力する (一覧は PrintSummary で標準出力に表示する)
+    ConfigureLogging(logging.INFO)
+
+    paths = ExpandInputs(args.inputs, args.recursive)
+    if not paths:
+        logger.error("No input files.")
+        return 1
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # "key=value" をオプションファイルと同じ "key = value" の形式にする
+    overrides = []
+    for override in args.overrides:
+        if "=" not in override:
+            logger.error(f"Invalid override: {override}")
+            return 1
+        key, value = override.split("=", 1)
+        overrides.append(f"{key.strip()} = {value.strip()}")
+
+    workers = max(1, min(args.workers, len(paths)))
+    logger.info(f"Converting {len(paths)} files with {workers} workers")
+
+    start_time = time.perf_counter()
+    results = {}
+
+    if workers == 1:
+        # 1プロセスの場合はプールを作らずにそのまま変換する
+        for path in paths:
+            results[path] = ConvertBatchFile(path, args.option, overrides, args.output_dir, args.verbose, os.cpu_count() or 1)
+            logger.info(f"\t[{len(results)}/{len(paths)}] {path}")
+    else:
+        # ワーカーは使い回すので、モジュールの読み込みはワーカーごとに1回だけ
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ConvertBatchFile, path, args.option, overrides, args.output_dir, args.verbose, 1) for path in paths]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result[0]] = result
+                logger.info(f"\t[{len(results)}/{len(paths)}] {result[0]}")
+
+    # 指定された順番で表示する
+    PrintSummary([results[path] for path in paths], time.perf_counter() - start_time)
+    return 0 if all(result[3] is None for result in results.values()) else 1
+
+# プロセスプールのワーカーから読み込まれた場合は実行しない
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,313 @@
+import sys
+import json
+import time
+import zlib
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from PIL import Image
+from MFMConverter import LoadOptions, MFMConversionError
+from Pipeline import *
+
+#==================================================
+# 変換処理の各段階の速度を計測するベンチマーク用モジュール
+#==================================================
+
+# 結果のファイルの形式のバージョン (形式を変えた場合は古い基準値と比較しない)
+benchmark_version = 1
+
+# 生成する画像の種類
+image_kinds = ["gradient", "noise", "pixel_art", "photo"]
+
+# 生成する画像の透明度の種類 (opaque: 不透明, binary: 円の外側が透明, soft: 外側ほど透明)
+alpha_kinds = ["opaque", "binary", "soft"]
+
+# 入力の画像は出力の幅のこの倍数の大きさで生成する (リサイズも計測するため)
+source_scale = 4
+
+# ベンチマーク用のデフォルトのオプション (すべての段階で処理が行われ、透明度も出力に残る値)
+benchmark_options = {
+    "smooth_repeat": 1,
+    "color_division": 8,
+    "max_row_colors": 8,
+    "color_type": 2,
+    "background_color": (0, 0, 0, 0)
+}
+
+# 計測する段階 (結果の表示順)
+benchmark_stages = ["resize", "to_array", "smooth", "divide", "reduce", "encode", "total"]
+
+### @brief 計測用の画像を生成する関数
+### @param kind 画像の種類 (image_kinds のどれか)
+### @param alpha 透明度の種類 (alpha_kinds のどれか)
+### @param size 画像の一辺のピクセル数
+### @return 画像オブジェクト (RGBA)
+### @details 乱数のシード値は種類とサイズから決めるので、毎回同じ画像になる
+def CreateBenchmarkImage(kind, alpha, size):
+    rng = np.random.default_rng(zlib.crc32(f"{kind}-{alpha}-{size}".encode("UTF-8")))
+    y, x = np.mgrid[0:size, 0:size] / max(size - 1, 1)
+
+    if kind == "gradient":
+        rgb = np.stack([x, y, (x + y) / 2], axis=-1) * 255
+
+    elif kind == "noise":
+        rgb = rng.integers(0, 256, (size, size, 3))
+
+    elif kind == "pixel_art":
+        # 16色のパレットで塗った粗いマスを拡大する (出力では1マスが4ピクセルになる)
+        cells = max(size // (source_scale * 4), 1)
+        palette = rng.integers(0, 256, (16, 3))
+        indices = rng.integers(0, 16, (cells, cells))
+        cell_size = -(-size // cells)
+        rgb = palette[np.repeat(np.repeat(indices, cell_size, axis=0), cell_size, axis=1)[:size, :size]]
+
+    elif kind == "photo":
+        # 粗い乱数を滑らかに拡大し、細かいノイズを加えて写真のような階調にする
+        coarse = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8), "RGB")
+        rgb = np.asarray(coarse.resize((size, size), Image.Resampling.BICUBIC), dtype=np.float64)
+        rgb = rgb + rng.normal(0, 6, rgb.shape)
+
+    else:
+        raise ValueError(f"Invalid image kind: {kind}")
+
+    # 中心からの距離で透明度を決める
+    distance = np.hypot(x - 0.5, y - 0.5) * 2
+    if alpha == "opaque":
+        a = np.full((size, size), 255)
+    elif alpha == "binary":
+        a = np.where(distance <= 1, 255, 0)
+    elif alpha == "soft":
+        a = (1 - np.clip(distance, 0, 1)) * 255
+    else:
+        raise ValueError(f"Invalid alpha kind: {alpha}")
+
+    rgba = np.dstack([np.clip(rgb, 0, 255), a]).astype(np.uint8)
+    return Image.fromarray(rgba, "RGBA")
+
+### @brief 関数の実行時間と最大メモリ使用量を計測する関数
+### @param function 計測する関数 (引数なし)
+### @param repeat 繰り返す回数 (時間は最も速かった回を使う)
+### @return 関数の戻り値、秒数、最大メモリ使用量 (バイト) のタプル
+### @details メモリの計測は時間に影響するので、時間を計測した後に1回だけ別に実行する
+def MeasureStage(function, repeat):
+    seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    tracemalloc.start()
+    try:
+        base_bytes = tracemalloc.get_traced_memory()[0]
+        function()
+        peak_bytes = tracemalloc.get_traced_memory()[1] - base_bytes
+    finally:
+        tracemalloc.stop()
+
+    return result, seconds, peak_bytes
+
+### @brief 1つの画像で各段階と全体を計測する関数
+### @param img 入力の画像オブジェクト
+### @param option オプションの辞書
+### @param repeat 繰り返す回数
+### @return 段階ごとの {"seconds", "peak_bytes"} の辞書と出力の文字数のタプル
+### @details 各段階の入力は前の段階の結果を使う
+def RunBenchmarkCase(img, option, repeat):
+    stages = {}
+
+    def Measure(stage, function):
+        result, seconds, peak_bytes = MeasureStage(function, repeat)
+        if (result is None) or (isinstance(result, tuple) and result[0] is None):
+            raise MFMConversionError(f"Stage {stage} failed.")
+        stages[stage] = {"seconds": seconds, "peak_bytes": peak_bytes}
+        return result
+
+    prepared = Measure("resize", lambda: PrepareImage(img, option))
+    color_array = Measure("to_array", lambda: ConvertPngToArray(prepared, read_only=True))
+    color_array = Measure("smooth", lambda: SmoothColorArray(color_array, option["smooth_repeat"], option["smooth_mode"]))
+    color_array, background_color = Measure("divide", lambda: QuantizeColorArray(color_array, option))
+    color_array = Measure("reduce", lambda: ReduceColorArray(color_array, option))
+    mfm_text = Measure("encode", lambda: EncodeColorArray(color_array, background_color, option))
+    total_text = Measure("total", lambda: ConvertImage(img, option))
+
+    if total_text != mfm_text:
+        raise MFMConversionError("End-to-end output differs from the staged output.")
+
+    return stages, len(mfm_text)
+
+### @brief すべての組み合わせを計測する関数
+### @param sizes 出力の幅のリスト
+### @param kinds 画像の種類のリスト
+### @param alphas 透明度の種類のリスト
+### @param option オプションの辞書
+### @param repeat 繰り返す回数
+### @return 結果の辞書
+def RunBenchmark(sizes, kinds, alphas, option, repeat):
+    cases = {}
+
+    for size in sizes:
+        # 正方形の画像を出力の幅に縮小する
+        case_option = {**option, "resize_width": size, "resize_height": size}
+        for kind in kinds:
+            for alpha in alphas:
+                name = f"{kind}-{alpha}-{size}"
+                img = CreateBenchmarkImage(kind, alpha, size * source_scale)
+                stages, chars = RunBenchmarkCase(img, case_option, repeat)
+                cases[name] = {"stages": stages, "chars": chars}
+                print(f"\t{name:<24} {stages['total']['seconds'] * 1000:>9.2f} ms  {chars:>8} chars")
+
+    return {
+        "version": benchmark_version,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "repeat": repeat,
+        "options": {key: option[key] for key in ["smooth_repeat", "smooth_mode", "dither_mode", "color_division", "max_row_colors", "global_colors", "color_type", "encoder_mode", "workers"]},
+        "cases": cases
+    }
+
+### @brief 結果を段階ごとの表で表示する関数
+### @param results RunBenchmark の戻り値
+def PrintResults(results):
+    cases = results["cases"]
+    name_width = max([len("Case")] + [len(name) for name in cases])
+
+    print(f"{'Case':<{name_width}}" + "".join(f"  {stage:>9}" for stage in benchmark_stages) + f"  {'peak MB':>8}  {'chars':>8}")
+    print("-" * (name_width + 11 * len(benchmark_stages) + 20))
+    for name, case in cases.items():
+        stages = case["stages"]
+        peak_mb = stages["total"]["peak_bytes"] / (1024 * 1024)
+        print(f"{name:<{name_width}}" + "".join(f"  {stages[stage]['seconds'] * 1000:>9.3f}" for stage in benchmark_stages) + f"  {peak_mb:>8.2f}  {case['chars']:>8}")
+    print("(times in ms, best of repeats)")
+
+### @brief 基準値と比較して、しきい値を超えて悪化した項目を探す関数
+### @param results 今回の結果
+### @param baseline 基準値の結果
+### @param time_threshold 時間の悪化とみなす割合 (0.25なら25%以上遅くなった場合)
+### @param memory_threshold メモリ使用量の悪化とみなす割合
+### @param chars_threshold 文字数の悪化とみなす割合 (0なら1文字でも増えた場合)
+### @param min_seconds これより小さい時間の差は誤差として無視する秒数
+### @param min_bytes これより小さいメモリの差は誤差として無視するバイト数
+### @return 悪化した項目と改善した項目の説明のリストのタプル
+def CompareResults(results, baseline, time_threshold, memory_threshold, chars_threshold, min_seconds = 0.001, min_bytes = 64 * 1024):
+    regressions = []
+    improvements = []
+
+    for name, case in results["cases"].items():
+        base_case = baseline["cases"].get(name)
+        if base_case is None:
+            continue
+
+        for stage, values in case["stages"].items():
+            base_values = base_case["stages"].get(stage)
+            if base_values is None:
+                continue
+
+            checks = [
+                ("time", values["seconds"], base_values["seconds"], time_threshold, min_seconds),
+                ("memory", values["peak_bytes"], base_values["peak_bytes"], memory_threshold, min_bytes)
+            ]
+            for metric, value, base_value, threshold, min_delta in checks:
+                if abs(value - base_value) < min_delta:
+                    continue
+                text = f"{name} {stage} {metric}: {base_value:.6g} -> {value:.6g} ({value / base_value - 1:+.1%})" if base_value > 0 else f"{name} {stage} {metric}: {base_value} -> {value}"
+                if value > base_value * (1 + threshold):
+                    regressions.append(text)
+                elif value < base_value * (1 - threshold):
+                    improvements.append(text)
+
+        chars, base_chars = case["chars"], base_case["chars"]
+        if chars != base_chars:
+            text = f"{name} chars: {base_chars} -> {chars} ({chars / base_chars - 1:+.2%})"
+            if chars > base_chars * (1 + chars_threshold):
+                regressions.append(text)
+            elif chars < base_chars:
+                improvements.append(text)
+
+    return regressions, improvements
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Benchmark each conversion stage on synthetic images.")
+    parser.add_argument("--sizes", default="32,64,128", help="comma separated output widths (default: 32,64,128)")
+    parser.add_argument("--kinds", default=",".join(image_kinds), help=f"comma separated image kinds (default: {','.join(image_kinds)})")
+    parser.add_argument("--alphas", default=",".join(alpha_kinds), help=f"comma separated alpha kinds (default: {','.join(alpha_kinds)})")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the fastest is kept (default: 5)")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE", help="override an option")
+    parser.add_argument("-o", "--output", default=None, help="write the results as JSON (use as a baseline later)")
+    parser.add_argument("--baseline", default=None, help="compare with a results JSON written by -o")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="slowdown ratio reported as a regression (default: 0.25)")
+    parser.add_argument("--memory-threshold", type=float, default=0.25, help="peak memory growth ratio reported as a regression (default: 0.25)")
+    parser.add_argument("--chars-threshold", type=float, default=0.0, help="output growth ratio reported as a regression (default: 0, any growth)")
+    parser.add_argument("--min-seconds", type=float, default=0.001, help="time differences below this are treated as noise (default: 0.001)")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = ParseArguments(argv)
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        print(f"Invalid sizes: {args.sizes}")
+        return 1
+    kinds = [kind.strip() for kind in args.kinds.split(",")]
+    alphas = [alpha.strip() for alpha in args.alphas.split(",")]
+    for value, choices in [(kind, image_kinds) for kind in kinds] + [(alpha, alpha_kinds) for alpha in alphas]:
+        if value not in choices:
+            print(f"Invalid value: {value} (choose from {', '.join(choices)})")
+            return 1
+
+    options = dict(benchmark_options)
+    for override in args.overrides:
+        if "=" not in override:
+            print(f"Invalid override: {override}")
+            return 1
+        key, value = override.split("=", 1)
+        options[key.strip()] = value.strip()
+
+    baseline = None
+    if args.baseline is not None:
+        try:
+            with open(args.baseline, "r", encoding="UTF-8") as baseline_file:
+                baseline = json.load(baseline_file)
+        except Exception as e:
+            print(f"Error loading baseline: {e}")
+            return 1
+        if baseline.get("version") != benchmark_version:
+            print(f"Baseline version {baseline.get('version')} does not match {benchmark_version}.")
+            return 1
+
+    try:
+        option = LoadOptions(options)
+        print(f"Running {len(sizes) * len(kinds) * len(alphas)} cases, {args.repeat} runs per stage")
+        results = RunBenchmark(sizes, kinds, alphas, option, max(1, args.repeat))
+    except MFMConversionError as e:
+        print(f"Benchmark failed: {e}")
+        return 1
+
+    print()
+    PrintResults(results)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="UTF-8") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if baseline is None:
+        return 0
+
+    if baseline.get("options") != results["options"]:
+        print("Warning: baseline was measured with different options.")
+
+    regressions, improvements = CompareResults(results, baseline, args.time_threshold, args.memory_threshold, args.chars_threshold, args.min_seconds)
+    print(f"\nCompared with {args.baseline}: {len(regressions)} regressions, {len(improvements)} improvements")
+    for text in improvements:
+        print(f"\timproved:  {text}")
+    for text in regressions:
+        print(f"\tREGRESSED: {text}")
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -1,6 +1,5 @@
-import copy
 import numpy as np
-from sklearn.cluster import KMeans
+from Instrumentation import *
 
 #==================================================
 # 減色処理用関数
@@ -8,22 +7,28 @@ from sklearn.cluster import KMeans
 
 ### @brief pngファイルから色だけを抽出した配列に変換する関数
 ### @param img 画像オブジェクト
-### @return 色の配列 (辞書型3次元配列)。変換に失敗した場合はNoneを返す。
-def ConvertPngToArray(img):
-    print("Converting PNG to color array.")
+### @param read_only Trueなら画像のバッファを読み取り専用のまま返す (後段で配列を書き換えない場合に使用)
+### @return 色の配列 (height, width, 4) のuint8配列。変換に失敗した場合はNoneを返す。
+def ConvertPngToArray(img, read_only = False):
+    logger.info("Converting PNG to color array.")
 
     try:
-        # 画像のピクセルの色を取得
-        color_array = np.zeros((img.height, img.width, 4), dtype=np.uint8)
-        for y in range(img.size[1]):
-            for x in range(img.size[0]):
-                pixel = img.getpixel((x, y))
-                color_array[y][x] = [pixel[0], pixel[1], pixel[2], pixel[3]]
+        # RGBA以外の画像はRGBAに揃える
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
 
-        return color_array
+        # Pillowのバッファから一括で変換する
+        if read_only:
+            # 読み取り専用のビュー (コピーは1回のみ)
+            color_array = np.asarray(img, dtype=np.uint8)
+        else:
+            # 書き換え可能な配列としてコピー
+            color_array = np.array(img, dtype=np.uint8)
+
+        return color_array.reshape((img.height, img.width, 4))
 
     except Exception as e:
-        print(f"Error converting PNG to array: {e}")
+        logger.error(f"Error converting PNG to array: {e}")
         return None
 
 ### @brief 色を平均化する関数
@@ -53,60 +58,99 @@ def SmoothColor(color_array):
 
     return averaged_color
 
+# 平均化の種類ごとの隣接ピクセルの位置 (y, x)
+smooth_mode_offsets = {
+    "horizontal": ((0, -1), (0, 1)),
+    "vertical": ((-1, 0), (1, 0)),
+    "2d": ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)),
+}
+
 ### @brief 隣合う色の平均値を出して滑らかにする関数
 ### @param color_array 色の配列 (R, G, B, A)
-### @return 平均値を求めたあとの色の配列
-def SmoothColorArray(color_array):
-    height = len(color_array)
-    width = len(color_array[0])
-    smoothed_array = copy.deepcopy(color_array)
-
-    for y in range(height):
-        for x in range(width):
-            current_color = color_array[y][x]
-
-            # 現在のピクセルが透明なら処理せずそのまま適用
-            if current_color[3] == 0:
-                smoothed_array[y][x] = current_color
-                continue
-
-            # 隣接ピクセルの取得（透明なピクセルは除外）
-            neighbor_colors = [current_color]
-
-            if (x > 0) and (color_array[y][x - 1][3] != 0):
-                neighbor_colors.append(color_array[y][x - 1])
-
-            if (x < width - 1) and (color_array[y][x + 1][3] != 0):
-                neighbor_colors.append(color_array[y][x + 1])
-
-            # 隣接ピクセルがない場合は現在の色をそのまま適用
-            if len(neighbor_colors) == 1:
-                smoothed_array[y][x] = current_color
-                continue
-            
-            # 各色成分を平均化
-            smoothed_array[y][x] = SmoothColor(neighbor_colors)
-            
-    return smoothed_array
+### @param repeat 平均化の繰り返し回数
+### @param mode 平均化の種類（"horizontal": 横方向, "vertical": 縦方向, "2d": 周囲8方向）
+### @return 平均値を求めたあとの色の配列。失敗した場合はNoneを返す。
+def SmoothColorArray(color_array, repeat = 1, mode = "horizontal"):
+    if mode not in smooth_mode_offsets:
+        logger.error(f"Invalid smooth mode: {mode}")
+        return None
+
+    try:
+        # 整数の作業用配列 (各回の平均化はこのバッファを使い回す)
+        current = np.array(color_array, dtype=np.int32)
+        if repeat <= 0:
+            return current.astype(np.uint8)
+
+        height, width = current.shape[:2]
+        # 透明でないピクセルのマスク。不透明度の平均は0にならないので繰り返しても変わらない
+        opaque = current[:, :, 3] != 0
+        masked = np.empty_like(current)
+        sums = np.empty_like(current)
+        counts = np.empty((height, width), dtype=np.int32)
+
+        for _ in range(repeat):
+            # 透明なピクセルを除外した色と、自分自身を含めた合計
+            np.multiply(current, opaque[:, :, None], out=masked)
+            np.copyto(sums, masked)
+            np.copyto(counts, opaque)
+
+            # 隣接ピクセルの色を合計（画像の外と透明なピクセルは除外）
+            for dy, dx in smooth_mode_offsets[mode]:
+                y0, y1 = max(0, -dy), height - max(0, dy)
+                x0, x1 = max(0, -dx), width - max(0, dx)
+                if (y0 >= y1) or (x0 >= x1):
+                    continue
+                sums[y0:y1, x0:x1] += masked[y0 + dy:y1 + dy, x0 + dx:x1 + dx]
+                counts[y0:y1, x0:x1] += opaque[y0 + dy:y1 + dy, x0 + dx:x1 + dx]
+
+            # 各色成分を平均化 (小数点以下は切り捨て)。透明なピクセルはそのまま
+            np.maximum(counts, 1, out=counts)
+            np.floor_divide(sums, counts[:, :, None], out=sums)
+            np.copyto(current, sums, where=opaque[:, :, None])
+
+        return current.astype(np.uint8)
+
+    except Exception as e:
+        logger.error(f"Error smoothing colors: {e}")
+        return None
+
+### @brief 色の量子化テーブルを作成する関数
+### @param division 割り算の値 (1以上の値)
+### @return 0～255の各値を量子化した256要素のuint8配列。作成に失敗した場合はNoneを返す。
+def CreateQuantizeTable(division):
+    if division < 1:
+        logger.error("Division value must be 1 or greater.")
+        return None
+
+    # 各値を割り算して掛け算し直し、division の半分の値を足して平均化する (QuantizeColorと同じ計算)
+    return np.array(
+        [min(int(int(value / division) * division) + int(division / 2), 255) for value in range(256)],
+        dtype=np.uint8
+    )
 
 ### @brief 色を量子化する関数
 ### @param color 色
 ### @param division 割り算の値 (1以上の値)
+### @param table CreateQuantizeTableで作成した量子化テーブル (省略時は毎回計算する)
 ### @return 量子化された色 (R, G, B, A)。割り算に失敗した場合はNoneを返す。
-def QuantizeColor(color, division):
+def QuantizeColor(color, division, table = None):
     if division < 1:
-        print("Division value must be 1 or greater.")
+        logger.error("Division value must be 1 or greater.")
         return None
     elif division == 1:
         # 割り算値が1の場合はそのまま返す
         return color
 
     if (color[0] < 0) or (color[1] < 0) or (color[2] < 0) or (color[3] < 0):
-        print("Invalid color values.")
+        logger.error("Invalid color values.")
         return color
 
     try:
         r, g, b, a = color
+        # 量子化テーブルがある場合はテーブルから取得。アルファ値はそのまま
+        if table is not None:
+            return (int(table[r]), int(table[g]), int(table[b]), a)
+
         # 各成分を割り算。アルファ値はそのまま
         r = int(r / division)
         g = int(g / division)
@@ -119,60 +163,875 @@ def QuantizeColor(color, division):
         return (r, g, b, a)
 
     except Exception as e:
-        print(f"Error quantizing color: {e}")
+        logger.error(f"Error quantizing color: {e}")
         return None
 
 ### @brief 色を割り算で減色する関数
 ### @param color_array 色の配列 (R, G, B, A)
 ### @param division 割り算の値 (1以上の値)
+### @param in_place Trueなら元の配列を直接書き換える (読み取り専用の配列はコピーする)
+### @param table CreateQuantizeTableで作成した量子化テーブル (省略時はここで作成する)
 ### @return 割り算後の色 (R, G, B, A)。割り算に失敗した場合はNoneを返す。
-def DivideColor(color_array, division):
-    print(f"Dividing color by: {division}")
+def DivideColor(color_array, division, in_place = False, table = None):
+    logger.info(f"Dividing color by: {division}")
 
     if division < 1:
-        print("Division value must be 1 or greater.")
+        logger.error("Division value must be 1 or greater.")
         return None
-    elif division == 1:
-        # 割り算値が1の場合はそのまま返す
-        return copy.deepcopy(color_array)
 
     try:
-        new_color_array = copy.deepcopy(color_array)
-        # 割り算後の色を計算
-        for y in range(len(color_array)):
-            for x in range(len(color_array[0])):
-                color = color_array[y][x]
-                # 現在のピクセルが透明なら処理せずそのまま適用
-                if color[3] == 0:
-                    new_color_array[y][x] = color
-                    continue
-                # 色を量子化
-                new_color_array[y][x] = QuantizeColor(color, division)
+        # 書き換え可能なuint8配列でなければコピーする
+        if in_place and isinstance(color_array, np.ndarray) and (color_array.dtype == np.uint8) and color_array.flags.writeable:
+            new_color_array = color_array
+        else:
+            new_color_array = np.array(color_array, dtype=np.uint8)
+
+        # 割り算値が1の場合はそのまま返す
+        if division == 1:
+            return new_color_array
+
+        if table is None:
+            table = CreateQuantizeTable(division)
+
+        # RGBをテーブルで一括変換。透明なピクセルとアルファ値はそのまま
+        rgb = new_color_array[:, :, :3]
+        opaque = new_color_array[:, :, 3:] != 0
+        np.copyto(rgb, table[rgb], where=opaque)
 
         return new_color_array
 
     except Exception as e:
-        print(f"Error dividing color: {e}")
+        logger.error(f"Error dividing color: {e}")
         return None
 
-### @brief 各行ごとに色をK-Meansクラスタリングで減色する関数
-### @param color_array 色の配列 (R, G, B, A)
+# k-meansの計算で一度に扱う要素数の目安 (行数 × 列数 × 色数)
+kmeans_batch_elements = 1 << 22
+
+# 行の減色に使うプロセスプール (同じプロセス内の画像で使い回す)
+process_pool = None
+# プロセスプールのワーカー数
+process_pool_workers = 0
+
+### @brief 行番号と回数から再現性のある乱数を作る関数 (splitmix64)
+### @param seed 乱数のシード値
+### @param rows 行番号の配列
+### @param step 乱数を使う回数目
+### @return 行ごとの 0 以上 1 未満の乱数の配列
+def RowRandom(seed, rows, step):
+    # 行番号ごとに独立した値にすることで、一度に処理する行の組み合わせに結果が左右されないようにする
+    z = np.asarray(rows, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    z += np.uint64((seed * 0x632BE59BD9B4E019 + step * 0xD1B54A32D192ED03) & 0xFFFFFFFFFFFFFFFF)
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xBF58476D1CE4E5B9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+### @brief 各サンプルから最も近い中心のインデックスを求める関数
+### @param samples サンプルの配列 (行数, サンプル数, 次元数)
+### @param centers 中心の配列 (行数, 色数, 次元数)
+### @return 最も近い中心のインデックスの配列 (行数, サンプル数)
+def NearestCenters(samples, centers):
+    distances = np.einsum("rkd,rkd->rk", centers, centers)[:, None, :]
+    distances = distances - 2.0 * np.einsum("rnd,rkd->rnk", samples, centers)
+    return np.argmin(distances, axis=2)
+
+### @brief 全行まとめてk-meansクラスタリングを行う関数
+### @param samples サンプルの配列 (行数, サンプル数, 次元数)
+### @param n_colors クラスタの数
+### @param weights サンプルごとの重みの配列 (行数, サンプル数)。省略時はすべて1
+### @param rows 乱数に使う行番号の配列。省略時は 0 から順番
+### @param seed 乱数のシード値
+### @param max_iter 最大の繰り返し回数
+### @param tol 中心の移動量 (2乗) が行の分散のこの倍率以下になった行は収束したとみなす
+### @return (中心の配列 (行数, 色数, 次元数), 各サンプルのクラスタ番号の配列 (行数, サンプル数))
+def KMeansRows(samples, n_colors, weights = None, rows = None, seed = 0, max_iter = 300, tol = 1e-4):
+    samples = np.asarray(samples, dtype=np.float64)
+    n_rows, n_samples, _ = samples.shape
+    if weights is None:
+        weights = np.ones((n_rows, n_samples), dtype=np.float64)
+    if rows is None:
+        rows = np.arange(n_rows)
+    row_range = np.arange(n_rows)
+
+    #==================================================
+    # k-means++ で初期の中心を決める
+    #==================================================
+
+    centers = np.empty((n_rows, n_colors, samples.shape[2]), dtype=np.float64)
+    probability = weights
+    min_distances = None
+    for k in range(n_colors):
+        # 重みに比例した確率でサンプルを選ぶ
+        cumulative = np.cumsum(probability, axis=1)
+        total = cumulative[:, -1]
+        target = RowRandom(seed, rows, k) * total
+        index = np.minimum((cumulative <= target[:, None]).sum(axis=1), n_samples - 1)
+        # 残りの色がない行 (色の種類が色数より少ない行) は既存の中心と同じ色を選ぶ
+        index[total <= 0] = 0
+        centers[:, k] = samples[row_range, index]
+
+        # 選んだ中心までの距離の2乗を確率にする
+        distances = ((samples - centers[:, k][:, None, :]) ** 2).sum(axis=2)
+        min_distances = distances if min_distances is None else np.minimum(min_distances, distances)
+        probability = weights * min_distances
+
+    #==================================================
+    # Lloyd法で中心を更新する (収束した行は以降の計算から外す)
+    #==================================================
+
+    # 収束の判定に使う移動量は行ごとの分散に合わせる (scikit-learn と同じ考え方)
+    total_weights = np.maximum(weights.sum(axis=1), 1e-12)
+    means = np.einsum("rn,rnd->rd", weights, samples) / total_weights[:, None]
+    variances = np.einsum("rn,rnd->r", weights, (samples - means[:, None, :]) ** 2) / total_weights
+    tolerances = tol * variances / samples.shape[2]
+
+    active = row_range
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+
+        active_samples = samples[active]
+        active_centers = centers[active]
+        labels = NearestCenters(active_samples, active_centers)
+
+        # クラスタごとの重み付き平均を計算。サンプルがないクラスタは中心を動かさない
+        active_weights = weights[active]
+        bins = (np.arange(active.size)[:, None] * n_colors + labels).ravel()
+        n_bins = active.size * n_colors
+        counts = np.bincount(bins, weights=active_weights.ravel(), minlength=n_bins).reshape((active.size, n_colors))
+        sums = np.stack([
+            np.bincount(bins, weights=(active_weights * active_samples[:, :, d]).ravel(), minlength=n_bins)
+            for d in range(samples.shape[2])
+        ], axis=1).reshape(active_centers.shape)
+        new_centers = np.where(counts[:, :, None] > 0, sums / np.maximum(counts, 1e-12)[:, :, None], active_centers)
+
+        centers[active] = new_centers
+        shift = ((new_centers - active_centers) ** 2).sum(axis=(1, 2))
+        active = active[shift > tolerances[active]]
+
+    # 最終的な中心でクラスタ番号を決める
+    return centers, NearestCenters(samples, centers)
+
+### @brief 各行の色を重複のない色と出現回数にまとめる関数
+### @param pixels 色の配列 (R, G, B, A)
+### @return (行ごとの色の配列 (行数, 最大色数, 4), 出現回数の配列 (行数, 最大色数), 各ピクセルの色の番号の配列 (行数, 列数), 行ごとの色の種類の数)
+def UniqueRowColors(pixels):
+    height, width = pixels.shape[:2]
+    row_range = np.arange(height)[:, None]
+
+    # RGBAを1つの整数にまとめて行ごとに並べ替える
+    codes = pixels.astype(np.uint32)
+    codes = (codes[:, :, 0] << 24) | (codes[:, :, 1] << 16) | (codes[:, :, 2] << 8) | codes[:, :, 3]
+    order = np.argsort(codes, axis=1, kind="stable")
+    sorted_codes = np.take_along_axis(codes, order, axis=1)
+
+    # 値が変わる位置で色の番号を進める
+    is_new = np.ones((height, width), dtype=np.int64)
+    is_new[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+    groups = np.cumsum(is_new, axis=1) - 1
+    inverse = np.empty_like(groups)
+    np.put_along_axis(inverse, order, groups, axis=1)
+    n_unique = groups[:, -1] + 1
+
+    # 行ごとの色と出現回数 (色の種類が少ない行の残りは出現回数0で埋める)
+    max_unique = int(n_unique.max()) if height > 0 else 0
+    colors = np.zeros((height, max_unique, 4), dtype=np.uint8)
+    colors[row_range, groups] = np.take_along_axis(pixels, order[:, :, None], axis=1)
+    counts = np.bincount((row_range * max_unique + groups).ravel(), minlength=height * max_unique)
+    counts = counts.reshape((height, max_unique)).astype(np.float64)
+
+    return colors, counts, inverse, n_unique
+
+### @brief scikit-learnで各行の色をK-Meansクラスタリングする関数
+### @param pixels 色の配列 (R, G, B, A)
 ### @param n_colors 行ごとの色の数
+### @param seed 乱数のシード値
 ### @return 各行ごとに色を減色した色の配列
-def ReduceColorsPerRow(color_array, n_colors):
-    pixels = np.array(color_array)
-    
+def ReduceColorsPerRowSklearn(pixels, n_colors, seed):
+    # scikit-learn は必要なときだけ読み込む
+    from sklearn.cluster import KMeans
+
+    reduce_color_array = pixels.copy()
     for y in range(pixels.shape[0]):  # 各行ごとに処理
-        row_pixels = pixels[y, :, :]
+        # 行の色を重複のない色と出現回数にまとめる
+        unique_colors, inverse, counts = np.unique(pixels[y, :, :], axis=0, return_inverse=True, return_counts=True)
+
+        # 色の種類が色数以下の行はそのまま
+        if len(unique_colors) <= n_colors:
+            continue
+
+        # 出現回数を重みにしてK-Meansクラスタリングで色を分類し、最も近い代表色に置換
+        kmeans = KMeans(n_clusters=n_colors, random_state=seed, n_init="auto")
+        labels = kmeans.fit_predict(unique_colors, sample_weight=counts)
+        reduce_color_array[y, :, :] = kmeans.cluster_centers_[labels[inverse.reshape(-1)]]
+
+    return reduce_color_array
+
+### @brief 指定した行をまとめて減色する関数
+### @param pixels 色の配列 (R, G, B, A)
+### @param n_colors 行ごとの色の数
+### @param backend クラスタリングの実装（"builtin" または "sklearn"）
+### @param row_offset 先頭の行の画像全体での行番号
+### @param seed 乱数のシード値
+### @return 各行ごとに色を減色した色の配列
+def ReduceColorsRows(pixels, n_colors, backend, row_offset, seed):
+    if backend == "sklearn":
+        return ReduceColorsPerRowSklearn(pixels, n_colors, seed)
+
+    height, width = pixels.shape[:2]
+    # 色の種類が色数以下の行はそのまま
+    reduce_color_array = pixels.copy()
+
+    # 計算用の配列が大きくなりすぎないように行をまとめて処理
+    batch_rows = max(1, kmeans_batch_elements // max(1, width * n_colors))
+    for start in range(0, height, batch_rows):
+        end = min(start + batch_rows, height)
+
+        # 行の色を重複のない色と出現回数にまとめ、色数を超える行だけクラスタリングする
+        colors, counts, inverse, n_unique = UniqueRowColors(pixels[start:end])
+        targets = np.flatnonzero(n_unique > n_colors)
+        if targets.size == 0:
+            continue
+
+        # 必要な分だけ詰めて、出現回数を重みにしてクラスタリング
+        max_unique = int(n_unique[targets].max())
+        centers, labels = KMeansRows(
+            colors[targets, :max_unique],
+            n_colors,
+            weights=counts[targets, :max_unique],
+            rows=row_offset + start + targets,
+            seed=seed
+        )
+
+        # 各色を最も近い代表色に置換し、元のピクセルの並びに戻す
+        reduced_colors = np.take_along_axis(centers, labels[:, :, None], axis=1)
+        reduce_color_array[start + targets] = np.take_along_axis(reduced_colors, inverse[targets][:, :, None], axis=1)
+
+    return reduce_color_array
 
-        # K-Meansクラスタリングで色を分類
-        kmeans = KMeans(n_clusters=n_colors)
-        kmeans.fit(row_pixels)
-        clustered_colors = kmeans.cluster_centers_
+### @brief 減色用のプロセスプールを取得する関数
+### @param workers ワーカー数
+### @return プロセスプール
+def GetProcessPool(workers):
+    global process_pool, process_pool_workers
+    from concurrent.futures import ProcessPoolExecutor
+
+    # ワーカー数が変わった場合は作り直す
+    if (process_pool is None) or (process_pool_workers != workers):
+        ShutdownProcessPool()
+        process_pool = ProcessPoolExecutor(max_workers=workers)
+        process_pool_workers = workers
+
+    return process_pool
+
+### @brief 減色用のプロセスプールを終了する関数
+def ShutdownProcessPool():
+    global process_pool, process_pool_workers
+
+    if process_pool is not None:
+        process_pool.shutdown()
+    process_pool = None
+    process_pool_workers = 0
+
+### @brief 共有メモリ上の行の帯を減色する関数 (プロセスプールのワーカーで実行)
+### @param input_name 入力の共有メモリの名前
+### @param output_name 出力の共有メモリの名前
+### @param shape 画像全体の配列の形状
+### @param start 帯の先頭の行
+### @param end 帯の末尾の行 (この行は含まない)
+### @param n_colors 行ごとの色の数
+### @param backend クラスタリングの実装
+### @param seed 乱数のシード値
+### @param row_offset 配列の先頭の行の画像全体での行番号
+### @return 処理した行数
+def ReduceColorsBand(input_name, output_name, shape, start, end, n_colors, backend, seed, row_offset = 0):
+    from multiprocessing import shared_memory
+
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=input_memory.buf)
+        output = np.ndarray(shape, dtype=np.uint8, buffer=output_memory.buf)
+        output[start:end] = ReduceColorsRows(pixels[start:end], n_colors, backend, row_offset + start, seed)
+        # 共有メモリを閉じる前に配列の参照を外す
+        del pixels, output
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+    return end - start
+
+### @brief 行を帯に分けてプロセスプールで並列に減色する関数
+### @param pixels 色の配列 (R, G, B, A)
+### @param n_colors 行ごとの色の数
+### @param backend クラスタリングの実装
+### @param seed 乱数のシード値
+### @param workers ワーカー数
+### @param row_offset 配列の先頭の行の画像全体での行番号
+### @return 各行ごとに色を減色した色の配列
+def ReduceColorsParallel(pixels, n_colors, backend, seed, workers, row_offset = 0):
+    from multiprocessing import shared_memory
+
+    height = pixels.shape[0]
+    pool = GetProcessPool(workers)
+
+    # 行の帯はpickleせず共有メモリで受け渡す
+    input_memory = shared_memory.SharedMemory(create=True, size=max(1, pixels.nbytes))
+    output_memory = shared_memory.SharedMemory(create=True, size=max(1, pixels.nbytes))
+    try:
+        shared_pixels = np.ndarray(pixels.shape, dtype=np.uint8, buffer=input_memory.buf)
+        shared_pixels[:] = pixels
+        del shared_pixels
+
+        # ワーカー数より多めに帯を分けて処理時間の偏りをならす
+        band_rows = max(1, -(-height // (workers * 4)))
+        futures = [
+            pool.submit(ReduceColorsBand, input_memory.name, output_memory.name, pixels.shape, start, min(start + band_rows, height), n_colors, backend, seed, row_offset)
+            for start in range(0, height, band_rows)
+        ]
+        for future in futures:
+            future.result()
+
+        shared_output = np.ndarray(pixels.shape, dtype=np.uint8, buffer=output_memory.buf)
+        reduce_color_array = shared_output.copy()
+        del shared_output
+        return reduce_color_array
+
+    finally:
+        input_memory.close()
+        input_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
+
+### @brief 各行ごとに色をK-Meansクラスタリングで減色する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param n_colors 行ごとの色の数
+### @param backend クラスタリングの実装（"builtin": 全行まとめて計算, "sklearn": scikit-learn）
+### @param seed 乱数のシード値
+### @param workers 並列に処理するプロセス数 (1以下なら並列化しない)
+### @param row_offset 配列の先頭の行の画像全体での行番号 (画像を帯に分けて処理する場合に指定)
+### @return 各行ごとに色を減色した色の配列 (uint8配列)。失敗した場合はNoneを返す。
+def ReduceColorsPerRow(color_array, n_colors, backend = "builtin", seed = 0, workers = 1, row_offset = 0):
+    logger.info(f"Reducing colors per row: {n_colors} ({backend}, workers: {workers})")
+
+    if n_colors < 1:
+        logger.error("Number of row colors must be 1 or greater.")
+        return None
+
+    if backend not in ["builtin", "sklearn"]:
+        logger.error(f"Invalid k-means backend: {backend}")
+        return None
+
+    try:
+        pixels = np.asarray(color_array, dtype=np.uint8)
+
+        # 行ごとの乱数は行番号で決まるので、ワーカー数に関係なく同じ結果になる
+        if (workers > 1) and (pixels.shape[0] > 1):
+            return ReduceColorsParallel(pixels, n_colors, backend, seed, workers, row_offset)
+
+        return ReduceColorsRows(pixels, n_colors, backend, row_offset, seed)
+
+    except Exception as e:
+        logger.error(f"Error reducing colors per row: {e}")
+        return None
+
+#==================================================
+# 画像全体のパレットによる減色用関数
+#==================================================
 
-        # 最も近い代表色に置換
-        labels = kmeans.predict(row_pixels)
-        pixels[y, :, :] = clustered_colors[labels]
+# 最近傍の色を総当たりで探すときに一度に扱う色の数
+nearest_color_batch = 1 << 16
 
-    reduce_color_array = pixels.astype(np.uint8)
-    return reduce_color_array.tolist()
\ No newline at end of file
+### @brief メディアンカット法でパレットを作成する関数
+### @param colors 色の配列 (色の種類, 4)
+### @param counts 各色の出現回数
+### @param n_colors パレットの色数
+### @return パレットの配列 (色数, 4)
+def CreatePaletteMedianCut(colors, counts, n_colors):
+    colors = colors.astype(np.float64)
+    boxes = [np.arange(len(colors))]
+
+    while len(boxes) < n_colors:
+        # 色の範囲が最も広い箱を選ぶ
+        ranges = [np.ptp(colors[box], axis=0) for box in boxes]
+        box_index = int(np.argmax([box_range.max() for box_range in ranges]))
+        if ranges[box_index].max() <= 0:
+            # すべての箱が1色だけになったら終了
+            break
+
+        # 範囲が最も広い成分で並べ替え、出現回数の中央で2つに分ける
+        box = boxes.pop(box_index)
+        channel = int(np.argmax(ranges[box_index]))
+        box = box[np.argsort(colors[box, channel], kind="stable")]
+        cumulative = np.cumsum(counts[box])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(box) - 1)
+        boxes += [box[:split], box[split:]]
+
+    # 箱ごとに出現回数で重み付けした平均色を代表色にする
+    return np.array([np.average(colors[box], axis=0, weights=counts[box]) for box in boxes])
+
+### @brief 八分木法 (Pillow の FASTOCTREE) でパレットを作成する関数
+### @param colors 色の配列 (色の種類, 4)
+### @param n_colors パレットの色数
+### @return パレットの配列 (色数, 4)
+def CreatePaletteOctree(colors, n_colors):
+    from PIL import Image
+
+    # 重複のない色だけを並べた画像からパレットを作る
+    img = Image.fromarray(np.ascontiguousarray(colors[None, :, :]), "RGBA")
+    quantized = img.quantize(colors=n_colors, method=Image.Quantize.FASTOCTREE)
+    used = np.unique(np.asarray(quantized))
+    palette = np.array(quantized.getpalette("RGBA"), dtype=np.float64).reshape((-1, 4))
+    return palette[used]
+
+### @brief 画像全体のパレットを作成する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param n_colors パレットの色数
+### @param method パレットの作成方法（"median_cut", "octree", "kmeans"）
+### @param seed 乱数のシード値 (kmeans のみ使用)
+### @return パレットの配列 (色数, 4) のuint8配列。作成に失敗した場合はNoneを返す。
+def CreatePalette(color_array, n_colors, method = "median_cut", seed = 0):
+    logger.info(f"Creating palette: {n_colors} ({method})")
+
+    if n_colors < 1:
+        logger.error("Number of palette colors must be 1 or greater.")
+        return None
+
+    try:
+        pixels = np.asarray(color_array, dtype=np.uint8).reshape((1, -1, 4))
+        # 透明なピクセルはパレットの計算から除外
+        pixels = pixels[:, pixels[0, :, 3] != 0]
+        if pixels.shape[1] == 0:
+            return np.zeros((0, 4), dtype=np.uint8)
+
+        # 画像全体の色を重複のない色と出現回数にまとめる
+        colors, counts, _, _ = UniqueRowColors(pixels)
+        return CreatePaletteFromColors(colors[0], counts[0], n_colors, method, seed)
+
+    except Exception as e:
+        logger.error(f"Error creating palette: {e}")
+        return None
+
+### @brief 不透明なピクセルの色を数えて、今までの集計に加える関数 (複数の画像の色をまとめて数える場合に使用)
+### @param color_array 色の配列 (R, G, B, A)
+### @param colors 今までに集計した重複のない色の配列 (色の種類, 4)。Noneなら新しく集計する
+### @param counts 今までに集計した各色の出現回数
+### @return 重複のない色の配列と出現回数のタプル
+def CountColors(color_array, colors = None, counts = None):
+    pixels = np.asarray(color_array, dtype=np.uint8).reshape((-1, 4))
+    pixels = pixels[pixels[:, 3] != 0]
+    weights = np.ones(len(pixels), dtype=np.float64)
+    if colors is not None:
+        pixels = np.concatenate([colors, pixels])
+        weights = np.concatenate([counts, weights])
+
+    # RGBAを1つの整数にまとめて重複を除く (UniqueRowColors と同じ並び順になる)
+    codes = pixels.astype(np.uint32)
+    codes = (codes[:, 0] << 24) | (codes[:, 1] << 16) | (codes[:, 2] << 8) | codes[:, 3]
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(unique_codes))
+    colors = np.stack([unique_codes >> 24, unique_codes >> 16, unique_codes >> 8, unique_codes], axis=1)
+    return (colors & 0xff).astype(np.uint8), counts
+
+### @brief 重複のない色と出現回数からパレットを作成する関数 (複数の画像で共有するパレットにも使用)
+### @param colors 重複のない色の配列 (色の種類, 4)
+### @param counts 各色の出現回数
+### @param n_colors パレットの色数
+### @param method パレットの作成方法（"median_cut", "octree", "kmeans"）
+### @param seed 乱数のシード値 (kmeans のみ使用)
+### @return パレットの配列 (色数, 4) のuint8配列。作成に失敗した場合はNoneを返す。
+def CreatePaletteFromColors(colors, counts, n_colors, method = "median_cut", seed = 0):
+    try:
+        # 色の種類が色数以下ならそのままパレットにする
+        if len(colors) <= n_colors:
+            return np.asarray(colors, dtype=np.uint8)
+
+        if method == "median_cut":
+            palette = CreatePaletteMedianCut(colors, counts, n_colors)
+        elif method == "octree":
+            palette = CreatePaletteOctree(colors, n_colors)
+        elif method == "kmeans":
+            centers, _ = KMeansRows(colors[None, :, :], n_colors, weights=counts[None, :], seed=seed)
+            palette = centers[0]
+        else:
+            logger.error(f"Invalid palette method: {method}")
+            return None
+
+        # 重複した色を除いてuint8に丸める
+        return np.unique(np.clip(np.rint(palette), 0, 255).astype(np.uint8), axis=0)
+
+    except Exception as e:
+        logger.error(f"Error creating palette: {e}")
+        return None
+
+### @brief 3桁RGB用の最近傍の色の索引 (16x16x16) を作成する関数
+### @param palette パレットの配列 (色数, 4)
+### @return 3桁RGBの各色に最も近いパレットの番号の配列 (4096要素)
+def CreateNearestColorTable(palette):
+    # 3桁RGBで出力される各色 (0x00, 0x11, ..., 0xff) に最も近いパレットの色を求める
+    levels = np.arange(16, dtype=np.float64) * 17
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape((-1, 3))
+    rgb = palette[:, :3].astype(np.float64)
+    distances = (grid ** 2).sum(axis=1)[:, None] - 2.0 * grid @ rgb.T + (rgb ** 2).sum(axis=1)[None, :]
+    return np.argmin(distances, axis=1)
+
+### @brief 各色に最も近いパレットの番号を求める関数
+### @param colors 色の配列 (色の種類, 4)
+### @param palette パレットの配列 (色数, 4)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 最も近いパレットの番号の配列
+def NearestPaletteIndex(colors, palette, color_type):
+    if color_type == 1:
+        # 3桁RGBは出力される精度の索引から引く
+        table = CreateNearestColorTable(palette)
+        colors = colors.astype(np.int64)
+        return table[((colors[:, 0] >> 4) << 8) | ((colors[:, 1] >> 4) << 4) | (colors[:, 2] >> 4)]
+
+    # それ以外は重複のない色ごとにまとめて総当たりで探す
+    palette = palette.astype(np.float64)
+    palette_norm = (palette ** 2).sum(axis=1)
+    indices = np.empty(len(colors), dtype=np.int64)
+    for start in range(0, len(colors), nearest_color_batch):
+        batch = colors[start:start + nearest_color_batch].astype(np.float64)
+        indices[start:start + nearest_color_batch] = np.argmin(palette_norm[None, :] - 2.0 * batch @ palette.T, axis=1)
+    return indices
+
+### @brief 画像全体のパレットで色を減色する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param n_colors パレットの色数
+### @param method パレットの作成方法（"median_cut", "octree", "kmeans"）
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @param palette 使用するパレット (省略時は画像から作成する)
+### @param seed 乱数のシード値
+### @return パレットの色に置き換えた色の配列 (uint8配列)。失敗した場合はNoneを返す。
+def ReduceColorsGlobal(color_array, n_colors, method = "median_cut", color_type = 0, palette = None, seed = 0):
+    logger.info(f"Reducing colors with global palette: {n_colors} ({method})")
+
+    if palette is None:
+        palette = CreatePalette(color_array, n_colors, method, seed)
+        if palette is None:
+            return None
+
+    try:
+        pixels = np.asarray(color_array, dtype=np.uint8)
+        reduce_color_array = pixels.copy()
+        opaque = pixels[:, :, 3] != 0
+        if (len(palette) == 0) or (not opaque.any()):
+            return reduce_color_array
+
+        # 重複のない色ごとに最も近いパレットの色を求め、ピクセルに戻す (透明なピクセルはそのまま)
+        colors, _, inverse, _ = UniqueRowColors(pixels[opaque][None, :, :])
+        indices = NearestPaletteIndex(colors[0], palette, color_type)
+        reduce_color_array[opaque] = palette[indices[inverse[0]]]
+
+        return reduce_color_array
+
+    except Exception as e:
+        logger.error(f"Error reducing colors with global palette: {e}")
+        return None
+
+#==================================================
+# 近い色をまとめる関数
+#==================================================
+
+# sRGB (D65) の線形RGBからXYZへの変換行列
+rgb_to_xyz_matrix = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041]
+])
+# D65の白色点 (XYZ)
+d65_white = np.array([0.95047, 1.0, 1.08883])
+
+# 近い色をまとめるときに一度に扱う要素数 (行数 × 色の種類 × 色の種類)
+merge_batch_elements = 1 << 22
+
+### @brief RGBをL*a*b*に変換する関数
+### @param rgb 色の配列 (..., 3)
+### @return L*a*b*の配列 (..., 3)
+def ConvertRgbToLab(rgb):
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = (linear @ rgb_to_xyz_matrix.T) / d65_white
+
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+### @brief 色をMFMに出力される精度に丸める関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 丸めた色の配列 (uint8配列)
+### @details 3桁と4桁は上位4bitだけが出力されるので 0x11 倍の値にする。0と1はアルファ値を出力しないので255にし、
+###          2で完全に透明な色は (0, 0, 0, 0) にまとめる
+def RoundToColorType(color_array, color_type):
+    pixels = np.array(color_array, dtype=np.uint8)
+    if color_type in [1, 2]:
+        pixels = (pixels >> 4) * 0x11
+    if color_type == 2:
+        pixels[pixels[:, :, 3] == 0] = 0
+    else:
+        pixels[:, :, 3] = 255
+    return pixels
+
+### @brief 各行で見た目の差 (ΔE) が小さい色を1つの色にまとめる関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param delta_e まとめる色の差の上限 (L*a*b*のユークリッド距離)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 色をまとめた色の配列 (uint8配列)。失敗した場合はNoneを返す。
+### @details 出力される精度に丸めてから、行ごとに出現回数が多い色から順に代表色にし、
+###          代表色との差が delta_e 以下の色はその代表色に置き換える (置き換えた色と元の色の差は delta_e 以下になる)。
+###          アルファ値が違う色はまとめない。行の中だけで決めるので、帯に分けて処理しても結果は変わらない
+def MergeSimilarColors(color_array, delta_e, color_type = 0):
+    logger.info(f"Merging similar colors per row with delta E: {delta_e}")
+
+    try:
+        pixels = RoundToColorType(color_array, color_type)
+        if (delta_e <= 0) or (pixels.size == 0):
+            return pixels
+
+        # 行ごとの色を出現回数が多い順に並べる (行の色の種類より後ろは出現回数0の埋め草)
+        colors, counts, inverse, _ = UniqueRowColors(pixels)
+        order = np.argsort(-counts, axis=1, kind="stable")
+        colors = np.take_along_axis(colors, order[:, :, None], axis=1)
+        lab = ConvertRgbToLab(colors[:, :, :3])
+        alpha = colors[:, :, 3]
+
+        height, n_unique = counts.shape
+        limit = delta_e ** 2
+        representative = np.tile(np.arange(n_unique), (height, 1))
+
+        batch_rows = max(1, merge_batch_elements // max(1, n_unique * n_unique))
+        for start in range(0, height, batch_rows):
+            end = min(start + batch_rows, height)
+            batch_lab = lab[start:end]
+            batch_alpha = alpha[start:end]
+            is_representative = np.ones((end - start, n_unique), dtype=bool)
+
+            # 前にある代表色のうち、差が上限以下で最も出現回数が多い色にまとめる (全行を同時に処理)
+            for i in range(1, n_unique):
+                distance = ((batch_lab[:, :i] - batch_lab[:, i:i + 1]) ** 2).sum(axis=2)
+                near = (distance <= limit) & is_representative[:, :i] & (batch_alpha[:, :i] == batch_alpha[:, i:i + 1])
+                merged = near.any(axis=1)
+                representative[start:end, i] = np.where(merged, near.argmax(axis=1), i)
+                is_representative[:, i] = ~merged
+
+        # 各ピクセルの色の番号 → 並べ替えた後の番号 → 代表色の番号
+        rank = np.argsort(order, axis=1)
+        row_range = np.arange(height)[:, None]
+        sorted_index = rank[row_range, inverse]
+        return colors[row_range, representative[row_range, sorted_index]]
+
+    except Exception as e:
+        logger.error(f"Error merging similar colors: {e}")
+        return None
+
+#==================================================
+# ディザリング用関数
+#==================================================
+
+# Bayer行列の大きさ (2のべき乗)
+bayer_size = 8
+
+# Floyd–Steinberg法で誤差を分配する先 (行のずれ, 列のずれ, 重み)
+floyd_steinberg_weights = [(0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)]
+
+### @brief Bayer行列を作成する関数
+### @param size 行列の大きさ (2のべき乗)
+### @return 0以上1未満の閾値の配列 (size, size)
+def CreateBayerMatrix(size):
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / (size * size)
+
+### @brief 各ピクセルのBayer行列の閾値を取得する関数
+### @param height 行数
+### @param width 列数
+### @param row_offset 先頭の行の画像全体での行番号
+### @return 閾値の配列 (height, width)
+def BayerThresholds(height, width, row_offset = 0):
+    matrix = CreateBayerMatrix(bayer_size)
+    rows = (np.arange(height) + row_offset) % bayer_size
+    cols = np.arange(width) % bayer_size
+    return matrix[rows[:, None], cols[None, :]]
+
+### @brief 出力される色の段階を求める関数
+### @param division 割り算の値 (1以上の値)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return (表示される値の配列, その値になる入力値の配列) のタプル (どちらも小さい順)。失敗した場合は (None, None) を返す。
+### @details 色の割り算で量子化した後、3桁と4桁は上位4bitだけが出力されるので、表示される値はその0x11倍になる
+def CreateDitherLevels(division, color_type):
+    table = CreateQuantizeTable(division)
+    if table is None:
+        return None, None
+
+    shown = table.astype(np.int64)
+    if color_type in [1, 2]:
+        shown = (shown >> 4) * 0x11
+    values, inputs = np.unique(shown, return_index=True)
+    return values.astype(np.float64), inputs.astype(np.uint8)
+
+### @brief Floyd–Steinberg法で誤差を分配しながら量子化する関数
+### @param values 色の値の配列 (height, width, チャンネル数) のfloat64配列 (書き換えられる)
+### @param quantize (値の配列, 行番号の配列, 列番号の配列) を受け取り、(保存する色の配列, 表示される値の配列) を返す関数
+### @param channels 保存する色のチャンネル数
+### @param carry 前の帯から先頭の行に分配された誤差 (width, チャンネル数)。Noneなら誤差なし
+### @return (保存する色の配列 (height, width, channels) のuint8配列, 次の行に分配する誤差 (width, チャンネル数)) のタプル
+### @details ピクセル (y, x) は左、左上、上、右上のピクセルの誤差を受け取るので、x + 2y が同じピクセルは互いに依存しない。
+###          この斜めの並びごとに全行をまとめて処理する
+def DiffuseError(values, quantize, channels, carry = None):
+    height, width = values.shape[:2]
+    stored = np.zeros((height, width, channels), dtype=np.uint8)
+    below = np.zeros((width, values.shape[2]))
+    if carry is not None:
+        values[0] += carry
+
+    for step in range(width + 2 * (height - 1)):
+        rows = np.arange(max(0, (step - width + 2) // 2), min(height - 1, step // 2) + 1)
+        cols = step - 2 * rows
+
+        value = values[rows, cols]
+        stored[rows, cols], shown = quantize(value, rows, cols)
+        error = value - shown
+
+        # 誤差を右と下の行に分配する (画像の下の端は次の帯の先頭の行に渡す)
+        for row_shift, col_shift, weight in floyd_steinberg_weights:
+            target_rows = rows + row_shift
+            target_cols = cols + col_shift
+            inside = (target_cols >= 0) & (target_cols < width)
+            in_image = inside & (target_rows < height)
+            values[target_rows[in_image], target_cols[in_image]] += error[in_image] * weight
+            to_below = inside & (target_rows == height)
+            below[target_cols[to_below]] += error[to_below] * weight
+
+    return stored, below
+
+### @brief 色の割り算とMFMに出力される精度で量子化される前に、ディザリングを行う関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param mode ディザリングの方法（"bayer": Bayer行列による組織的ディザ, "floyd_steinberg": 誤差拡散）
+### @param division 割り算の値 (1以上の値)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @param row_offset 先頭の行の画像全体での行番号 (画像を帯に分けて処理する場合に指定)
+### @param carry 前の帯から渡された誤差 (floyd_steinberg のみ)
+### @return (ディザリングした色の配列 (uint8配列), 次の帯に渡す誤差) のタプル。失敗した場合は (None, None) を返す。
+### @details 各ピクセルを、表示される値がそのピクセルの値の上下にある段階のどちらかになる値に置き換えるので、
+###          後の色の割り算と出力の精度への丸めで、表示される値の平均が元の色に近くなる。透明なピクセルとアルファ値はそのまま
+def DitherColor(color_array, mode, division, color_type, row_offset = 0, carry = None):
+    logger.info(f"Dithering colors: {mode}")
+
+    if mode not in ["bayer", "floyd_steinberg"]:
+        logger.error(f"Invalid dither mode: {mode}")
+        return None, None
+
+    levels, level_inputs = CreateDitherLevels(division, color_type)
+    if levels is None:
+        return None, None
+
+    try:
+        pixels = np.array(color_array, dtype=np.uint8)
+        opaque = pixels[:, :, 3] != 0
+        rgb = pixels[:, :, :3].astype(np.float64)
+        height, width = pixels.shape[:2]
+        if (len(levels) < 2) or (pixels.size == 0):
+            return pixels, carry
+
+        if mode == "bayer":
+            # 上下の段階の間のどの位置にあるかを閾値と比べ、超えていれば上の段階にする
+            lower = np.clip(np.searchsorted(levels, rgb, side="right") - 1, 0, len(levels) - 2)
+            fraction = (rgb - levels[lower]) / (levels[lower + 1] - levels[lower])
+            chosen = lower + (fraction > BayerThresholds(height, width, row_offset)[:, :, None])
+            np.copyto(pixels[:, :, :3], level_inputs[chosen], where=opaque[:, :, None])
+            return pixels, carry
+
+        ### @brief 最も近い段階に量子化する関数 (透明なピクセルは誤差を出さない)
+        def QuantizeToLevels(value, rows, cols):
+            upper = np.clip(np.searchsorted(levels, value), 1, len(levels) - 1)
+            chosen = upper - ((value - levels[upper - 1]) <= (levels[upper] - value))
+            keep = ~opaque[rows, cols]
+            stored = level_inputs[chosen]
+            stored[keep] = pixels[rows[keep], cols[keep], :3]
+            shown = levels[chosen]
+            shown[keep] = value[keep]
+            return stored, shown
+
+        stored, carry = DiffuseError(rgb, QuantizeToLevels, 3, carry)
+        pixels[:, :, :3] = stored
+        return pixels, carry
+
+    except Exception as e:
+        logger.error(f"Error dithering colors: {e}")
+        return None, None
+
+### @brief 減色後の各行の色だけを使って、減色前の色をディザリングし直す関数
+### @param color_array 減色前の色の配列 (R, G, B, A)
+### @param reduce_color_array 減色後の色の配列 (各行の色がその行で使える色になる)
+### @param mode ディザリングの方法（"bayer" または "floyd_steinberg"）
+### @param row_offset 先頭の行の画像全体での行番号 (画像を帯に分けて処理する場合に指定)
+### @param carry 前の帯から渡された誤差 (floyd_steinberg のみ)
+### @return (ディザリングした色の配列 (uint8配列), 次の帯に渡す誤差) のタプル。失敗した場合は (None, None) を返す。
+### @details 行ごとの色は減色するまで決まらないので、減色後の行の色を各行のパレットとして、各ピクセルをその中から選び直す。
+###          bayer は行の色どうしの間隔に合わせた閾値を足してから最も近い色を選ぶ。減色後に透明なピクセルはそのまま
+def DitherRowPalettes(color_array, reduce_color_array, mode, row_offset = 0, carry = None):
+    logger.info(f"Dithering colors with row palettes: {mode}")
+
+    if mode not in ["bayer", "floyd_steinberg"]:
+        logger.error(f"Invalid dither mode: {mode}")
+        return None, None
+
+    try:
+        pixels = np.asarray(color_array, dtype=np.uint8)
+        reduced = np.array(reduce_color_array, dtype=np.uint8)
+        height, width = pixels.shape[:2]
+        if pixels.size == 0:
+            return reduced, carry
+
+        # 各行で使われている色 (色の種類が少ない行の残りは選ばれないように距離を無限大にする)
+        palettes, _, _, n_unique = UniqueRowColors(reduced)
+        palettes = palettes.astype(np.float64)
+        unused = np.arange(palettes.shape[1])[None, :] >= n_unique[:, None]
+        keep = reduced[:, :, 3] == 0
+        alpha = pixels[:, :, 3].astype(np.float64)
+
+        ### @brief 各ピクセルの行の色の中から最も近い色を選ぶ関数
+        def NearestRowColor(value, rows, cols):
+            candidates = palettes[rows]
+            distance = ((candidates[:, :, :3] - value[:, None, :]) ** 2).sum(axis=2)
+            distance += (candidates[:, :, 3] - alpha[rows, cols][:, None]) ** 2
+            distance[unused[rows]] = np.inf
+            chosen = candidates[np.arange(len(rows)), np.argmin(distance, axis=1)]
+            stored = chosen.astype(np.uint8)
+            stored[keep[rows, cols]] = reduced[rows, cols][keep[rows, cols]]
+            shown = chosen[:, :3]
+            shown[keep[rows, cols]] = value[keep[rows, cols]]
+            return stored, shown
+
+        rgb = pixels[:, :, :3].astype(np.float64)
+        if mode == "bayer":
+            # 行の色ごとに最も近い別の色までの距離の平均を、その行の閾値の幅にする
+            spacing = np.sqrt(((palettes[:, :, None, :3] - palettes[:, None, :, :3]) ** 2).sum(axis=3))
+            spacing[unused[:, :, None] | unused[:, None, :]] = np.inf
+            spacing[:, np.arange(palettes.shape[1]), np.arange(palettes.shape[1])] = np.inf
+            nearest = spacing.min(axis=2)
+            nearest[~np.isfinite(nearest)] = 0
+            spread = nearest.sum(axis=1) / np.maximum(n_unique, 1)
+
+            offsets = (BayerThresholds(height, width, row_offset) - 0.5) * spread[:, None]
+            values = (rgb + offsets[:, :, None]).reshape((-1, 3))
+            rows, cols = np.indices((height, width)).reshape((2, -1))
+
+            # 計算用の配列が大きくなりすぎないようにピクセルを分けて選ぶ
+            stored = np.empty((height * width, 4), dtype=np.uint8)
+            batch = max(1, nearest_color_batch // max(1, palettes.shape[1]))
+            for start in range(0, height * width, batch):
+                stored[start:start + batch], _ = NearestRowColor(values[start:start + batch], rows[start:start + batch], cols[start:start + batch])
+            return stored.reshape((height, width, 4)), carry
+
+        return DiffuseError(rgb, NearestRowColor, 4, carry)
+
+    except Exception as e:
+        logger.error(f"Error dithering colors with row palettes: {e}")
+        return None, None
\ No newline at end of file
@@ -1,33 +1,6 @@
-import copy
-
-#=================================================
-# MFM出力用の変数定義
-#=================================================
-
-# メモ：本当はこんなグローバル変数でやるのよくないけど、他のやり方わからないので一旦このまま
-
-# 使用できる色の最大数
-max_use_colors = 19
-
-# 背景の色
-default_background = (0, 0, 0, 0)
-
-# 使用中の色の配列
-use_colors = []
-# 現在使用している色のインデックス
-use_color_index = -1
-# 前回使用していた色のインデックス
-pre_use_color_index = -1
-
-# 使用するMFM
-use_mfm = "bg"
-
-# mfm出力用の行ごとの配列
-mfm_lines = []
-# 行ごとの1マス目の色
-mfm_lines_first_color = []
-# 行ごとの最後に使用していたインデックス
-mfm_lines_last_index = []
+import logging
+import numpy as np
+from Instrumentation import *
 
 #=================================================
 # MFM出力用の関数定義
@@ -73,273 +46,685 @@ def ConvertColorToString(color, color_type):
         a = a[0]
         return f"{r}{g}{b}{a}"
     else:
-        print(f"Invalid color type: {color_type}")
+        logger.error(f"Invalid color type: {color_type}")
         return None
 
-### @brief 現在使用中の色をリセットする関数
-def ResetCurrentColors():
-    global use_colors, use_color_index, pre_use_color_index
-    # 使用中の色をリセット
-    use_colors.clear()
-    use_color_index = -1
-    pre_use_color_index = -1
-
-### @brief 現在使用中の色を指定のインデックスまで閉じる関数
-### @param mfm_line 現在のMFM行文字列
-### @param close_index どこまでのインデックスを閉じるか
-### @return 色を閉じた後のMFM行文字列
-def CloseCurrentColors(mfm_line, close_index):
-    global use_colors, use_color_index, mfm_lines, mfm_lines_last_index
-    
-    if not mfm_line:
-        # 現在の行が空の場合は何もしない
-        return mfm_line
+# 色の形式ごとの色コード文字列のテーブル (最初に使うときに作成する)
+color_string_tables = {}
 
-    # 使用中の色がある場合
-    if use_colors:
-        # 使用中の色の数分 "]" を追加してMFMを閉じる
-        mfm_line += "]" * ((len(use_colors) - 1) - close_index)
-        # 使用中の色を閉じた分だけ削除
-        del use_colors[(close_index + 1):]
-    
-    return mfm_line
+### @brief 色の配列を色の形式に合わせた整数の色コードにまとめる関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 色コードの配列 (height, width)。色の形式が無効な場合はNoneを返す。
+### @details 0: 0xRRGGBB, 1: 0xRGB, 2: 0xRGBA (各成分の上位4bit)
+def ConvertColorArrayToCodes(color_array, color_type):
+    pixels = np.asarray(color_array, dtype=np.uint8)
+    pixels = pixels.reshape(pixels.shape[:-1] + (4,)).astype(np.uint32)
+    r = pixels[..., 0]
+    g = pixels[..., 1]
+    b = pixels[..., 2]
+    a = pixels[..., 3]
 
-### @brief 1行前の色を閉じる関数
-### @param close_index どこまでのインデックスを閉じるか
-def ClosePreviousColors(close_index):
-    global use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-    
-    # 1行前の色がない場合は何もしない
-    if not mfm_lines or (mfm_lines_last_index[-1] == -1):
-        return
-    # 1行前の色を閉じる
-    mfm_lines[-1] += "]" * (mfm_lines_last_index[-1] - close_index)
-
-### @brief 1行前の色を指定のインデックスまで現在の行に追加する関数
-### @param mfm_line 現在のMFM行文字列
-### @param add_index どこまでのインデックスを追加するか
-### @return 色を追加した後のMFM行文字列
-def AddPreviousColors(mfm_line, add_index):
-    global use_colors, mfm_lines, mfm_lines_last_index
-    
-    # まだ1行前の色がない場合は何もしない
-    if (not mfm_lines) or (mfm_lines_last_index[-1] == -1):
-        return mfm_line
+    if color_type == 0:
+        return (r << 16) | (g << 8) | b
+    elif color_type == 1:
+        return ((r >> 4) << 8) | ((g >> 4) << 4) | (b >> 4)
+    elif color_type == 2:
+        return ((r >> 4) << 12) | ((g >> 4) << 8) | ((b >> 4) << 4) | (a >> 4)
 
-    # 1行前の行の色を閉じる
-    ClosePreviousColors(add_index)
-    # 現在の行が空でない場合、閉じた分の色を追加
-    if mfm_line:
-        for i in range(add_index + 1, mfm_lines_last_index[-1] + 1):
-            mfm_line = f"$[{use_mfm}.color={use_colors[i]} " + mfm_line
-    # 1行前の色のインデックスを設定
-    mfm_lines_last_index[-1] = add_index
-
-    return mfm_line
-
-### @brief 新しい色を追加する関数
-### @param mfm_line 現在のMFM行文字列
-### @oaram new_color 新しい色の文字列
-### @return 色を追加した後のMFM行文字列
-def AddNewColor(new_color):
-    global use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-    # 新しい色を追加
-    use_color_index += 1
-    use_colors.append(new_color)
-
-### @brief 使用している色の数が上限を超えた場合に今までの色を閉じる関数
-### @param mfm_line 現在のMFM行文字列
-### @return 色を閉じた後のMFM行文字列
-def CloseColorsIfNeeded(mfm_line):
-    global max_use_colors, use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-
-    # 上限を超えていない場合は何もしない
-    if len(use_colors) <= max_use_colors:
-        return mfm_line
+    logger.error(f"Invalid color type: {color_type}")
+    return None
 
-    if mfm_lines and (mfm_lines_last_index[-1] >= 0):
-        #==================================================
-        # 1行前の色が残ってる状態で上限を超えた場合
-        #==================================================
-        
-        # 1行前の色を閉じる
-        mfm_line = AddPreviousColors(mfm_line, -1)
-        # 行を再生成してほしいので使用中の色などをリセット
-        ResetCurrentColors()
-        mfm_line = None
+### @brief 色コードのアルファ値を取得する関数
+### @param code 色コード
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return アルファ値 (0 ～ 15)。4桁RGBA形式以外は常に15(不透明)
+def ColorCodeAlpha(code, color_type):
+    return (code & 0xf) if color_type == 2 else 0xf
+
+### @brief 色コードを色コード文字列に変換する関数
+### @param code 色コード
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 色コード文字列。4桁RGBA形式でアルファ値がf(不透明)ならアルファ値の部分を削る
+def ColorCodeToString(code, color_type):
+    if color_type == 0:
+        return format(code, "06x")
+    elif color_type == 1:
+        return format(code, "03x")
+    elif (code & 0xf) == 0xf:
+        return format(code >> 4, "03x")
+    return format(code, "04x")
+
+### @brief 色コード文字列のテーブルを取得する関数
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 色コードを添字にした色コード文字列のリスト。6桁RGB形式は大きすぎるので作成せずNoneを返す
+def GetColorStringTable(color_type):
+    if color_type == 0:
+        return None
+
+    if color_type not in color_string_tables:
+        size = 1 << 12 if color_type == 1 else 1 << 16
+        color_string_tables[color_type] = [ColorCodeToString(code, color_type) for code in range(size)]
+
+    return color_string_tables[color_type]
+
+#=================================================
+# MFM生成用のクラス定義
+#=================================================
+
+### @brief MFMを生成するクラス
+### @details 生成中の状態をすべてインスタンスに持つので、複数の画像を並行して生成できる
+###          生成中の行は文字列の部品のリストとして持ち、行の最後に1回だけ結合する
+###          色は整数の色コードで扱い、文字列には出力するときだけ変換する
+class MFMEncoder:
+    __slots__ = (
+        "max_use_colors",           # 使用できる色の最大数
+        "default_background",       # 背景の色
+        "color_type",               # 色の形式
+        "color_strings",            # 色コードから色コード文字列へのテーブル
+        "use_colors",               # 使用中の色コードの配列
+        "use_color_positions",      # 使用中の色コードから配列の位置への辞書
+        "use_color_index",          # 現在使用している色のインデックス
+        "pre_use_color_index",      # 前回使用していた色のインデックス
+        "use_mfm",                  # 使用するMFM
+        "line_head",                # 生成中の行の先頭に追加する部品 (追加した順。結合時に逆順にする)
+        "line_body",                # 生成中の行の部品
+        "mfm_lines",                # mfm出力用の行ごとの配列
+        "mfm_lines_close_count",    # 行ごとに後から末尾に追加する "]" の数
+        "mfm_lines_first_color",    # 行ごとの1マス目の色
+        "mfm_lines_last_index",     # 行ごとの最後に使用していたインデックス
+        "encoder_mode",             # 生成方法（"greedy": 従来の方法, "planner": 文字数が最小になるよう探索）
+        "planner_beam",             # 探索で残す状態の数
+        "planned_stack",            # 探索で生成した行の最後に開いている色コードのタプル
+        "overflow_count",           # 重ねがけの上限を超えた回数
+        "carried_overflow_count",   # そのうち1行前の色が開いたままだった回数
+        "regenerate_count",         # 1行前の色を閉じて行を作り直した回数
+        "line_count",               # 生成した行数
+        "tags_opened",              # 出力した開始タグの数
+        "tags_closed",              # 出力した "]" の数
+        "max_depth",                # 同時に開いていた色の最大数
+    )
+
+    ### @brief コンストラクタ
+    ### @param max_overlap_bg_color 重ねがけできるbg.colorの上限
+    ### @param background_color 背景色 (R, G, B, A)
+    ### @param use_mfm_char MFMの使用形式（"bg" または "fg"）
+    ### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+    ### @param encoder_mode 生成方法（"greedy": 従来の方法, "planner": 文字数が最小になるよう探索）
+    ### @param planner_beam 探索で残す状態の数 (大きいほど文字数が減るが遅くなる)
+    def __init__(self, max_overlap_bg_color = 19, background_color = (0, 0, 0, 0), use_mfm_char = "bg", color_type = 0, encoder_mode = "greedy", planner_beam = 16):
+        self.max_use_colors = max_overlap_bg_color if max_overlap_bg_color > 0 else 19
+        self.default_background = background_color if background_color else (0, 0, 0, 0)
+        self.use_mfm = use_mfm_char if use_mfm_char else "bg"
+        self.color_type = color_type
+        self.color_strings = GetColorStringTable(color_type)
+        if self.color_strings is None:
+            self.color_strings = {}
+        self.use_colors = []
+        self.use_color_positions = {}
+        self.use_color_index = -1
+        self.pre_use_color_index = -1
+        self.line_head = []
+        self.line_body = []
+        self.mfm_lines = []
+        self.mfm_lines_close_count = []
+        self.mfm_lines_first_color = []
+        self.mfm_lines_last_index = []
+        self.encoder_mode = encoder_mode
+        self.planner_beam = max(1, planner_beam)
+        self.planned_stack = ()
+        self.overflow_count = 0
+        self.carried_overflow_count = 0
+        self.regenerate_count = 0
+        self.line_count = 0
+        self.tags_opened = 0
+        self.tags_closed = 0
+        self.max_depth = 0
+
+    ### @brief 生成中の行が空かを判定する関数
+    ### @return 空ならTrue
+    def IsLineEmpty(self):
+        # 空文字列の部品は追加しないので、部品の有無だけで判定できる
+        return (not self.line_head) and (not self.line_body)
+
+    ### @brief 色の開始タグの文字列を作る関数
+    ### @param color 色コード
+    ### @return 開始タグの文字列
+    def ColorTag(self, color):
+        color_strings = self.color_strings
+        if isinstance(color_strings, dict) and (color not in color_strings):
+            color_strings[color] = ColorCodeToString(color, self.color_type)
+        return f"$[{self.use_mfm}.color={color_strings[color]} "
+
+    ### @brief 使用中の色を追加する関数
+    ### @param color 色コード
+    def AppendUseColor(self, color):
+        self.use_color_positions.setdefault(color, len(self.use_colors))
+        self.use_colors.append(color)
+
+    ### @brief 使用中の色を指定の数まで減らす関数
+    ### @param length 残す色の数
+    def TruncateUseColors(self, length):
+        positions = self.use_color_positions
+        for color in self.use_colors[length:]:
+            if positions.get(color, -1) >= length:
+                del positions[color]
+        del self.use_colors[length:]
+
+    ### @brief 現在使用中の色をリセットする関数
+    def ResetCurrentColors(self):
+        # 使用中の色をリセット
+        self.use_colors.clear()
+        self.use_color_positions.clear()
+        self.use_color_index = -1
+        self.pre_use_color_index = -1
+
+    ### @brief 現在使用中の色を指定のインデックスまで閉じる関数
+    ### @param close_index どこまでのインデックスを閉じるか
+    def CloseCurrentColors(self, close_index):
+        if self.IsLineEmpty():
+            # 現在の行が空の場合は何もしない
+            return
+
+        # 使用中の色がある場合
+        if self.use_colors:
+            # 使用中の色の数分 "]" を追加してMFMを閉じる
+            close_count = (len(self.use_colors) - 1) - close_index
+            if close_count > 0:
+                self.line_body.append("]" * close_count)
+            # 使用中の色を閉じた分だけ削除
+            self.TruncateUseColors(close_index + 1)
+
+    ### @brief 1行前の色を閉じる関数
+    ### @param close_index どこまでのインデックスを閉じるか
+    def ClosePreviousColors(self, close_index):
+        # 1行前の色がない場合は何もしない
+        if not self.mfm_lines or (self.mfm_lines_last_index[-1] == -1):
+            return
+        # 1行前の色を閉じる (結合時に行末へ追加する)
+        self.mfm_lines_close_count[-1] += self.mfm_lines_last_index[-1] - close_index
+
+    ### @brief 1行前の色を指定のインデックスまで現在の行に追加する関数
+    ### @param add_index どこまでのインデックスを追加するか
+    def AddPreviousColors(self, add_index):
+        # まだ1行前の色がない場合は何もしない
+        if (not self.mfm_lines) or (self.mfm_lines_last_index[-1] == -1):
+            return
+
+        # 1行前の行の色を閉じる
+        self.ClosePreviousColors(add_index)
+        # 現在の行が空でない場合、閉じた分の色を先頭に追加
+        if not self.IsLineEmpty():
+            for i in range(add_index + 1, self.mfm_lines_last_index[-1] + 1):
+                self.line_head.append(self.ColorTag(self.use_colors[i]))
+        else:
+            # 現在の行が空の場合、閉じた色はもう使用中ではない
+            self.TruncateUseColors(add_index + 1)
+        # 1行前の色のインデックスを設定
+        self.mfm_lines_last_index[-1] = add_index
+
+    ### @brief 新しい色を追加する関数
+    ### @oaram new_color 新しい色コード
+    def AddNewColor(self, new_color):
+        # 新しい色を追加
+        self.use_color_index += 1
+        self.AppendUseColor(new_color)
+
+    ### @brief 使用している色の数が上限を超えた場合に今までの色を閉じる関数
+    ### @return 行の作り直しが必要な場合はTrue
+    def CloseColorsIfNeeded(self):
+        # 上限を超えていない場合は何もしない
+        depth = len(self.use_colors)
+        if depth <= self.max_use_colors:
+            if depth > self.max_depth:
+                self.max_depth = depth
+            return False
+
+        self.overflow_count += 1
+
+        if self.mfm_lines and (self.mfm_lines_last_index[-1] >= 0):
+            #==================================================
+            # 1行前の色が残ってる状態で上限を超えた場合
+            #==================================================
+
+            self.carried_overflow_count += 1
+            # 1行前の色を1行前の行末で閉じる (途中まで閉じていた分と合わせて全部閉じる)
+            self.ClosePreviousColors(-1)
+            self.mfm_lines_last_index[-1] = -1
+            # 出力済みの部分は1行前の色の上にあるので、開き直さずに空の状態から行を作り直す
+            self.ResetCurrentColors()
+            return True
 
-    else:
         #==================================================
         # 現在の行で上限を超えた場合
         #==================================================
 
         # 超えた分の色を取得
-        over_color = use_colors[max_use_colors]
+        over_color = self.use_colors[self.max_use_colors]
         # 超えた分を削除
-        del use_colors[max_use_colors:]
+        self.TruncateUseColors(self.max_use_colors)
         # 現時点で使用中の色を閉じる
-        mfm_line = CloseCurrentColors(mfm_line, -1)
+        self.CloseCurrentColors(-1)
         # 超えた分の色を追加
-        use_colors.append(over_color)
-        use_color_index = 0
-    
-    return mfm_line
-
-### @brief 指定の色が使用中の色に含まれる場合の処理関数
-### @param mfm_line 現在のMFM行文字列
-### @param color 色の文字列
-### @return MFM行文字列
-def ColorInUseColors(mfm_line, color):
-    global use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-
-    # インデックスを取得
-    use_color_index = use_colors.index(color)
-    # 取得したインデックスが1行前のインデックス以下の場合
-    if (mfm_lines) and (use_color_index < mfm_lines_last_index[-1]):
-        # 1行前まで使用していた色を閉じて現在の行に追加
-        mfm_line = AddPreviousColors(mfm_line, use_color_index)
-        # 現在の行も同様に色を閉じる
-        mfm_line = CloseCurrentColors(mfm_line, use_color_index)
-
-    # インデックスが前回のインデックスより小さい場合
-    if use_color_index < pre_use_color_index:
-        # 現在のインデックスまでMFMを閉じる
-        mfm_line = CloseCurrentColors(mfm_line, use_color_index)
-
-    return mfm_line
-
-### @brief 指定の色が使用中の色に含まれない場合の処理関数
-### @param mfm_line 現在のMFM行文字列
-### @param color 色の文字列
-### @param alpha アルファ値
-### @return MFM行文字列
-def ColorNotInUseColors(mfm_line, color, alpha):
-    global use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-
-    # もし不透明でない色の場合
-    if alpha != "f":
-        # 1行前の色を閉じて現在の行に追加
-        if mfm_lines:
-            mfm_line = AddPreviousColors(mfm_line, -1)
-        # 現在使用中の色を閉じる
-        mfm_line = CloseCurrentColors(mfm_line, -1)
-        use_color_index = -1
-
-    # 透明の色でなければMFMを追加
-    if alpha != "0":
-        AddNewColor(color)
-        # 使用できる色の数を超えた場合の処理
-        mfm_line = CloseColorsIfNeeded(mfm_line)
-        # mfm_lineがNoneになった場合は再生成なのでreturnする
-        if mfm_line is None:
-            return None
-        # 現在の行に新しい色を追加
-        mfm_line += f"$[{use_mfm}.color={color} "
+        self.AppendUseColor(over_color)
+        self.use_color_index = 0
+        return False
+
+    ### @brief 指定の色が使用中の色に含まれる場合の処理関数
+    ### @param color 色コード
+    def ColorInUseColors(self, color):
+        # インデックスを取得
+        self.use_color_index = self.use_color_positions[color]
+        # 取得したインデックスが1行前のインデックス以下の場合
+        if (self.mfm_lines) and (self.use_color_index < self.mfm_lines_last_index[-1]):
+            # 1行前まで使用していた色を閉じて現在の行に追加
+            self.AddPreviousColors(self.use_color_index)
+            # 現在の行も同様に色を閉じる
+            self.CloseCurrentColors(self.use_color_index)
+
+        # インデックスが前回のインデックスより小さい場合
+        if self.use_color_index < self.pre_use_color_index:
+            # 現在のインデックスまでMFMを閉じる
+            self.CloseCurrentColors(self.use_color_index)
+
+    ### @brief 指定の色が使用中の色に含まれない場合の処理関数
+    ### @param color 色コード
+    ### @param alpha アルファ値 (0 ～ 15)
+    ### @return 行の作り直しが必要な場合はTrue
+    def ColorNotInUseColors(self, color, alpha):
+        # もし不透明でない色の場合
+        if alpha != 0xf:
+            # 1行前の色を閉じて現在の行に追加
+            if self.mfm_lines:
+                self.AddPreviousColors(-1)
+            # 現在使用中の色を閉じる
+            self.CloseCurrentColors(-1)
+            self.use_color_index = -1
+
+        # 透明の色でなければMFMを追加
+        if alpha != 0:
+            self.AddNewColor(color)
+            # 使用できる色の数を超えた場合の処理。作り直しが必要な場合はreturnする
+            if self.CloseColorsIfNeeded():
+                return True
+            # 現在の行に新しい色を追加
+            self.line_body.append(self.ColorTag(color))
+
+        return False
+
+    ### @brief 背景色を追加する関数
+    ### @return 行の作り直しが必要な場合はTrue
+    def AddBackgroundColor(self):
+        default_background = self.default_background
+        # 背景色が無効な場合は何もしない
+        if (default_background[0] < 0) or (default_background[1] < 0) or (default_background[2] < 0) or (default_background[3] <= 0):
+            return False
+
+        # 重ねがけの上限が1の場合は背景色の上に色を重ねられず、開いてもすぐに閉じることになるので追加しない
+        if self.max_use_colors <= 1:
+            return False
+
+        # 背景色を色コードに変換
+        bg_color = int(ConvertColorArrayToCodes(default_background, self.color_type))
+
+        # 背景色が使用中の色にある場合は何もしない
+        if bg_color in self.use_color_positions:
+            return False
+
+        # 1行前の色が開いたままの場合、その下に背景色を入れることはできないので1行前の行末で閉じる
+        if self.mfm_lines and (self.mfm_lines_last_index[-1] >= 0):
+            self.AddPreviousColors(-1)
+            self.ResetCurrentColors()
+
+        # 使用中の色が上限を超える場合
+        if len(self.use_colors) >= self.max_use_colors:
+            # 現在使用中の色を閉じて新しく追加
+            self.AddNewColor(bg_color)
+            if self.CloseColorsIfNeeded():
+                return True
+            self.line_body.append(self.ColorTag(bg_color))
 
-    return mfm_line
+        else:
+            # 上限を超えない場合は先頭に色を追加
+            self.use_colors = [bg_color] + self.use_colors
+            self.use_color_positions = {}
+            for i, color in enumerate(self.use_colors):
+                self.use_color_positions.setdefault(color, i)
+            self.use_color_index += 1
+            self.line_head.append(self.ColorTag(bg_color))
+            self.max_depth = max(self.max_depth, len(self.use_colors))
+
+        return False
+
+    ### @brief 1行分の色のタグとスペースを生成中の行に追加する関数
+    ### @param color_code_line 色コードの配列（1行分）
+    ### @param space_char 空白として使用する文字
+    ### @return 1行前の色を閉じて行の作り直しが必要になった場合はTrue
+    def EncodeMFMLine(self, color_code_line, space_char):
+        self.line_head = []
+        self.line_body = []
+        line_body = self.line_body
+        color_type = self.color_type
+
+        # 背景色を追加
+        if self.AddBackgroundColor():
+            return True
+
+        # 背景色の追加で辞書が作り直されている場合があるので取り直す
+        use_color_positions = self.use_color_positions
+
+        for code in color_code_line:
+            # 前まで使用していたインデックスを保存
+            self.pre_use_color_index = self.use_color_index
+
+            if code not in use_color_positions:
+                #==================================================
+                # 使用中の色にない場合の処理
+                #==================================================
+
+                if self.ColorNotInUseColors(code, ColorCodeAlpha(code, color_type)):
+                    return True
+
+            else:
+                #==================================================
+                # 使用中の色にある場合の処理
+                #==================================================
+
+                self.ColorInUseColors(code)
+
+            # スペースの追加
+            if space_char:
+                line_body.append(space_char)
+
+        return False
+
+    ### @brief 1行分のMFMを生成する関数
+    ### @param color_code_line 色コードの配列（1行分）
+    ### @param space_char 空白として使用する文字
+    ### @details 作り直しについては GenerateMFMLineText を参照
+    def GenerateMFMLine(self, color_code_line, space_char):
+        mfm_line = self.GenerateMFMLineText(color_code_line, space_char)
+        self.mfm_lines.append(mfm_line)
+        self.mfm_lines_close_count.append(0)
+        self.mfm_lines_last_index.append(self.use_color_index)
+
+    ### @brief 1行分のMFMの文字列を従来の方法で生成する関数 (行の配列には追加しない)
+    ### @param color_code_line 色コードの配列（1行分）
+    ### @param space_char 空白として使用する文字
+    ### @return 1行分のMFMの文字列
+    ### @details ほとんどの行は1回だけ生成するが、1行前の色が開いたまま上限を超えた場合だけ、1行前の色を1行前の行末で閉じて
+    ###          空の状態から1回だけ作り直す (作り直しは最大1回)。
+    ###          1行前の色を使い回すかは、その行で実際に閉じた色や使い回した色によって決まり、行の色の種類の数を先に数えても
+    ###          上限を超えるかは分からない。先に閉じると上限を超えない行まで1行前の色を使い回せなくなり、従来より出力が長くなるので、
+    ###          実際に上限を超えたときだけ作り直す。作り直すときは1行前の色がもう開いていないので、2回目は作り直しにならない
+    def GenerateMFMLineText(self, color_code_line, space_char):
+        # 1行前の色が開いたまま上限を超えた場合だけ、もう1回だけ生成する
+        if self.EncodeMFMLine(color_code_line, space_char):
+            self.regenerate_count += 1
+            self.EncodeMFMLine(color_code_line, space_char)
+        line_body = self.line_body
+
+        # 仮の動作で行ごとに色を閉じる
+        if self.default_background[3] > 0:
+            self.CloseCurrentColors(0)
+            # 透明のマスで全て閉じている場合は開いている色はない
+            self.use_color_index = 0 if self.use_colors else -1
+        else:
+            self.CloseCurrentColors(-1)
+            self.use_color_index = -1
 
-### @brief 背景色を追加する関数
-### @param mfm_line 現在のMFM行文字列
-### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
-### @return MFM行文字列
-def AddBackgroundColor(mfm_line, color_type):
-    global default_background, use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-    # 背景色が無効な場合は何もしない
-    if (default_background[0] < 0) or (default_background[1] < 0) or (default_background[2] < 0) or (default_background[3] <= 0):
-        return mfm_line
+        # 行の部品を1回だけ結合する (先頭の部品は追加した順と逆に並べる)
+        self.line_head.reverse()
+        mfm_line = "".join(self.line_head) + "".join(line_body)
 
-    # 背景色を文字列に変換
-    bg_color = ConvertColorToString(default_background, color_type)
-    # 4桁RGBA形式の場合、アルファ値がf(不透明)ならアルファ値の部分を削る
-    if (color_type == 2) and (bg_color[3] == "f"):
-        bg_color = bg_color[:3]
+        # 使用中の色が無い場合、右端にあるスペースを削除
+        if not self.use_colors:
+            mfm_line = mfm_line.rstrip(space_char)
 
-    # 背景色が使用中の色にある場合は何もしない
-    if bg_color in use_colors:
         return mfm_line
 
-    # 使用中の色が上限を超える場合
-    if len(use_colors) >= max_use_colors:
-        # 現在使用中の色を閉じて新しく追加
-        AddNewColor(bg_color)
-        mfm_line = CloseColorsIfNeeded(mfm_line)
-        # mfm_lineがNoneになった場合は再生成なのでreturnする
-        if mfm_line is None:
-            return None
-        mfm_line += f"$[{use_mfm}.color={bg_color} "
+    ### @brief 行全体を見て出力文字数が最小になるようにタグを開閉し、1行分のMFMを生成する関数
+    ### @param color_code_line 色コードの配列（1行分）
+    ### @param space_char 空白として使用する文字
+    ### @details 開いている色の並びを状態としたビームサーチを行う。
+    ###          前の行から開いたままの色も引き継ぎ、重ねがけの上限を超えないように開閉の順番を決める。
+    ###          背景色は従来の方法と同じように行の先頭で一番下に開くこともできる。
+    ###          文字数は開始タグとそれを閉じる "]" を合わせて、開いた時点で数える。
+    ###          ビームの幅が足りずに従来の方法より長くなった行は、同じ状態から従来の方法で生成した行を使う
+    def GenerateMFMLinePlanned(self, color_code_line, space_char):
+        color_type = self.color_type
+        max_depth = self.max_use_colors
+
+        # 同じ色が続く部分をまとめる
+        runs = []
+        for code in color_code_line:
+            if runs and (runs[-1][0] == code):
+                runs[-1][1] += 1
+            else:
+                runs.append([code, 1])
+
+        # 開いている色のタプル → (文字数, 経路)。経路は (前の経路, 閉じる数, 開く色, マス数)
+        states = {self.planned_stack: (0, None)}
+        tag_costs = {}
+
+        # 背景色が有効な場合は、開いている色を閉じて行の先頭で背景色を一番下に開く状態も候補にする
+        default_background = self.default_background
+        if (min(default_background[:3]) >= 0) and (default_background[3] > 0) and (max_depth > 1):
+            bg_color = int(ConvertColorArrayToCodes(default_background, color_type))
+            if bg_color not in self.planned_stack:
+                tag_costs[bg_color] = len(self.ColorTag(bg_color)) + 1
+                states[(bg_color,)] = (tag_costs[bg_color], (None, len(self.planned_stack), bg_color, 0))
+
+        for code, count in runs:
+            alpha = ColorCodeAlpha(code, color_type)
+            if code not in tag_costs:
+                tag_costs[code] = len(self.ColorTag(code)) + 1
+            push_cost = tag_costs[code]
+
+            next_states = {}
+            for stack, (cost, path) in states.items():
+                depth = len(stack)
+                # 遷移の候補 (新しい状態, 閉じる数, 開く色, 増える文字数)
+                if alpha == 0:
+                    # 透明な色はすべての色を閉じる
+                    candidates = [((), depth, None, 0)]
+                elif alpha != 0xf:
+                    # 不透明でない色は下の色と重ならないように一番下で開く
+                    # 一番下に開いている場合は、上に重ねた不透明な色を閉じて使い回す
+                    if (depth > 0) and (stack[0] == code):
+                        candidates = [(stack[:1], depth - 1, None, 0)]
+                    else:
+                        candidates = [((code,), depth, code, push_cost)]
+                else:
+                    candidates = []
+                    # 開いている色まで閉じて使い回す
+                    for p in range(depth):
+                        if stack[p] == code:
+                            candidates.append((stack[:p + 1], depth - p - 1, None, 0))
+                    # いくつか閉じてから新しく開く (重ねがけの上限まで)
+                    for j in range(min(depth, max_depth - 1) + 1):
+                        candidates.append((stack[:j] + (code,), depth - j, code, push_cost))
+
+                for new_stack, pops, push, added_cost in candidates:
+                    new_cost = cost + added_cost
+                    if (new_stack not in next_states) or (new_cost < next_states[new_stack][0]):
+                        next_states[new_stack] = (new_cost, (path, pops, push, count))
+
+            # 文字数の少ない状態だけを残す (同じ文字数なら、後の行で使い回せる色が多い深い状態を優先する)
+            if len(next_states) > self.planner_beam:
+                next_states = dict(sorted(next_states.items(), key=lambda item: (item[1][0], -len(item[0])))[:self.planner_beam])
+            states = next_states
+
+        # 最も文字数の少ない状態から経路をたどる
+        best_stack = min(states, key=lambda stack: (states[stack][0], -len(stack)))
+        path = states[best_stack][1]
+        steps = []
+        while path is not None:
+            path, pops, push, count = path
+            steps.append((pops, push, count))
+        steps.reverse()
+
+        # 右端の透明な部分はスペースを出力しない
+        visible_runs = len(runs)
+        while (visible_runs > 0) and (ColorCodeAlpha(runs[visible_runs - 1][0], color_type) == 0):
+            visible_runs -= 1
+
+        line_body = []
+        depth = len(self.planned_stack)
+        planned_max_depth = depth
+        run_index = 0
+        for pops, push, count in steps:
+            if pops > 0:
+                line_body.append("]" * pops)
+                depth -= pops
+            if push is not None:
+                line_body.append(self.ColorTag(push))
+                depth += 1
+                planned_max_depth = max(planned_max_depth, depth)
+            # 行の先頭で背景色を開くだけの段階はマスを持たない
+            if count > 0:
+                if (run_index < visible_runs) and space_char:
+                    line_body.append(space_char * count)
+                run_index += 1
+        planned_line = "".join(line_body)
 
-    else:
-        # 上限を超えない場合は先頭に色を追加
-        use_colors = [bg_color] + use_colors
-        use_color_index += 1
-        mfm_line = f"$[{use_mfm}.color={bg_color} " + mfm_line
-    
-    return mfm_line
+        #==================================================
+        # 同じ状態から従来の方法でも生成して短い方を使う
+        #==================================================
 
-### @brief 1行分のMFMを生成する関数
-### @param color_array_line 色の配列（1行分）
-### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
-### @param space_char 空白として使用する文字
-### @return 生成された1行分のMFM文字列
-def GenerateMFMLine(color_array_line, color_type, space_char):
-    global use_colors, use_color_index, pre_use_color_index, mfm_lines, mfm_lines_last_index
-    mfm_line = ""
-    space = ""
-
-    # 背景色を追加
-    mfm_line = AddBackgroundColor(mfm_line, color_type)
-    
-    for rgba in color_array_line:
-        # 前まで使用していたインデックスを保存
-        pre_use_color_index = use_color_index
-        # 色を文字列に変換
-        bg_color = ConvertColorToString(rgba, color_type)
-        
-        # 4桁RGBA形式の場合、アルファ値を取得
-        if color_type == 2:
-            alpha = bg_color[3]
-            # アルファ値がf(不透明)ならアルファ値の部分を削る
-            if (alpha == "f"):
-                bg_color = bg_color[:3]
+        # 従来の方法は1行前の行末の "]" の数や統計も変えるので、探索の方を使う場合に戻せるように保存する
+        previous_state = (self.mfm_lines_close_count[-1], self.mfm_lines_last_index[-1]) if self.mfm_lines else None
+        counters = (self.overflow_count, self.carried_overflow_count, self.regenerate_count, self.max_depth)
+
+        # 探索の開始時に開いていた色を使用中の色にする
+        self.ResetCurrentColors()
+        for color in self.planned_stack:
+            self.AppendUseColor(color)
+        self.use_color_index = len(self.use_colors) - 1
+        greedy_line = self.GenerateMFMLineText(color_code_line, space_char)
+
+        # 開いたままの色も後で "]" が1つずつ必要なので含めて比べる
+        greedy_chars = len(greedy_line) + (self.mfm_lines_close_count[-1] - previous_state[0] if previous_state else 0) + (self.use_color_index + 1)
+        if greedy_chars < len(planned_line) + len(best_stack):
+            self.planned_stack = tuple(self.use_colors[:self.use_color_index + 1])
+            self.mfm_lines.append(greedy_line)
         else:
-            alpha = "f"
-        
-        if bg_color not in use_colors:
-            #==================================================
-            # 使用中の色にない場合の処理
-            #==================================================
-
-            mfm_line = ColorNotInUseColors(mfm_line, bg_color, alpha)
-            # mfm_lineがNoneになった場合は再生成なのでreturnする
-            if mfm_line is None:
-                return True  # 再生成が必要なのでTrueを返す
-
-        elif bg_color in use_colors:
-            #==================================================
-            # 使用中の色にある場合の処理
-            #==================================================
-
-            mfm_line = ColorInUseColors(mfm_line, bg_color)
-            
-        # スペースの追加
-        mfm_line += space_char
-
-    # 仮の動作で行ごとに色を閉じる
-    if default_background[3] > 0:
-        mfm_line = CloseCurrentColors(mfm_line, 0)
-        use_color_index = 0
-    else:
-        mfm_line = CloseCurrentColors(mfm_line, -1)
-        use_color_index = -1
-
-    # 使用中の色が無い場合、右端にあるスペースを削除
-    if not use_colors:
-        mfm_line = mfm_line.rstrip(space_char)
-
-    mfm_lines.append(mfm_line)
-    mfm_lines_last_index.append(use_color_index)
+            if previous_state is not None:
+                self.mfm_lines_close_count[-1], self.mfm_lines_last_index[-1] = previous_state
+            self.overflow_count, self.carried_overflow_count, self.regenerate_count, self.max_depth = counters
+            self.max_depth = max(self.max_depth, planned_max_depth)
+            self.planned_stack = best_stack
+            self.mfm_lines.append(planned_line)
+
+        self.mfm_lines_close_count.append(0)
+        self.mfm_lines_last_index.append(len(self.planned_stack) - 1)
+
+    ### @brief 確定した一番古い行を取り出す関数
+    ### @return 後から追加する "]" を付けたMFMの行
+    def PopFinishedLine(self):
+        mfm_line = self.mfm_lines.pop(0)
+        close_count = self.mfm_lines_close_count.pop(0)
+        self.mfm_lines_last_index.pop(0)
+        if close_count:
+            mfm_line += "]" * close_count
+
+        # 確定した行のタグを数える (スケールのタグは後から追加するので含まない)
+        self.line_count += 1
+        self.tags_opened += mfm_line.count("$[")
+        self.tags_closed += mfm_line.count("]")
+        return mfm_line
 
-    return False  # 成功した場合はFalseを返す
+    ### @brief 生成の統計を計測結果のカウンターに追加する関数
+    def RecordCounters(self):
+        AddCounters({
+            "encoder_lines": self.line_count,
+            "tags_opened": self.tags_opened,
+            "tags_closed": self.tags_closed,
+            "overflows": self.overflow_count,
+            "carried_overflows": self.carried_overflow_count,
+            "line_regenerations": self.regenerate_count
+        })
+        UpdateMaximum("max_depth", self.max_depth)
+
+    ### @brief 色の配列を行の帯ごとに受け取り、確定したMFMの行を順に返すジェネレーター
+    ### @param color_bands 色の配列 (R, G, B, A) の帯を上から順に返すイテラブル
+    ### @param scale MFMのスケール文字列
+    ### @param space_char 空白として使用する文字
+    ### @param height 画像全体の行数 (進捗の表示用。不明な場合はNone)
+    ### @return MFMの行の文字列 (改行は含まない) を上から順に返す
+    ### @details 次の行を生成すると前の行の末尾に "]" が追加されることがあるので、1行遅れで返す。
+    ###          保持する行は最大2行なので、画像の高さに関係なく使用するメモリは変わらない
+    def GenerateMFMLines(self, color_bands, scale, space_char, height = None):
+        logger.info("Generating MFM.")
+
+        if self.color_type not in [0, 1, 2]:
+            raise ValueError(f"Invalid color type: {self.color_type}")
+
+        # 行ごとの表示は詳細表示のときだけ行う (表示しない場合は文字列も作らない)
+        log_lines = logger.isEnabledFor(logging.DEBUG)
+
+        i = 0
+        is_first_line = True
+        for color_band in color_bands:
+            # 帯のピクセルを一括で色コードに変換する
+            color_codes = ConvertColorArrayToCodes(color_band, self.color_type)
+
+            for code_line in color_codes.tolist():
+                i += 1
+                if log_lines:
+                    logger.debug(f"\tProcessing line {i}/{height if height is not None else '?'}...")
+
+                # 各行のMFMを生成
+                if self.encoder_mode == "planner":
+                    self.GenerateMFMLinePlanned(code_line, space_char)
+                else:
+                    self.GenerateMFMLine(code_line, space_char)
+
+                # 1つ前の行はもう変更されないので確定して返す
+                if len(self.mfm_lines) > 1:
+                    mfm_line = self.PopFinishedLine()
+                    if is_first_line:
+                        # MFMの最初にスケールを追加
+                        mfm_line = "$[scale.y=" + scale + " " + mfm_line
+                        is_first_line = False
+                    yield mfm_line
+
+        if not self.mfm_lines:
+            return
+
+        # 最後の行のMFMを閉じる
+        if self.encoder_mode == "planner":
+            # 探索で生成した場合は開いたままの色を閉じる
+            self.mfm_lines_close_count[-1] += len(self.planned_stack)
+        elif self.mfm_lines[-1] or self.mfm_lines_close_count[-1]:
+            # 最後の行の色を閉じる
+            self.mfm_lines_close_count[-1] += len(self.use_colors)
+
+        mfm_line = self.PopFinishedLine()
+        if is_first_line:
+            mfm_line = "$[scale.y=" + scale + " " + mfm_line
+        # MFMの最後にスケールを閉じる括弧を追加
+        yield mfm_line + "]"
+
+        # 上限を超えた回数と行を作り直した回数を表示
+        logger.info(f"\tOverflow count: {self.overflow_count} (with previous line colors: {self.carried_overflow_count}), Regenerate count: {self.regenerate_count}")
+        logger.info(f"\tTags opened: {self.tags_opened}, closed: {self.tags_closed}, max depth: {self.max_depth}")
+        logger.info("MFM generation complete.")
+        self.RecordCounters()
+
+    ### @brief MFMの文字列を生成する関数
+    ### @param color_array 色の配列 (R, G, B, A)
+    ### @param scale MFMのスケール文字列
+    ### @param space_char 空白として使用する文字
+    ### @return 生成されたMFM文字列。失敗した場合はNoneを返す。
+    def GenerateMFM(self, color_array, scale, space_char):
+        try:
+            # MFMの行を結合して最終的な文字列を生成
+            return "\n".join(self.GenerateMFMLines([color_array], scale, space_char, len(color_array)))
+
+        except Exception as e:
+            logger.error(f"Error generating MFM: {e}")
+            return None
 
 ### @brief MFMの文字列生成関数
 ### @param color_array 色の配列 (辞書型3次元配列)
@@ -349,58 +734,51 @@ def GenerateMFMLine(color_array_line, color_type, space_char):
 ### @param space_char 空白として使用する文字
 ### @param max_overlap_bg_color 重ねがけできるbg.colorの上限
 ### @param use_mfm_char MFMの使用形式（"bg" または "fg"）
+### @param encoder_mode 生成方法（"greedy": 従来の方法, "planner": 文字数が最小になるよう探索）
+### @param planner_beam 探索で残す状態の数
 ### @return 生成されたMFM文字列
-def GenerateMFM(color_array, color_type, background_color, scale, space_char, max_overlap_bg_color, use_mfm_char):
-    global max_use_colors, default_background, use_mfm, mfm_lines, use_colors, use_color_index, pre_use_color_index, mfm_lines_last_index
-    print("Generating MFM.")
-
-    max_use_colors = max_overlap_bg_color if max_overlap_bg_color > 0 else 19
-    default_background = background_color if background_color else (0, 0, 0, 0)
-    use_mfm = use_mfm_char if use_mfm_char else "bg"
-
-    i = 0
-    for color_line in color_array:
-        i += 1
-        print(f"\tProcessing line {i}/{len(color_array)}...")
-        
-        j = 0
-        # 各行のMFMを生成。生成に失敗するとTrueを返すので、それで再生成を行う
-        while GenerateMFMLine(color_line, color_type, space_char):
-            j += 1
-            # 10回繰り返しても失敗する場合はエラーとする
-            if (j > 10):
-                print(f"Failed to generate MFM line. Line {i}")
-                break
-
-
-    # すべての行のMFMを閉じる
-    if mfm_lines:
-        # 最後の行の色を閉じる
-        mfm_lines[-1] = CloseCurrentColors(mfm_lines[-1], -1)
-
-    # MFMの最初にスケールを追加
-    mfm_lines[0] = "$[scale.y=" + scale + " " + mfm_lines[0]
-    # MFMの最後にスケールを閉じる括弧を追加
-    mfm_lines[-1] += "]"
-
-    # MFMの行を結合して最終的な文字列を生成
-    mfm_text = "\n".join(mfm_lines)
-
-    print("MFM generation complete.")
-    return mfm_text
+def GenerateMFM(color_array, color_type, background_color, scale, space_char, max_overlap_bg_color, use_mfm_char, encoder_mode = "greedy", planner_beam = 16):
+    # 呼び出しごとに新しいエンコーダーを使うので、前回の生成結果は引き継がれない
+    encoder = MFMEncoder(max_overlap_bg_color, background_color, use_mfm_char, color_type, encoder_mode, planner_beam)
+    return encoder.GenerateMFM(color_array, scale, space_char)
 
 ### @brief MFMをファイルに保存する関数
 ### @param mfm_text MFMアートの文字列
 ### @param filename 保存するファイル名（拡張子は自動的に.txtが付与される）
 def OutputMFM(mfm_text, filename):
-    print(f"Saving MFM art to: {filename}.txt")
+    logger.info(f"Saving MFM art to: {filename}.txt")
 
     try:
-        with open(f"{filename}.txt", "w", encoding="UTF-8") as mfm_file:
+        with StageTimer("output"), open(f"{filename}.txt", "w", encoding="UTF-8") as mfm_file:
             mfm_file.write(mfm_text)
-        print(f"MFM art saved to {filename}.txt")
+        logger.info(f"MFM art saved to {filename}.txt")
         return True
 
     except Exception as e:
-        print(f"Error saving MFM art: {e}")
-        return False
\ No newline at end of file
+        logger.error(f"Error saving MFM art: {e}")
+        return False
+
+### @brief MFMの行を生成されたそばからファイルに書き込む関数
+### @param mfm_lines MFMの行の文字列を順に返すイテラブル (改行は含まない)
+### @param filename 保存するファイル名（拡張子は自動的に.txtが付与される）
+### @return 書き込んだ文字数。失敗した場合はNoneを返す。
+### @details 全体の文字列を作らないので、画像の高さに関係なく使用するメモリは変わらない
+def OutputMFMLines(mfm_lines, filename):
+    logger.info(f"Saving MFM art to: {filename}.txt")
+
+    try:
+        char_count = 0
+        with open(f"{filename}.txt", "w", encoding="UTF-8") as mfm_file:
+            for i, mfm_line in enumerate(mfm_lines):
+                # 行の間に改行を入れる (最後の行の後には入れない)
+                if i > 0:
+                    mfm_file.write("\n")
+                    char_count += 1
+                mfm_file.write(mfm_line)
+                char_count += len(mfm_line)
+        logger.info(f"MFM art saved to {filename}.txt")
+        return char_count
+
+    except Exception as e:
+        logger.error(f"Error saving MFM art: {e}")
+        return None
\ No newline at end of file
@@ -1,17 +1,28 @@
 import copy
 import numpy as np
 from PIL import Image
+from Instrumentation import *
 
 #==================================================
 # 画像用関数
 #==================================================
 
+# リサイズに使うフィルターの種類
+resample_filters = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
 ### @brief リサイズの値を計算する関数
 ### @param img_size 画像のサイズ (width, height)
 ### @param resize_value リサイズの値 (width, height)
 ### @return リサイズ後の幅と高さのタプル。両方とも0以下の場合はNoneを返す。
 def CalculateResizeValue(img_size, resize_value):
-    print(f"Calculating resize value for image size: {img_size} with resize value: {resize_value}")
+    logger.info(f"Calculating resize value for image size: {img_size} with resize value: {resize_value}")
 
     # 縦幅も横幅も設定されているならそのまま返す
     if resize_value[0] > 0 and resize_value[1] > 0:
@@ -39,26 +50,33 @@ def CalculateResizeValue(img_size, resize_value):
         return resize_width, resize_height
 
     except Exception as e:
-        print(f"Error calculating resize value: {e}")
+        logger.error(f"Error calculating resize value: {e}")
         return None, None
 
 ### @brief pngファイルリサイズ関数
 ### @param img 画像オブジェクト
 ### @param resize_value リサイズの値 (width, height)
+### @param resample リサイズに使うフィルター（nearest, box, bilinear, hamming, bicubic, lanczos）
+### @param reducing_gap 先に整数倍で縮小してから残す倍率。大きく縮小する場合に速くなる (0以下なら使用しない)
 ### @return リサイズ後の画像オブジェクト。リサイズに失敗した場合はNoneを返す。
-def ResizePngFile(img, resize_value):
-    print(f"Resizing image to: {resize_value}")
+def ResizePngFile(img, resize_value, resample = "bicubic", reducing_gap = 0):
+    logger.info(f"Resizing image to: {resize_value} ({resample})")
     # リサイズの値が無効ならそのままにする
     if (resize_value[0] <= 0) and (resize_value[1] <= 0):
-        print("Retain size.")
+        logger.info("Retain size.")
         return img
 
+    if resample not in resample_filters:
+        logger.error(f"Invalid resample filter: {resample}")
+        return None
+
     try:
-        img = img.resize(resize_value)
+        # reducing_gap を指定すると、目的のサイズのその倍率まで Image.reduce で縮小してからフィルターをかける
+        img = img.resize(resize_value, resample_filters[resample], reducing_gap=reducing_gap if reducing_gap > 0 else None)
         return img
 
     except Exception as e:
-        print(f"Error resizing image: {e}")
+        logger.error(f"Error resizing image: {e}")
         return None
 
 ### @brief 背景色設定用関数
@@ -66,11 +84,11 @@ def ResizePngFile(img, resize_value):
 ### @param background_color 背景色 (R, G, B, A)
 ### @return 背景色が設定された画像オブジェクト。失敗した場合はNoneを返す。
 def SetBackgroundColor(img, background_color):
-    print(f"Setting background color: {background_color}")
+    logger.info(f"Setting background color: {background_color}")
 
     # 背景色が無効ならそのままにする
     if (background_color[0] < 0) or (background_color[1] < 0) or (background_color[2] < 0) or (background_color[3] < 0):
-        print("Invalid background color. Retain original image.")
+        logger.warning("Invalid background color. Retain original image.")
         return img
 
     try:
@@ -81,5 +99,5 @@ def SetBackgroundColor(img, background_color):
         return new_img
 
     except Exception as e:
-        print(f"Error setting background color: {e}")
+        logger.error(f"Error setting background color: {e}")
         return None
\ No newline at end of file
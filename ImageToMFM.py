@@ -1,109 +1,146 @@
+import sys
+import time
+import logging
+import argparse
 from LoadingFiles import *
 from ImageFunctions import *
 from ColorReduction import *
 from GenerateMFM import *
+from Pipeline import *
+from AnimationMFM import *
 
-def main():
-    #==================================================
-    # ファイル読み込み
-    #==================================================
+### @brief オプションに従って画像を変換し、ファイルに保存する関数
+### @param option オプションの辞書
+### @return 出力したMFMの文字数。失敗した場合はNoneを返す。
+def RunConversion(option):
+    # 出力するファイル名
+    output_filename = option["filename"].split("/")[-1]
+    output_filename = output_filename.split(".")[0]
 
-    # オプションファイルの読み込み
-    option: dict[str, int] = LoadOptionFile("option.txt")
-    if not option:
-        print("Invalid option file.")
-        return
+    # アニメーションの場合はフレームごとに変換して保存する
+    if option["animation_mode"] != "off":
+        char_counts = ConvertAnimationFile(option["filename"], option, output_filename)
+        if char_counts is None:
+            logger.error("Failed to convert animation.")
+            return None
 
-    # 画像の読み込み
-    img = LoadPngFile(option["filename"])
-    if img is None:
-        print("Failed to load image.")
-        return
+        logger.info(f"MFM art saved success.")
+        logger.info(f"Output MFM character count: {sum(char_counts)} ({len(char_counts)} frames)\n")
+        return sum(char_counts)
 
-    #===================================================
-    # 画像処理と色抽出
-    #===================================================
-  
-    # 画像のリサイズ値の計算
-    option["resize_width"], option["resize_height"] = CalculateResizeValue(img.size, (option["resize_width"], option["resize_height"]))
-    if option["resize_width"] is None or option["resize_height"] is None:
-        print("Invalid resize dimensions.")
-        return
-
-    # 画像のリサイズ
-    img = ResizePngFile(img, [option["resize_width"], option["resize_height"]])
-    if img is None:
-        print("Failed to resize image.")
-        return
-
-    # 背景色の設定
-    img = SetBackgroundColor(img, option["background_color"])
-    if img is None:
-        print("Failed to set background color.")
-        return
-  
-    # 画像から色を抽出
-    color_array = ConvertPngToArray(img)
-    if color_array is None:
-        print("Failed to convert image to color array.")
-        return
+    # 行の帯ごとに変換する場合は生成した行からファイルに書き込む
+    if (option["stream_rows"] > 0) and (option["max_chars"] <= 0):
+        img, resize_value = LoadImageFile(option["filename"], option)
+        if img is None:
+            logger.error("Failed to load image.")
+            return None
+
+        char_count = ConvertImageStreaming(img, option, output_filename, resize_value)
+        if char_count is None:
+            logger.error("Failed to save MFM art.")
+            return None
+
+        logger.info(f"MFM art saved success.")
+        logger.info(f"Output MFM character count: {char_count}\n")
+        return char_count
 
     #===================================================
-    # 減色処理
+    # MFMアートの生成
     #===================================================
-    
-    # 色を平均化
-    print(f"Smooth repeat num: {option["smooth_repeat"]}")
-    for i in range(option["smooth_repeat"]):
-        print(f"\tSmooth count: {i+1}")
-        color_array = SmoothColorArray(color_array)
-        if color_array is None:
-            print("Failed to smooth colors.")
-            return
-
-    # ピクセルの色を割り算して減色
-    color_array = DivideColor(color_array, option["color_division"])
-    if color_array is None:
-        print("Failed to reduce colors.")
-        return
-
-    # 背景の色も同様に割り算して減色
-    option["background_color"] = QuantizeColor(option["background_color"], option["color_division"])
-
-    # k-meansクラスタリングで減色
-    if option["max_row_colors"] > 0:
-        print(f"Reducing colors per row with max_row_colors: {option['max_row_colors']}")
-        color_array = ReduceColorsPerRow(color_array, option["max_row_colors"])
+
+    # 画像の読み込みからMFMアートの生成までを行う
+    # (文字数の上限を指定した場合は探索し、キャッシュが有効なら保存済みの段階は飛ばす)
+    mfm_text = ConvertImageFile(option["filename"], option)
+    if mfm_text is None:
+        logger.error("Failed to generate MFM text.")
+        return None
 
     #===================================================
-    # MFMアートの生成と保存
+    # MFMアートの保存
     #===================================================
-    
-    # MFMアートの生成
-    mfm_text: str = GenerateMFM(
-        color_array,
-        option["color_type"],
-        option["background_color"],
-        option["use_scale"],
-        option["use_space"],
-        option["max_overlap_bg_color"],
-        option["use_mfm"]
-    )
-    if mfm_text is None:
-        print("Failed to generate MFM text.")
-        return
 
     # MFMアートの保存
-    output_filename = option["filename"].split("/")[-1]
-    output_filename = output_filename.split(".")[0]
     is_output_complate = OutputMFM(mfm_text, output_filename)
     if not is_output_complate:
-        print("Failed to save MFM art.")
-        return
+        logger.error("Failed to save MFM art.")
+        return None
 
     # 完了メッセージの表示
-    print(f"MFM art saved success.")
+    logger.info(f"MFM art saved success.")
     # 出力したMFMの文字数を表示
-    print(f"Output MFM character count: {len(mfm_text)}\n")
+    logger.info(f"Output MFM character count: {len(mfm_text)}\n")
+    return len(mfm_text)
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Convert the image set in option.txt to MFM art.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="show errors only")
+    parser.add_argument("-v", "--verbose", action="store_true", help="also show the progress of each line")
+    parser.add_argument("--profile", default=None, metavar="REPORT.json", help="save stage timings and encoder counters as JSON")
+    parser.add_argument("--profile-memory", action="store_true", help="also record peak memory per stage in the report (slows down the conversion)")
+    parser.add_argument("--cprofile", default=None, metavar="STATS.prof", help="also save cProfile statistics (open with pstats or snakeviz)")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = ParseArguments(argv)
+
+    # 表示の設定 (quiet の場合はエラーだけを表示する)
+    if args.quiet:
+        ConfigureLogging(logging.WARNING)
+    elif args.verbose:
+        ConfigureLogging(logging.DEBUG)
+    else:
+        ConfigureLogging(logging.INFO)
+
+    #==================================================
+    # ファイル読み込み
+    #==================================================
+
+    # オプションファイルの読み込み
+    option: dict[str, int] = LoadOptionFile("option.txt")
+    if not option:
+        logger.error("Invalid option file.")
+        return 1
+
+    #==================================================
+    # 変換と計測
+    #==================================================
+
+    # 計測は指定した場合だけ行う (指定しない場合、計測用の処理はほとんど時間がかからない)
+    # メモリの計測はtracemallocで全ての確保を追跡するので、時間も遅くなる
+    if args.profile is not None:
+        EnableMetrics(memory=args.profile_memory)
+
+    profiler = None
+    if args.cprofile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start_time = time.perf_counter()
+    with StageTimer("total"):
+        char_count = RunConversion(option)
+    total_seconds = time.perf_counter() - start_time
+
+    if profiler is not None:
+        profiler.disable()
+        try:
+            profiler.dump_stats(args.cprofile)
+            logger.info(f"cProfile stats saved to {args.cprofile}")
+        except Exception as e:
+            logger.error(f"Error saving cProfile stats: {e}")
+
+    if args.profile is not None:
+        SaveMetricsReport(args.profile, {
+            "filename": option["filename"],
+            "succeeded": char_count is not None,
+            "output_chars": char_count,
+            "total_seconds": round(total_seconds, 6)
+        })
+        DisableMetrics()
+
+    return 0 if char_count is not None else 1
 
-main()
\ No newline at end of file
+# プロセスプールのワーカーから読み込まれた場合は実行しない
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,204 @@
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+#==================================================
+# ログの出力と処理の計測用モジュール
+#==================================================
+
+# 変換処理のログの出力先 (表示するかどうかは呼び出し側で ConfigureLogging を呼んで決める)
+logger = logging.getLogger("ImageToMFM")
+# 設定されていない場合は何も表示しない (ライブラリとして使う場合)
+logger.addHandler(logging.NullHandler())
+
+# ConfigureLogging で追加した表示用のハンドラー
+console_handler = None
+
+# 計測を行うか (Falseの場合、StageTimer と AddCounters は何もしない)
+metrics_enabled = False
+# 段階ごとの最大メモリ使用量も計測するか (tracemallocを使うので遅くなる)
+metrics_memory = False
+# 段階名 → {"calls": 回数, "seconds": 合計時間, "peak_bytes": 最大メモリ使用量}
+stage_metrics = {}
+# カウンター名 → 値
+counter_metrics = {}
+# 計測中の段階ごとの [開始時のメモリ使用量, それまでの最大メモリ使用量] (入れ子になった順)
+open_stage_peaks = []
+
+### @brief ログを表示するように設定する関数
+### @param level 表示するログのレベル (logging.INFO など)
+### @param stream 出力先 (デフォルトは標準出力)
+### @details 何度呼んでもハンドラーは1つだけで、レベルだけが変わる
+def ConfigureLogging(level = logging.INFO, stream = None):
+    global console_handler
+
+    if console_handler is None:
+        console_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(console_handler)
+    logger.setLevel(level)
+
+### @brief 現在のスレッドのログを集めるハンドラー
+class RecordListHandler(logging.Handler):
+    def __init__(self, level):
+        super().__init__(level)
+        self.records = []
+        self.thread = threading.get_ident()
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.records.append(record)
+
+### @brief ログを集めるコンテキストマネージャー
+### @param level 集めるログのレベル
+### @return with文で集めたログのレコードのリストを返す
+### @details 他のハンドラーへの出力はそのままで、同じスレッドのログだけを集める
+class CaptureLogs:
+    def __init__(self, level = logging.WARNING):
+        self.handler = RecordListHandler(level)
+
+    def __enter__(self):
+        logger.addHandler(self.handler)
+        return self.handler.records
+
+    def __exit__(self, *exc_info):
+        logger.removeHandler(self.handler)
+        return False
+
+### @brief 一時的に指定のレベルより低いログを出力しないようにするコンテキストマネージャー
+### @param level 出力するログの最低レベル
+class SuppressLogs:
+    def __init__(self, level = logging.WARNING):
+        self.level = level
+        self.previous_level = logging.NOTSET
+
+    def __enter__(self):
+        self.previous_level = logger.level
+        logger.setLevel(max(logger.getEffectiveLevel(), self.level))
+        return self
+
+    def __exit__(self, *exc_info):
+        logger.setLevel(self.previous_level)
+        return False
+
+### @brief 計測を開始する関数 (それまでの計測結果は消す)
+### @param memory 段階ごとの最大メモリ使用量も計測するか
+def EnableMetrics(memory = False):
+    global metrics_enabled, metrics_memory
+
+    ResetMetrics()
+    metrics_enabled = True
+    metrics_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+### @brief 計測を終了する関数
+def DisableMetrics():
+    global metrics_enabled, metrics_memory
+
+    if metrics_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    metrics_enabled = False
+    metrics_memory = False
+
+### @brief 計測結果を消す関数
+def ResetMetrics():
+    stage_metrics.clear()
+    counter_metrics.clear()
+    open_stage_peaks.clear()
+
+### @brief 処理の段階の時間とメモリ使用量を計測するコンテキストマネージャー
+### @param stage 段階の名前
+### @details 計測が無効な場合は何もしない。入れ子にした場合、外側の段階の最大メモリ使用量には内側の分も含まれる
+class StageTimer:
+    __slots__ = ("stage", "start_time", "tracked")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_time = None
+        self.tracked = False
+
+    def __enter__(self):
+        if not metrics_enabled:
+            return self
+
+        if metrics_memory and tracemalloc.is_tracing():
+            # 外側の段階にそれまでの最大値を反映してから、この段階用に最大値を測り直す
+            current, peak = tracemalloc.get_traced_memory()
+            for entry in open_stage_peaks:
+                entry[1] = max(entry[1], peak)
+            open_stage_peaks.append([current, current])
+            tracemalloc.reset_peak()
+            self.tracked = True
+
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_time is None:
+            return False
+
+        seconds = time.perf_counter() - self.start_time
+        peak_bytes = 0
+        if self.tracked:
+            _, peak = tracemalloc.get_traced_memory()
+            for entry in open_stage_peaks:
+                entry[1] = max(entry[1], peak)
+            start_bytes, peak_seen = open_stage_peaks.pop()
+            peak_bytes = peak_seen - start_bytes
+            tracemalloc.reset_peak()
+
+        metrics = stage_metrics.setdefault(self.stage, {"calls": 0, "seconds": 0.0, "peak_bytes": 0})
+        metrics["calls"] += 1
+        metrics["seconds"] += seconds
+        metrics["peak_bytes"] = max(metrics["peak_bytes"], peak_bytes)
+        return False
+
+### @brief カウンターに値を足す関数
+### @param counts カウンター名 → 足す値の辞書
+def AddCounters(counts):
+    if not metrics_enabled:
+        return
+
+    for name, value in counts.items():
+        counter_metrics[name] = counter_metrics.get(name, 0) + value
+
+### @brief カウンターを最大値で更新する関数
+### @param name カウンター名
+### @param value 値
+def UpdateMaximum(name, value):
+    if not metrics_enabled:
+        return
+
+    counter_metrics[name] = max(counter_metrics.get(name, value), value)
+
+### @brief 計測結果を辞書にまとめる関数
+### @return {"stages": 段階ごとの計測結果, "counters": カウンター}
+def MetricsReport():
+    return {
+        "stages": {
+            stage: {"calls": metrics["calls"], "seconds": round(metrics["seconds"], 6), "peak_bytes": metrics["peak_bytes"]}
+            for stage, metrics in stage_metrics.items()
+        },
+        "counters": dict(counter_metrics)
+    }
+
+### @brief 計測結果をJSONファイルに保存する関数
+### @param filename 保存するファイル名
+### @param extra 計測結果に追加して保存する辞書
+### @return 保存に成功した場合はTrue
+def SaveMetricsReport(filename, extra = None):
+    report = {**(extra or {}), **MetricsReport()}
+
+    try:
+        with open(filename, "w", encoding="UTF-8") as report_file:
+            json.dump(report, report_file, indent=2)
+        logger.info(f"Profile report saved to {filename}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error saving profile report: {e}")
+        return False
\ No newline at end of file
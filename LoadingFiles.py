@@ -1,15 +1,17 @@
-from turtle import back
 from PIL import Image
+from Instrumentation import *
 
 #=================================================
 # ファイル読み込み用モジュール
 #=================================================
 
 ### @brief オプションファイルの読み込み関数
-### @param file_path 読み込むオプションファイルのパス
+### @param file_path 読み込むオプションファイルのパス (Noneの場合はファイルを読まずにデフォルト値を使う)
+### @param extra_lines ファイルの後に追加で読み込む "key = value" 形式の行のリスト (後の行の値が優先される)
 ### @return 読み込んだオプションの辞書。読み込みに失敗した場合はNoneを返す。
-def LoadOptionFile(file_path):
-    print(f"Loading option file from: {file_path}")
+def LoadOptionFile(file_path, extra_lines = None):
+    if file_path is not None:
+        logger.info(f"Loading option file from: {file_path}")
 
     # 読み込み用変数
     option_file = []        # オプションファイルの文字を格納するリスト
@@ -19,22 +21,48 @@ def LoadOptionFile(file_path):
     resize_width = -1       # リサイズ後の幅
     resize_height = -1      # リサイズ後の高さ
     smooth_repeat = 0       # 平均化の繰り返し回数
+    smooth_mode = "horizontal"  # 平均化の種類（horizontal: 横方向, vertical: 縦方向, 2d: 周囲8方向）
+    dither_mode = "off"     # ディザリングの方法（off: 使用しない, bayer: 組織的ディザ, floyd_steinberg: 誤差拡散）
     color_division = 0      # 色の割り算値
     max_row_colors = 0      # 各行の最大色数
+    kmeans_backend = "builtin"  # k-meansの実装（builtin: 全行まとめて計算, sklearn: scikit-learn）
+    workers = 1             # 並列に処理するプロセス数
+    global_colors = 0       # 画像全体のパレットの色数
+    palette_method = "median_cut"   # パレットの作成方法（median_cut, octree, kmeans）
     color_type = -1         # 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
     scale_preset = ["0.7"]  # スケールのプリセット
     space_preset = ["　"]   # スペースのプリセット
     use_mfm = "bg"          # 使用するMFM
     background_color = (0, 0, 0, 0) # 背景色 (R, G, B, A)
+    has_background_color = False    # 背景色が指定されたかどうか
     max_overlap_bg_color = 19       # 最大重複背景色数
+    encoder_mode = "greedy"         # MFMの生成方法（greedy: 従来の方法, planner: 文字数が最小になるよう探索）
+    planner_beam = 16               # 探索で残す状態の数
+    merge_delta_e = 0.0             # 各行で近い色をまとめる色の差の上限（0: まとめない）
+    max_chars = 0                   # 出力の文字数の上限（0: 上限なし）
+    fit_parameter = "width"         # 文字数の上限に合わせるときに探索するパラメーター（width, division, row_colors）
+    use_cache = False               # 各段階の結果をキャッシュするか
+    cache_dir = ".mfm_cache"        # キャッシュを保存するディレクトリ
+    cache_max_mb = 256              # キャッシュ全体の上限サイズ (MB)
+    animation_mode = "off"          # アニメーションの変換方法（off: 最初のフレームのみ, frames: フレームごとに保存, bundle: 1つのファイルにまとめて保存）
+    animation_shared_palette = True # 全フレームで同じパレットを使うか (global_colors を指定した場合のみ)
+    animation_reuse_frames = True   # 前のフレームと同じ内容のフレームは変換結果を使い回すか
+    stream_rows = 0                 # 行の帯ごとに変換するときの帯の行数（0: 画像全体をまとめて変換）
+    resample = "bicubic"            # リサイズに使うフィルター（nearest, box, bilinear, hamming, bicubic, lanczos）
+    reducing_gap = 0.0              # 大きく縮小するときに先に整数倍で縮小してから残す倍率（0: 使用しない）
     
     # ファイル読み込み
-    try:
-        with open(file_path, "r", encoding="UTF-8") as file:
-            option_file = file.read().splitlines()
-    except Exception as e:
-        print(f"Error loading option file: {e}")
-        return None
+    if file_path is not None:
+        try:
+            with open(file_path, "r", encoding="UTF-8") as file:
+                option_file = file.read().splitlines()
+        except Exception as e:
+            logger.error(f"Error loading option file: {e}")
+            return None
+
+    # 上書きする行を追加
+    if extra_lines:
+        option_file.extend(extra_lines)
 
     while option_file:
         line = option_file.pop(0).strip()
@@ -61,12 +89,42 @@ def LoadOptionFile(file_path):
         elif line.startswith("smooth_repeat"):
             smooth_repeat = int(line.split("=", 1)[1].strip())
 
+        elif line.startswith("smooth_mode"):
+            smooth_mode = line.split("=", 1)[1].strip()
+            if smooth_mode not in ["horizontal", "vertical", "2d"]:
+                logger.warning(f"Invalid smooth_mode value: {smooth_mode}. Defaulting to 'horizontal'.")
+                smooth_mode = "horizontal"
+
+        elif line.startswith("dither_mode"):
+            dither_mode = line.split("=", 1)[1].strip()
+            if dither_mode not in ["off", "bayer", "floyd_steinberg"]:
+                logger.warning(f"Invalid dither_mode value: {dither_mode}. Defaulting to 'off'.")
+                dither_mode = "off"
+
         elif line.startswith("color_division"):
             color_division = float(line.split("=", 1)[1].strip())
 
         elif line.startswith("max_row_colors"):
             max_row_colors = int(line.split("=", 1)[1].strip())
 
+        elif line.startswith("kmeans_backend"):
+            kmeans_backend = line.split("=", 1)[1].strip()
+            if kmeans_backend not in ["builtin", "sklearn"]:
+                logger.warning(f"Invalid kmeans_backend value: {kmeans_backend}. Defaulting to 'builtin'.")
+                kmeans_backend = "builtin"
+
+        elif line.startswith("workers"):
+            workers = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("global_colors"):
+            global_colors = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("palette_method"):
+            palette_method = line.split("=", 1)[1].strip()
+            if palette_method not in ["median_cut", "octree", "kmeans"]:
+                logger.warning(f"Invalid palette_method value: {palette_method}. Defaulting to 'median_cut'.")
+                palette_method = "median_cut"
+
         elif line.startswith("color_type"):
             color_type = int(line.split("=", 1)[1].strip())
 
@@ -77,10 +135,8 @@ def LoadOptionFile(file_path):
                     color_values[i] = int(color_values[i].strip())
                 else:
                     color_values.append(0)
-            # カラータイプが2以外の場合はアルファ値を255に設定
-            if color_type != 2:
-                color_values[3] = 255
             background_color = tuple(color_values)
+            has_background_color = True
 
         elif line.startswith("scale_preset"):
             scale_preset = line.split("=", 1)[1].strip().split(",")
@@ -93,19 +149,78 @@ def LoadOptionFile(file_path):
         elif line.startswith("max_overlap_bg_color"):
             max_overlap_bg_color = int(line.split("=", 1)[1].strip())
 
+        elif line.startswith("encoder_mode"):
+            encoder_mode = line.split("=", 1)[1].strip()
+            if encoder_mode not in ["greedy", "planner"]:
+                logger.warning(f"Invalid encoder_mode value: {encoder_mode}. Defaulting to 'greedy'.")
+                encoder_mode = "greedy"
+
+        elif line.startswith("planner_beam"):
+            planner_beam = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("merge_delta_e"):
+            merge_delta_e = float(line.split("=", 1)[1].strip())
+
+        elif line.startswith("max_chars"):
+            max_chars = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("fit_parameter"):
+            fit_parameter = line.split("=", 1)[1].strip()
+            if fit_parameter not in ["width", "division", "row_colors"]:
+                logger.warning(f"Invalid fit_parameter value: {fit_parameter}. Defaulting to 'width'.")
+                fit_parameter = "width"
+
+        elif line.startswith("use_cache"):
+            use_cache = int(line.split("=", 1)[1].strip()) != 0
+
+        elif line.startswith("cache_dir"):
+            cache_dir = line.split("=", 1)[1].strip()
+
+        elif line.startswith("cache_max_mb"):
+            cache_max_mb = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("animation_mode"):
+            animation_mode = line.split("=", 1)[1].strip()
+            if animation_mode not in ["off", "frames", "bundle"]:
+                logger.warning(f"Invalid animation_mode value: {animation_mode}. Defaulting to 'off'.")
+                animation_mode = "off"
+
+        elif line.startswith("animation_shared_palette"):
+            animation_shared_palette = int(line.split("=", 1)[1].strip()) != 0
+
+        elif line.startswith("animation_reuse_frames"):
+            animation_reuse_frames = int(line.split("=", 1)[1].strip()) != 0
+
+        elif line.startswith("stream_rows"):
+            stream_rows = int(line.split("=", 1)[1].strip())
+
+        elif line.startswith("resample"):
+            resample = line.split("=", 1)[1].strip()
+            if resample not in ["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"]:
+                logger.warning(f"Invalid resample value: {resample}. Defaulting to 'bicubic'.")
+                resample = "bicubic"
+
+        elif line.startswith("reducing_gap"):
+            reducing_gap = float(line.split("=", 1)[1].strip())
+
         elif line.startswith("use_mfm"):
             use_mfm = line.split("=", 1)[1].strip()
             if use_mfm not in ["bg", "fg"]:
-                print(f"Invalid use_mfm value: {use_mfm}. Defaulting to 'bg'.")
+                logger.warning(f"Invalid use_mfm value: {use_mfm}. Defaulting to 'bg'.")
                 use_mfm = "bg"
 
+    # カラータイプが2以外の場合はアルファ値を255に設定
+    # (行の順番に左右されないように、全ての行を読み込んでから適用する)
+    if has_background_color and color_type != 2:
+        background_color = background_color[:3] + (255,)
+
     # スケールとスペースのインデックスが有効な範囲内か確認
     if use_scale_index < 0 or use_scale_index >= len(scale_preset):
-        print(f"Invalid scale index: {use_scale_index}. Using default scale: {scale_preset[0]}")
+        logger.warning(f"Invalid scale index: {use_scale_index}. Using default scale: {scale_preset[0]}")
         use_scale_index = 0
 
     if use_space_index < 0 or use_space_index >= len(space_preset):
-        print(f"Invalid space index: {use_space_index}. Using default space: {space_preset[0]}")
+        logger.warning(f"Invalid space index: {use_space_index}. Using default space: {space_preset[0]}")
         use_space_index = 0
 
     # 使用するスケールとスペースを取得
@@ -113,44 +228,94 @@ def LoadOptionFile(file_path):
     space = space_preset[use_space_index]
 
     # 設定を表示
-    print(f"\tFilename: {filename}")
-    print(f"\tResize Width: {resize_width}")
-    print(f"\tResize Height: {resize_height}")
-    print(f"\tSmooth Repeat: {smooth_repeat}")
-    print(f"\tColor Division: {color_division}")
-    print(f"\tMax Row Colors: {max_row_colors}")
-    print(f"\tColor Type: {color_type}")
-    print(f"\tBackground Color: {background_color}")
-    print(f"\tUse Scale: {scale}")
-    print(f"\tUse Space: \"{space}\"")
-    print(f"\tMax Overlap Background Color: {max_overlap_bg_color}")
-    print(f"\tUse MFM: {use_mfm}")
+    logger.info(f"\tFilename: {filename}")
+    logger.info(f"\tResize Width: {resize_width}")
+    logger.info(f"\tResize Height: {resize_height}")
+    logger.info(f"\tSmooth Repeat: {smooth_repeat}")
+    logger.info(f"\tSmooth Mode: {smooth_mode}")
+    logger.info(f"\tDither Mode: {dither_mode}")
+    logger.info(f"\tColor Division: {color_division}")
+    logger.info(f"\tMax Row Colors: {max_row_colors}")
+    logger.info(f"\tK-Means Backend: {kmeans_backend}")
+    logger.info(f"\tWorkers: {workers}")
+    logger.info(f"\tGlobal Colors: {global_colors}")
+    logger.info(f"\tPalette Method: {palette_method}")
+    logger.info(f"\tColor Type: {color_type}")
+    logger.info(f"\tBackground Color: {background_color}")
+    logger.info(f"\tUse Scale: {scale}")
+    logger.info(f"\tUse Space: \"{space}\"")
+    logger.info(f"\tMax Overlap Background Color: {max_overlap_bg_color}")
+    logger.info(f"\tUse MFM: {use_mfm}")
+    logger.info(f"\tEncoder Mode: {encoder_mode}")
+    logger.info(f"\tPlanner Beam: {planner_beam}")
+    logger.info(f"\tMerge Delta E: {merge_delta_e}")
+    logger.info(f"\tMax Chars: {max_chars}")
+    logger.info(f"\tFit Parameter: {fit_parameter}")
+    logger.info(f"\tUse Cache: {use_cache}")
+    logger.info(f"\tCache Directory: {cache_dir}")
+    logger.info(f"\tCache Max MB: {cache_max_mb}")
+    logger.info(f"\tAnimation Mode: {animation_mode}")
+    logger.info(f"\tAnimation Shared Palette: {animation_shared_palette}")
+    logger.info(f"\tAnimation Reuse Frames: {animation_reuse_frames}")
+    logger.info(f"\tStream Rows: {stream_rows}")
+    logger.info(f"\tResample: {resample}")
+    logger.info(f"\tReducing Gap: {reducing_gap}")
 
     return {
         "filename": filename,
         "resize_width": resize_width,
         "resize_height": resize_height,
         "smooth_repeat": smooth_repeat,
+        "smooth_mode": smooth_mode,
+        "dither_mode": dither_mode,
         "color_division": color_division,
         "max_row_colors": max_row_colors,
+        "kmeans_backend": kmeans_backend,
+        "workers": workers,
+        "global_colors": global_colors,
+        "palette_method": palette_method,
         "color_type": color_type,
         "background_color": background_color,
         "use_scale": scale,
         "use_space": space,
         "max_overlap_bg_color": max_overlap_bg_color,
-        "use_mfm": use_mfm
+        "use_mfm": use_mfm,
+        "encoder_mode": encoder_mode,
+        "planner_beam": planner_beam,
+        "merge_delta_e": merge_delta_e,
+        "max_chars": max_chars,
+        "fit_parameter": fit_parameter,
+        "use_cache": use_cache,
+        "cache_dir": cache_dir,
+        "cache_max_mb": cache_max_mb,
+        "animation_mode": animation_mode,
+        "animation_shared_palette": animation_shared_palette,
+        "animation_reuse_frames": animation_reuse_frames,
+        "stream_rows": stream_rows,
+        "resample": resample,
+        "reducing_gap": reducing_gap
     }
 
 ### @brief pngファイル読み込み関数
 ### @param filename 読み込むpngファイルのパス
+### @param target_size リサイズ後のサイズ (width, height)。指定するとJPEGはこのサイズに近い縮小版を展開する
+### @param reducing_gap 縮小版を展開するときに、リサイズ後のサイズに対して残す倍率 (0以下なら縮小版を使わない)
 ### @return 読み込んだ画像オブジェクト。読み込みに失敗した場合はNoneを返す。
-def LoadPngFile(filename):
-    print(f"Loading PNG file from: {filename}")
+def LoadPngFile(filename, target_size = None, reducing_gap = 0):
+    logger.info(f"Loading PNG file from: {filename}")
 
     try:
-        img = Image.open(filename).convert("RGBA")
+        # この時点ではヘッダーしか読み込まれない
+        img = Image.open(filename)
+
+        # JPEGは展開するときに1/2, 1/4, 1/8に縮小できるので、リサイズ後のサイズのreducing_gap倍を下回らない範囲で縮小する
+        # (JPEG以外では何もしない)
+        if (target_size is not None) and (target_size[0] > 0) and (target_size[1] > 0) and (reducing_gap > 0):
+            img.draft(None, (int(target_size[0] * reducing_gap), int(target_size[1] * reducing_gap)))
+
+        img = img.convert("RGBA")
         return img
 
     except Exception as e:
-        print(f"Error loading image: {e}")
+        logger.error(f"Error loading image: {e}")
         return None
\ No newline at end of file
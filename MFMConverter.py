@@ -0,0 +1,199 @@
+import io
+import os
+import sys
+import logging
+import argparse
+from PIL import Image
+from LoadingFiles import LoadOptionFile
+from Pipeline import *
+
+#==================================================
+# 他のプログラムから読み込んで使うためのモジュール
+#==================================================
+
+# オプションファイルにだけ書けるキー (読み込んだ後の辞書には残らない)
+option_file_keys = ["use_scale_index", "use_space_index", "scale_preset", "space_preset"]
+
+# 読み込んだ後の辞書の値をそのまま上書きするキー
+direct_option_keys = ["use_scale", "use_space"]
+
+# ライブラリとして使う場合のデフォルト値 (同梱の option.txt と同じ値で、作業ディレクトリにキャッシュは作らない)
+library_defaults = {
+    "resize_width": 16,
+    "resize_height": 0,
+    "color_division": 1.0,
+    "color_type": 1,
+    "background_color": (255, 255, 255, 0),
+    "use_scale_index": 0,
+    "use_space_index": 0,
+    "use_cache": False
+}
+
+### @brief 変換に失敗したときに送出される例外
+class MFMConversionError(Exception):
+    pass
+
+### @brief オプションの辞書をオプションファイルと同じ "key = value" 形式の行に変換する関数
+### @param options オプションの辞書
+### @return 行のリスト
+def CreateOptionLines(options):
+    lines = []
+
+    for key, value in options.items():
+        if key in direct_option_keys:
+            continue
+
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, (list, tuple)):
+            # スペースは前後の空白が消えないように""で囲む
+            if key == "space_preset":
+                value = ",".join(f"\"{v}\"" for v in value)
+            else:
+                value = ",".join(str(v) for v in value)
+        lines.append(f"{key} = {value}")
+
+    return lines
+
+### @brief デフォルト値をオプションの辞書で上書きして読み込む関数
+### @param options 上書きするオプションの辞書 (キーはオプションファイルと同じ)
+### @param option_file 基本にするオプションファイルのパス (Noneの場合はデフォルト値)
+### @return 読み込んだオプションの辞書
+### @details 存在しないキーや選択肢にない値を指定した場合は MFMConversionError を送出する
+def LoadOptions(options = None, option_file = None):
+    options = dict(options or {})
+    if option_file is None:
+        options = {**library_defaults, **options}
+
+    try:
+        with CaptureLogs() as records:
+            option = LoadOptionFile(option_file, CreateOptionLines(options))
+    except ValueError as e:
+        raise MFMConversionError(f"Invalid option value: {e}") from e
+
+    if option is None:
+        raise MFMConversionError(FailureMessage(records))
+
+    # 選択肢にない値はデフォルト値に置き換えられるので、その警告があればエラーにする
+    for record in records:
+        if "Defaulting to" in record.getMessage():
+            raise MFMConversionError(record.getMessage())
+
+    for key, value in options.items():
+        if key in direct_option_keys:
+            option[key] = value
+        elif (key not in option) and (key not in option_file_keys):
+            raise MFMConversionError(f"Unknown option: {key}")
+
+    return option
+
+### @brief 変換中のログから失敗の原因を探す関数
+### @param records CaptureLogs で集めたログのレコードのリスト
+### @return 最初のエラーのメッセージ。見つからない場合は "Conversion failed."
+def FailureMessage(records):
+    for record in records:
+        if record.levelno >= logging.ERROR:
+            return record.getMessage()
+    return "Conversion failed."
+
+### @brief 画像の入力をファイルのパスか画像ファイルとして読めるオブジェクトにする関数
+### @param source 画像オブジェクト、ファイルのパス、画像ファイルのバイト列、またはバイナリのファイルオブジェクト
+### @return 画像オブジェクト、ファイルのパス、または io.BytesIO
+def OpenImageSource(source):
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if hasattr(source, "read"):
+        # 標準入力などシークできない場合があるので、一度すべて読み込む
+        return io.BytesIO(source.read())
+    raise MFMConversionError(f"Unsupported image source: {type(source).__name__}")
+
+### @brief オプションの辞書を読み込んだ後の変換処理
+### @param source OpenImageSource の戻り値
+### @param option オプションの辞書
+### @return MFMアートの文字列。失敗した場合はNoneを返す。
+### @details キャッシュはファイルの中身から作るので、ファイルのパスを指定した場合だけ使う。
+###          アニメーションと行の帯ごとの変換はファイルに出力するためのものなので、ここでは最初のフレームを画像全体まとめて変換する
+def ConvertSource(source, option):
+    if isinstance(source, (str, os.PathLike)):
+        return ConvertImageFile(os.fspath(source), option)
+
+    if isinstance(source, Image.Image):
+        img, resize_value = source.convert("RGBA"), None
+    else:
+        img, resize_value = LoadImageFile(source, option)
+        if img is None:
+            return None
+
+    if option["max_chars"] > 0:
+        mfm_text, _ = FitMaxChars(img, option, resize_value)
+        return mfm_text
+
+    return ConvertImage(img, option, resize_value)
+
+### @brief 画像をMFMアートに変換する関数
+### @param source 画像オブジェクト、ファイルのパス、画像ファイルのバイト列、またはバイナリのファイルオブジェクト
+### @param options 上書きするオプションの辞書 (キーはオプションファイルと同じ。例: {"resize_width": 32, "color_type": 0})
+### @param option_file 基本にするオプションファイルのパス (Noneの場合はデフォルト値)
+### @return MFMアートの文字列
+### @details 途中の経過はログ (Instrumentation.logger) に出力するだけで表示はせず、失敗した場合は MFMConversionError を送出する
+def Convert(source, options = None, option_file = None):
+    option = LoadOptions(options, option_file)
+    source = OpenImageSource(source)
+
+    try:
+        with CaptureLogs() as records:
+            mfm_text = ConvertSource(source, option)
+    except Exception as e:
+        raise MFMConversionError(str(e)) from e
+
+    if mfm_text is None:
+        raise MFMConversionError(FailureMessage(records))
+
+    return mfm_text
+
+# 他のPythonのライブラリと同じ名前でも呼べるようにする
+convert = Convert
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Convert an image to MFM art (reads stdin and writes stdout by default).")
+    parser.add_argument("input", nargs="?", default="-", help="image file, or - for stdin (default: -)")
+    parser.add_argument("-o", "--output", default="-", help="output file, or - for stdout (default: -)")
+    parser.add_argument("--option", default=None, help="base option file (default: built-in defaults)")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE", help="override an option")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = ParseArguments(argv)
+
+    options = {}
+    for override in args.overrides:
+        if "=" not in override:
+            print(f"Invalid override: {override}", file=sys.stderr)
+            return 1
+        key, value = override.split("=", 1)
+        options[key.strip()] = value.strip()
+
+    try:
+        source = sys.stdin.buffer if args.input == "-" else args.input
+        mfm_text = Convert(source, options, args.option)
+    except MFMConversionError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    # 端末の文字コードに関係なくUTF-8で出力する
+    if args.output == "-":
+        sys.stdout.buffer.write(mfm_text.encode("UTF-8"))
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, "w", encoding="UTF-8") as mfm_file:
+            mfm_file.write(mfm_text)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
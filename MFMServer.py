@@ -0,0 +1,430 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from MFMConverter import *
+from StageCache import CreateStageKey
+
+#==================================================
+# 画像をMFMアートに変換するローカルHTTPサーバー用モジュール
+#==================================================
+
+# 一度に受け付ける画像の最大サイズ (バイト)
+max_request_bytes = 32 * 1024 * 1024
+
+### @brief ワーカーの起動時に小さな画像を一度変換して、モジュールの読み込みなどを済ませておく関数
+def WarmUpWorker():
+    from PIL import Image
+
+    # サーバーのログの設定が引き継がれても、ワーカーでは変換の途中経過を出力しない
+    logger.setLevel(logging.WARNING)
+
+    try:
+        Convert(Image.new("RGBA", (2, 2)), {"resize_width": 2})
+    except MFMConversionError:
+        pass
+
+### @brief ワーカーで画像を変換する関数
+### @param image_bytes 画像ファイルのバイト列
+### @param options 上書きするオプションの辞書
+### @return MFMアートの文字列と変換にかかった時間のタプル
+def ConvertRequest(image_bytes, options):
+    start_time = time.perf_counter()
+    mfm_text = Convert(image_bytes, options)
+    return mfm_text, time.perf_counter() - start_time
+
+### @brief ワーカーのプロセスプールを作成する関数
+### @param workers ワーカーのプロセス数
+### @return プロセスプール
+### @details 最初のリクエストで待たないように、ワーカーを起動して変換の準備を済ませてから返す
+def CreateExecutor(workers):
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=WarmUpWorker)
+    for future in [executor.submit(time.sleep, 0) for _ in range(workers)]:
+        future.result()
+    return executor
+
+### @brief 変換結果を新しく使った順に保持するキャッシュ
+class ResultCache:
+    ### @brief コンストラクタ
+    ### @param max_entries 保持する結果の最大数
+    ### @param max_bytes 保持する結果の文字列の合計の最大サイズ (バイト)
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    ### @brief 結果を取得する関数
+    ### @param key キー
+    ### @return MFMアートの文字列。ない場合はNoneを返す。
+    def Get(self, key):
+        with self.lock:
+            mfm_text = self.entries.get(key)
+            if mfm_text is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return mfm_text
+
+    ### @brief 結果を保存する関数。上限を超えた場合は最も前に使った結果から消す
+    ### @param key キー
+    ### @param mfm_text MFMアートの文字列
+    def Put(self, key, mfm_text):
+        size = len(mfm_text.encode("UTF-8"))
+        if (self.max_entries <= 0) or (size > self.max_bytes):
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key).encode("UTF-8"))
+            self.entries[key] = mfm_text
+            self.total_bytes += size
+
+            while (len(self.entries) > self.max_entries) or (self.total_bytes > self.max_bytes):
+                _, old_text = self.entries.popitem(last=False)
+                self.total_bytes -= len(old_text.encode("UTF-8"))
+
+    ### @brief キャッシュの状態を返す関数
+    def Stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+### @brief 変換サーバー。ワーカーのプロセスプールとキャッシュ、処理中の数と統計を持つ
+class MFMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    ### @brief コンストラクタ
+    ### @param address 待ち受けるアドレス (host, port)
+    ### @param workers 変換するワーカーのプロセス数
+    ### @param max_queue 同時に受け付ける変換の最大数 (実行中と待機中の合計。超えた場合は503を返す)
+    ### @param cache_entries キャッシュする結果の最大数
+    ### @param cache_mb キャッシュする結果の合計の最大サイズ (MB)
+    ### @param convert_timeout 1回の変換を待つ最大の秒数
+    def __init__(self, address, workers, max_queue, cache_entries, cache_mb, convert_timeout):
+        super().__init__(address, MFMRequestHandler)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.convert_timeout = convert_timeout
+        self.cache = ResultCache(cache_entries, cache_mb * 1024 * 1024)
+        self.start_time = time.time()
+
+        self.executor = CreateExecutor(workers)
+        self.executor_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {"requests": 0, "converted": 0, "cached": 0, "rejected": 0, "failed": 0}
+        self.convert_seconds = 0.0
+
+    ### @brief 変換の受付を試みる関数
+    ### @return 受け付けた場合はTrue、処理中の数が上限に達している場合はFalse
+    def Acquire(self):
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.in_flight >= self.max_queue:
+                self.counters["rejected"] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    ### @brief 変換の終了を記録する関数
+    ### @param result 結果の種類 ("converted", "cached", "failed")
+    ### @param seconds 変換にかかった時間
+    def Release(self, result, seconds = 0.0):
+        with self.lock:
+            self.in_flight -= 1
+            self.counters[result] += 1
+            self.convert_seconds += seconds
+
+    ### @brief 変換の失敗を記録し、処理中の数はワーカーの変換が終わってから減らす関数
+    ### @param future 変換のFuture
+    ### @param result 結果の種類 ("failed")
+    ### @details タイムアウトしても実行中のワーカーは止められないので、終わるまで処理中の数に含めて受付を制限する。
+    ###          まだ始まっていない変換を取り消せた場合は、すぐに減らされる
+    def ReleaseWhenDone(self, future, result):
+        with self.lock:
+            self.counters[result] += 1
+        future.add_done_callback(self.FinishInFlight)
+
+    ### @brief ワーカーの変換が終わったときに処理中の数を減らす関数 (Futureの完了時に呼ばれる)
+    ### @param future 終わった変換のFuture
+    def FinishInFlight(self, future):
+        with self.lock:
+            self.in_flight -= 1
+
+    ### @brief ワーカーのプロセスが異常終了して使えなくなったプロセスプールを作り直す関数
+    ### @param broken 使えなくなったプロセスプール
+    ### @details 同時に複数のリクエストが失敗しても、作り直すのは1回だけにする。
+    ###          使えなくなったプロセスプールの変換は全て例外で終わるので、処理中の数は FinishInFlight で減らされる
+    def RestartExecutor(self, broken):
+        with self.executor_lock:
+            if self.executor is not broken:
+                return
+
+            logger.warning("Worker process terminated abruptly. Restarting workers.")
+            try:
+                self.executor = CreateExecutor(self.workers)
+            except Exception as e:
+                # 作り直せなかった場合は、次のリクエストでもう一度作り直す
+                logger.error(f"Error restarting workers: {e}")
+                return
+
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    ### @brief 状態と統計を返す関数
+    def Metrics(self):
+        with self.lock:
+            converted = self.counters["converted"]
+            metrics = {
+                "status": "ok",
+                "uptime": round(time.time() - self.start_time, 3),
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "max_queue": self.max_queue,
+                **self.counters,
+                "average_convert_seconds": round(self.convert_seconds / converted, 6) if converted else 0.0
+            }
+        metrics["cache"] = self.cache.Stats()
+        return metrics
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+### @brief リクエストの処理クラス
+### @details POST /convert: 本文に画像ファイルのバイト列、クエリ文字列にオプション (例: /convert?resize_width=32&color_type=0)
+###          GET /health: 状態と統計のJSON
+class MFMRequestHandler(BaseHTTPRequestHandler):
+    ### @brief 応答を送る関数
+    ### @param status HTTPのステータスコード
+    ### @param body 本文の文字列
+    ### @param content_type 本文の種類
+    def SendText(self, status, body, content_type = "text/plain; charset=utf-8"):
+        data = body.encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != "/health":
+            self.SendText(404, "Not found.\n")
+            return
+
+        self.SendText(200, json.dumps(self.server.Metrics()), "application/json")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/convert":
+            self.SendText(404, "Not found.\n")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if (length <= 0) or (length > max_request_bytes):
+            self.SendText(400 if length <= 0 else 413, "Invalid image size.\n")
+            return
+        image_bytes = self.rfile.read(length)
+
+        # オプションの確認とキーの作成は変換の前に行う (同じ意味の値は同じキーになる)
+        options = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        try:
+            # 読み込んだオプションの一覧はリクエストごとに出力しない
+            with SuppressLogs():
+                option = LoadOptions(options)
+        except MFMConversionError as e:
+            self.SendText(400, f"{e}\n")
+            return
+        # workers などの出力が変わらないオプションはキーに含めない
+        key = CreateStageKey(hashlib.sha256(image_bytes).hexdigest(), "server", OutputOptions(option))
+
+        if not self.server.Acquire():
+            self.SendText(503, "Server is busy.\n")
+            return
+
+        mfm_text = self.server.cache.Get(key)
+        if mfm_text is not None:
+            self.server.Release("cached")
+            self.SendText(200, mfm_text)
+            return
+
+        # ワーカーの中でさらにプロセスを作らない
+        options["workers"] = "1"
+        executor = self.server.executor
+        try:
+            future = executor.submit(ConvertRequest, image_bytes, options)
+            mfm_text, seconds = future.result(timeout=self.server.convert_timeout)
+        except MFMConversionError as e:
+            self.server.Release("failed")
+            self.SendText(422, f"{e}\n")
+            return
+        except TimeoutError:
+            future.cancel()
+            self.server.ReleaseWhenDone(future, "failed")
+            self.SendText(504, "Conversion timed out.\n")
+            return
+        except BrokenProcessPool:
+            # ワーカーのプロセスが異常終了した場合は、次のリクエストのためにプロセスプールを作り直す
+            self.server.Release("failed")
+            self.server.RestartExecutor(executor)
+            self.SendText(500, "Worker process terminated abruptly.\n")
+            return
+        except Exception as e:
+            self.server.Release("failed")
+            self.SendText(500, f"Error converting image: {e}\n")
+            return
+
+        self.server.cache.Put(key, mfm_text)
+        self.server.Release("converted", seconds)
+        self.SendText(200, mfm_text)
+
+#==================================================
+# クライアント用関数
+#==================================================
+
+### @brief サーバーに画像を送ってMFMアートに変換する関数
+### @param image_bytes 画像ファイルのバイト列
+### @param options 上書きするオプションの辞書
+### @param url サーバーのURL
+### @param timeout 応答を待つ最大の秒数
+### @return MFMアートの文字列
+### @details 変換に失敗した場合やサーバーが混んでいる場合は MFMConversionError を送出する
+def RequestConversion(image_bytes, options = None, url = "http://127.0.0.1:8765", timeout = 60):
+    query = urllib.parse.urlencode({key: str(value) for key, value in (options or {}).items()})
+    request = urllib.request.Request(f"{url}/convert?{query}", data=image_bytes, method="POST")
+    request.add_header("Content-Type", "application/octet-stream")
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read().decode("UTF-8")
+    except urllib.error.HTTPError as e:
+        message = e.read().decode("UTF-8", "replace").strip()
+        raise MFMConversionError(f"Server returned {e.code}: {message}") from e
+    except urllib.error.URLError as e:
+        raise MFMConversionError(f"Error connecting to server: {e.reason}") from e
+
+### @brief サーバーの状態と統計を取得する関数
+### @param url サーバーのURL
+### @param timeout 応答を待つ最大の秒数
+### @return 状態と統計の辞書
+def RequestHealth(url = "http://127.0.0.1:8765", timeout = 10):
+    try:
+        with urllib.request.urlopen(f"{url}/health", timeout=timeout) as response:
+            return json.loads(response.read().decode("UTF-8"))
+    except urllib.error.URLError as e:
+        raise MFMConversionError(f"Error connecting to server: {e}") from e
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Local HTTP server that converts images to MFM art.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve = subparsers.add_parser("serve", help="start the server (default)")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    serve.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    serve.add_argument("--max-queue", type=int, default=None, help="conversions accepted at once before answering 503 (default: 4 x workers)")
+    serve.add_argument("--cache-entries", type=int, default=1024, help="number of results kept in memory (default: 1024)")
+    serve.add_argument("--cache-mb", type=int, default=64, help="total size of results kept in memory (default: 64)")
+    serve.add_argument("--timeout", type=float, default=60, help="seconds to wait for one conversion (default: 60)")
+
+    client = subparsers.add_parser("convert", help="send an image to a running server")
+    client.add_argument("input", nargs="?", default="-", help="image file, or - for stdin (default: -)")
+    client.add_argument("-o", "--output", default="-", help="output file, or - for stdout (default: -)")
+    client.add_argument("--url", default="http://127.0.0.1:8765", help="server URL")
+    client.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE", help="override an option")
+
+    health = subparsers.add_parser("health", help="show the status of a running server")
+    health.add_argument("--url", default="http://127.0.0.1:8765", help="server URL")
+
+    # コマンドを省略した場合はサーバーを起動する
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if (not argv) or (argv[0] not in ["serve", "convert", "health", "-h", "--help"]):
+        argv = ["serve"] + argv
+    return parser.parse_args(argv)
+
+### @brief サーバーを起動する関数
+def Serve(args):
+    workers = max(1, args.workers)
+    max_queue = args.max_queue if args.max_queue is not None else workers * 4
+
+    # 標準出力はクライアントの出力に使うので、サーバーのログはリクエストのログと同じく標準エラー出力に出す
+    ConfigureLogging(logging.INFO, sys.stderr)
+    logger.info(f"Starting {workers} workers...")
+    server = MFMServer((args.host, args.port), workers, max(1, max_queue), args.cache_entries, args.cache_mb, args.timeout)
+    logger.info(f"Listening on http://{args.host}:{server.server_address[1]}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+def main(argv = None):
+    args = ParseArguments(argv)
+
+    if args.command == "serve":
+        return Serve(args)
+
+    try:
+        if args.command == "health":
+            print(json.dumps(RequestHealth(args.url), indent=2))
+            return 0
+
+        options = {}
+        for override in args.overrides:
+            if "=" not in override:
+                print(f"Invalid override: {override}", file=sys.stderr)
+                return 1
+            key, value = override.split("=", 1)
+            options[key.strip()] = value.strip()
+
+        if args.input == "-":
+            image_bytes = sys.stdin.buffer.read()
+        else:
+            with open(args.input, "rb") as image_file:
+                image_bytes = image_file.read()
+
+        mfm_text = RequestConversion(image_bytes, options, args.url)
+
+    except (MFMConversionError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.output == "-":
+        sys.stdout.buffer.write(mfm_text.encode("UTF-8"))
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, "w", encoding="UTF-8") as mfm_file:
+            mfm_file.write(mfm_text)
+
+    return 0
+
+# プロセスプールのワーカーから読み込まれた場合は実行しない
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,675 @@
+from ImageFunctions import *
+from ColorReduction import *
+from GenerateMFM import *
+from PIL import Image
+from LoadingFiles import LoadPngFile
+from StageCache import *
+from Instrumentation import *
+
+#==================================================
+# 変換処理の各段階をまとめたモジュール
+#==================================================
+
+# 文字数の上限に合わせるときに探索できるパラメーター
+fit_parameters = ["width", "division", "row_colors"]
+
+### @brief リサイズと背景色の設定を行う関数
+### @param img 画像オブジェクト
+### @param option オプションの辞書
+### @param resize_value リサイズの値 (width, height)。Noneの場合はオプションの値から計算する
+### @return 画像オブジェクト。失敗した場合はNoneを返す。
+def PrepareImage(img, option, resize_value = None):
+    # 画像のリサイズ値の計算
+    if resize_value is None:
+        resize_value = CalculateResizeValue(img.size, (option["resize_width"], option["resize_height"]))
+        if resize_value[0] is None or resize_value[1] is None:
+            logger.error("Invalid resize dimensions.")
+            return None
+
+    # 画像のリサイズ
+    with StageTimer("resize"):
+        img = ResizePngFile(img, list(resize_value), option["resample"], option["reducing_gap"])
+    if img is None:
+        logger.error("Failed to resize image.")
+        return None
+
+    # 背景色の設定
+    with StageTimer("background"):
+        img = SetBackgroundColor(img, option["background_color"])
+    if img is None:
+        logger.error("Failed to set background color.")
+        return None
+
+    return img
+
+### @brief リサイズ、背景色の設定、色の平均化までを行う関数
+### @param img 画像オブジェクト
+### @param option オプションの辞書
+### @param resize_value リサイズの値 (width, height)。Noneの場合はオプションの値から計算する
+### @return 色の配列 (R, G, B, A)。失敗した場合はNoneを返す。
+def PrepareColorArray(img, option, resize_value = None):
+    img = PrepareImage(img, option, resize_value)
+    if img is None:
+        return None
+
+    # 画像から色を抽出 (後段の処理はすべて新しい配列を返すので読み取り専用で取得)
+    with StageTimer("to_array"):
+        color_array = ConvertPngToArray(img, read_only=True)
+    if color_array is None:
+        logger.error("Failed to convert image to color array.")
+        return None
+
+    # 色を平均化
+    if option["smooth_repeat"] > 0:
+        logger.info(f"Smooth repeat num: {option['smooth_repeat']} ({option['smooth_mode']})")
+        with StageTimer("smooth"):
+            color_array = SmoothColorArray(color_array, option["smooth_repeat"], option["smooth_mode"])
+        if color_array is None:
+            logger.error("Failed to smooth colors.")
+            return None
+
+    return color_array
+
+### @brief 色の割り算による減色を行う関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param option オプションの辞書
+### @param division 減色値。Noneの場合はオプションの値を使用する
+### @param in_place Trueなら元の配列を直接書き換える (後で使い回す配列にはFalseを指定する)
+### @return 減色した色の配列と、同じテーブルで減色した背景色のタプル。失敗した場合は (None, None) を返す。
+def QuantizeColorArray(color_array, option, division = None, in_place = False):
+    if division is None:
+        division = option["color_division"]
+
+    # 減色用の量子化テーブルを作成
+    quantize_table = CreateQuantizeTable(division)
+    if quantize_table is None:
+        logger.error("Failed to create quantize table.")
+        return None, None
+
+    # 割り算と出力の精度で量子化される段階に合わせてディザリング (新しい配列になるので割り算は直接書き換える)
+    if option["dither_mode"] != "off":
+        with StageTimer("dither"):
+            color_array, _ = DitherColor(color_array, option["dither_mode"], division, option["color_type"])
+        if color_array is None:
+            logger.error("Failed to dither colors.")
+            return None, None
+        in_place = True
+
+    # ピクセルの色を割り算して減色
+    with StageTimer("quantize"):
+        color_array = DivideColor(color_array, division, in_place=in_place, table=quantize_table)
+    if color_array is None:
+        logger.error("Failed to reduce colors.")
+        return None, None
+
+    # 背景の色も同じテーブルで減色
+    background_color = QuantizeColor(option["background_color"], division, quantize_table)
+
+    return color_array, background_color
+
+### @brief 背景色だけを色の割り算で減色する関数 (色の配列をキャッシュから読み込んだ場合に使用)
+### @param option オプションの辞書
+### @return 減色した背景色 (R, G, B, A)。失敗した場合はNoneを返す。
+def QuantizeBackgroundColor(option):
+    quantize_table = CreateQuantizeTable(option["color_division"])
+    if quantize_table is None:
+        logger.error("Failed to create quantize table.")
+        return None
+
+    return QuantizeColor(option["background_color"], option["color_division"], quantize_table)
+
+### @brief 減色前の色を、減色後の各行の色だけを使ってディザリングし直す関数
+### @param color_array 減色前の色の配列 (R, G, B, A)
+### @param reduce_color_array 減色後の色の配列
+### @param option オプションの辞書
+### @return ディザリングした色の配列。dither_mode が off の場合は減色後の配列をそのまま返す。失敗した場合はNoneを返す。
+def DitherReducedColorArray(color_array, reduce_color_array, option):
+    if (option["dither_mode"] == "off") or (reduce_color_array is None):
+        return reduce_color_array
+
+    with StageTimer("dither"):
+        reduce_color_array, _ = DitherRowPalettes(color_array, reduce_color_array, option["dither_mode"])
+    if reduce_color_array is None:
+        logger.error("Failed to dither colors with row palettes.")
+
+    return reduce_color_array
+
+### @brief パレットまたは行ごとのk-meansで減色する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param option オプションの辞書
+### @param n_colors 色の数。Noneの場合はオプションの値を使用する
+### @return 減色した色の配列。失敗した場合はNoneを返す。
+### @details dither_mode を指定した場合は、減色後の各行の色を使ってディザリングし直す
+def ReduceColorArray(color_array, option, n_colors = None):
+    # 画像全体のパレットで減色 (指定した場合は行ごとの減色より優先)
+    if option["global_colors"] > 0:
+        if n_colors is None:
+            n_colors = option["global_colors"]
+        logger.info(f"Reducing colors with global_colors: {n_colors}")
+        with StageTimer("reduce"):
+            reduce_color_array = ReduceColorsGlobal(color_array, n_colors, option["palette_method"], option["color_type"])
+        if reduce_color_array is None:
+            logger.error("Failed to reduce colors with global palette.")
+        return DitherReducedColorArray(color_array, reduce_color_array, option)
+
+    # k-meansクラスタリングで減色
+    if n_colors is None:
+        n_colors = option["max_row_colors"]
+    if n_colors > 0:
+        logger.info(f"Reducing colors per row with max_row_colors: {n_colors}")
+        with StageTimer("reduce"):
+            reduce_color_array = ReduceColorsPerRow(color_array, n_colors, option["kmeans_backend"], workers=option["workers"])
+        if reduce_color_array is None:
+            logger.error("Failed to reduce colors per row.")
+        return DitherReducedColorArray(color_array, reduce_color_array, option)
+
+    return color_array
+
+### @brief 各行で見た目の差が小さい色をまとめる関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param option オプションの辞書
+### @return 色をまとめた色の配列。merge_delta_e が0以下の場合はそのまま返す。失敗した場合はNoneを返す。
+def MergeColorArray(color_array, option):
+    if option["merge_delta_e"] <= 0:
+        return color_array
+
+    with StageTimer("merge"):
+        color_array = MergeSimilarColors(color_array, option["merge_delta_e"], option["color_type"])
+    if color_array is None:
+        logger.error("Failed to merge similar colors.")
+
+    return color_array
+
+### @brief 色の配列からMFMアートを生成する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param background_color 減色済みの背景色 (R, G, B, A)
+### @param option オプションの辞書
+### @return MFMアートの文字列。失敗した場合はNoneを返す。
+### @details 生成の前に近い色をまとめる (merge_delta_e を指定した場合)
+def EncodeColorArray(color_array, background_color, option):
+    color_array = MergeColorArray(color_array, option)
+    if color_array is None:
+        return None
+
+    with StageTimer("encode"):
+        mfm_text = GenerateMFM(
+            color_array,
+            option["color_type"],
+            background_color,
+            option["use_scale"],
+            option["use_space"],
+            option["max_overlap_bg_color"],
+            option["use_mfm"],
+            option["encoder_mode"],
+            option["planner_beam"]
+        )
+    if mfm_text is None:
+        logger.error("Failed to generate MFM text.")
+
+    return mfm_text
+
+### @brief 画像ファイルをリサイズ後のサイズに合わせて読み込む関数
+### @param filename 画像ファイルのパス
+### @param option オプションの辞書
+### @return 画像オブジェクトとリサイズ後のサイズのタプル。失敗した場合は (None, None) を返す。
+### @details 先にヘッダーだけ読んで元のサイズからリサイズ後のサイズを決め、JPEGはそのサイズに近い縮小版を展開する。
+###          展開した画像のサイズは元のサイズと比率が少しずれるので、リサイズ後のサイズは元のサイズから計算したものを使う
+def LoadImageFile(filename, option):
+    try:
+        with Image.open(filename) as img:
+            image_size = img.size
+    except Exception as e:
+        logger.error(f"Error loading image: {e}")
+        return None, None
+
+    resize_value = CalculateResizeValue(image_size, (option["resize_width"], option["resize_height"]))
+    if resize_value[0] is None or resize_value[1] is None:
+        logger.error("Invalid resize dimensions.")
+        return None, None
+
+    with StageTimer("load"):
+        img = LoadPngFile(filename, resize_value, option["reducing_gap"])
+    if img is None:
+        logger.error("Failed to load image.")
+        return None, None
+
+    return img, resize_value
+
+### @brief 画像をオプションの値のままMFMアートに変換する関数
+### @param img 画像オブジェクト
+### @param option オプションの辞書
+### @param resize_value リサイズの値 (width, height)。Noneの場合はオプションの値から計算する
+### @return MFMアートの文字列。失敗した場合はNoneを返す。
+def ConvertImage(img, option, resize_value = None):
+    color_array = PrepareColorArray(img, option, resize_value)
+    if color_array is None:
+        return None
+
+    # 平均化した配列は他で使わないので直接書き換える
+    color_array, background_color = QuantizeColorArray(color_array, option, in_place=True)
+    if color_array is None:
+        return None
+
+    color_array = ReduceColorArray(color_array, option)
+    if color_array is None:
+        return None
+
+    return EncodeColorArray(color_array, background_color, option)
+
+#==================================================
+# 行の帯ごとに変換する関数
+#==================================================
+
+### @brief 色の配列を平均化して行の帯ごとに返すジェネレーター
+### @param img リサイズと背景色の設定を行った画像オブジェクト
+### @param option オプションの辞書
+### @param band_rows 帯の行数
+### @return 色の配列 (R, G, B, A) の帯を上から順に返す
+### @details 縦方向にも平均化する場合は、平均化の回数分の行を帯の上下に加えて平均化してから切り取るので、
+###          画像全体をまとめて平均化した場合と同じ結果になる
+def IterateColorBands(img, option, band_rows):
+    width, height = img.size
+    smooth_repeat = option["smooth_repeat"]
+    halo = smooth_repeat if (smooth_repeat > 0) and (option["smooth_mode"] != "horizontal") else 0
+
+    for start in range(0, height, band_rows):
+        end = min(start + band_rows, height)
+        top = max(0, start - halo)
+        bottom = min(height, end + halo)
+
+        # 帯の部分だけを色の配列にする
+        color_band = ConvertPngToArray(img.crop((0, top, width, bottom)), read_only=True)
+        if color_band is None:
+            raise RuntimeError("Failed to convert image to color array.")
+
+        if smooth_repeat > 0:
+            color_band = SmoothColorArray(color_band, smooth_repeat, option["smooth_mode"])
+            if color_band is None:
+                raise RuntimeError("Failed to smooth colors.")
+
+        yield color_band[start - top:end - top]
+
+### @brief 色の帯を割り算で減色して返すジェネレーター
+### @param color_bands 色の配列の帯を順に返すイテラブル
+### @param option オプションの辞書
+### @return 減色した色の配列の帯を順に返す
+### @details ディザリングの誤差は次の帯に渡すので、帯に分けても画像全体をまとめて処理した場合と同じ結果になる
+def QuantizeColorBands(color_bands, option):
+    quantize_table = CreateQuantizeTable(option["color_division"])
+    if quantize_table is None:
+        raise RuntimeError("Failed to create quantize table.")
+
+    row_offset = 0
+    carry = None
+    for color_band in color_bands:
+        if option["dither_mode"] != "off":
+            color_band, carry = DitherColor(color_band, option["dither_mode"], option["color_division"], option["color_type"], row_offset, carry)
+            if color_band is None:
+                raise RuntimeError("Failed to dither colors.")
+        row_offset += len(color_band)
+
+        color_band = DivideColor(color_band, option["color_division"], in_place=True, table=quantize_table)
+        if color_band is None:
+            raise RuntimeError("Failed to reduce colors.")
+        yield color_band
+
+### @brief 色の帯をパレットまたは行ごとのk-meansで減色して返すジェネレーター
+### @param color_bands 色の配列の帯を順に返すイテラブル
+### @param option オプションの辞書
+### @param palette 画像全体のパレット (global_colors を指定した場合)
+### @return 減色した色の配列の帯を順に返す
+### @details 行ごとの乱数は画像全体での行番号で決まるので、帯に分けても結果は変わらない
+def ReduceColorBands(color_bands, option, palette = None):
+    row_offset = 0
+    carry = None
+    for color_band in color_bands:
+        reduce_color_band = color_band
+        if palette is not None:
+            reduce_color_band = ReduceColorsGlobal(color_band, option["global_colors"], option["palette_method"], option["color_type"], palette=palette)
+        elif option["max_row_colors"] > 0:
+            reduce_color_band = ReduceColorsPerRow(color_band, option["max_row_colors"], option["kmeans_backend"], workers=option["workers"], row_offset=row_offset)
+        if reduce_color_band is None:
+            raise RuntimeError("Failed to reduce colors.")
+
+        # 減色した場合は、減色後の各行の色でディザリングし直す (誤差は次の帯に渡す)
+        if (option["dither_mode"] != "off") and (reduce_color_band is not color_band):
+            reduce_color_band, carry = DitherRowPalettes(color_band, reduce_color_band, option["dither_mode"], row_offset, carry)
+            if reduce_color_band is None:
+                raise RuntimeError("Failed to dither colors.")
+        color_band = reduce_color_band
+
+        # 近い色は行の中だけでまとめるので、帯ごとに処理しても結果は変わらない
+        color_band = MergeColorArray(color_band, option)
+        if color_band is None:
+            raise RuntimeError("Failed to merge similar colors.")
+
+        row_offset += len(color_band)
+        yield color_band
+
+### @brief 画像を行の帯ごとに変換し、生成した行からファイルに書き込む関数
+### @param img 画像オブジェクト
+### @param option オプションの辞書
+### @param output_name 出力するファイル名 (拡張子なし)
+### @param resize_value リサイズの値 (width, height)。Noneの場合はオプションの値から計算する
+### @return 書き込んだ文字数。失敗した場合はNoneを返す。
+### @details リサイズ後の画像以外は帯ごとに処理するので、使用するメモリは画像の高さにほとんど依存しない。
+###          global_colors を指定した場合は、パレットを作るために帯を2回処理する
+def ConvertImageStreaming(img, option, output_name, resize_value = None):
+    band_rows = option["stream_rows"]
+    logger.info(f"Converting image in bands of {band_rows} rows")
+
+    img = PrepareImage(img, option, resize_value)
+    if img is None:
+        return None
+
+    background_color = QuantizeBackgroundColor(option)
+    if background_color is None:
+        return None
+
+    # 画像全体のパレットは、先に全ての帯の色を数えてから作る
+    palette = None
+    if option["global_colors"] > 0:
+        try:
+            colors = None
+            counts = None
+            for color_band in QuantizeColorBands(IterateColorBands(img, option, band_rows), option):
+                colors, counts = CountColors(color_band, colors, counts)
+        except Exception as e:
+            logger.error(f"Error counting colors: {e}")
+            return None
+
+        if colors is None:
+            palette = np.zeros((0, 4), dtype=np.uint8)
+        else:
+            palette = CreatePaletteFromColors(colors, counts, option["global_colors"], option["palette_method"])
+        if palette is None:
+            logger.error("Failed to create palette.")
+            return None
+
+    # 各段階は帯を受け取って帯を返すので、書き込みに合わせて1帯ずつ処理される
+    color_bands = ReduceColorBands(QuantizeColorBands(IterateColorBands(img, option, band_rows), option), option, palette)
+    encoder = MFMEncoder(option["max_overlap_bg_color"], background_color, option["use_mfm"], option["color_type"], option["encoder_mode"], option["planner_beam"])
+    mfm_lines = encoder.GenerateMFMLines(color_bands, option["use_scale"], option["use_space"], img.size[1])
+
+    # 帯の処理、生成、書き込みは交互に進むので、まとめて計測する
+    with StageTimer("stream"):
+        return OutputMFMLines(mfm_lines, output_name)
+
+#==================================================
+# キャッシュを使用した変換用関数
+#==================================================
+
+### @brief 各段階の結果に影響するオプションを取得する関数
+### @param stage 段階の名前 (prepare, quantize, reduce, encode)
+### @param option オプションの辞書
+### @return キーに使うオプションの辞書。何もしない段階の場合はNoneを返す。
+def StageOptions(stage, option):
+    if stage == "prepare":
+        # リサイズ後のサイズは画像とオプションから決まるので、オプションの値のままで良い
+        return {key: option[key] for key in ["resize_width", "resize_height", "resample", "reducing_gap", "background_color", "smooth_repeat", "smooth_mode"]}
+
+    if stage == "quantize":
+        # ディザリングは出力の精度に合わせるので color_type も含める
+        if option["dither_mode"] != "off":
+            return {key: option[key] for key in ["color_division", "dither_mode", "color_type"]}
+        return {"color_division": option["color_division"]}
+
+    if stage == "reduce":
+        # 使用しない減色方法のオプションは含めない (color_type はパレットの減色でのみ使用する)
+        if option["global_colors"] > 0:
+            return {key: option[key] for key in ["global_colors", "palette_method", "color_type", "dither_mode"]}
+        if option["max_row_colors"] > 0:
+            return {key: option[key] for key in ["max_row_colors", "kmeans_backend", "dither_mode"]}
+        return None
+
+    # 背景色は前の段階のキーに含まれている (近い色をまとめる処理も生成の段階で行う)
+    return {key: option[key] for key in ["color_type", "use_scale", "use_space", "max_overlap_bg_color", "use_mfm", "encoder_mode", "planner_beam", "merge_delta_e"]}
+
+### @brief 出力に影響するオプションをまとめて取得する関数
+### @param option オプションの辞書
+### @return 全ての段階の StageOptions と文字数の上限の指定をまとめた辞書
+### @details workers やキャッシュの設定など、変えても出力が同じになるオプションは含めない
+def OutputOptions(option):
+    params = {}
+    for stage in ["prepare", "quantize", "reduce", "encode"]:
+        params.update(StageOptions(stage, option) or {})
+
+    # 文字数の上限を指定した場合は探索するパラメーターによって結果が変わる
+    if option["max_chars"] > 0:
+        params.update({key: option[key] for key in ["max_chars", "fit_parameter"]})
+    return params
+
+### @brief 画像ファイルをMFMアートに変換する関数。キャッシュが有効な場合は各段階の結果を使い回す
+### @param filename 画像ファイルのパス
+### @param option オプションの辞書
+### @return MFMアートの文字列。失敗した場合はNoneを返す。
+### @details キーは入力ファイルの中身のハッシュ値と、各段階までに使うオプションから作る。
+###          最後の段階から順にキャッシュを探すので、後の段階のオプションだけを変えた場合は前の段階を計算しない。
+###          文字数の上限を指定した場合はキャッシュを使用せずに探索する。
+def ConvertImageFile(filename, option):
+    if option["max_chars"] > 0:
+        img, resize_value = LoadImageFile(filename, option)
+        if img is None:
+            return None
+
+        # 文字数の上限に収まるようにパラメーターを探索して生成
+        mfm_text, _ = FitMaxChars(img, option, resize_value)
+        return mfm_text
+
+    if not option["use_cache"]:
+        img, resize_value = LoadImageFile(filename, option)
+        if img is None:
+            return None
+        return ConvertImage(img, option, resize_value)
+
+    cache_dir = option["cache_dir"]
+    max_bytes = option["cache_max_mb"] * 1024 * 1024
+
+    # 各段階のキーを作成
+    key = HashFileBytes(filename)
+    if key is None:
+        logger.error("Failed to hash image file.")
+        return None
+    keys = {}
+    for stage in ["prepare", "quantize", "reduce", "encode"]:
+        params = StageOptions(stage, option)
+        # 何もしない段階は前の段階と同じキーにする
+        if params is not None:
+            key = CreateStageKey(key, stage, params)
+        keys[stage] = key
+
+    # MFMアートが保存されている場合はそのまま返す
+    mfm_text = LoadCachedText(cache_dir, keys["encode"])
+    if mfm_text is not None:
+        logger.info("Loaded MFM text from cache.")
+        AddCounters({"cache_hits": 1})
+        return mfm_text
+
+    # 保存されている一番後の段階の色の配列を探す
+    array_stages = ["prepare", "quantize", "reduce"]
+    color_array = None
+    start = 0
+    for i in reversed(range(len(array_stages))):
+        color_array = LoadCachedArray(cache_dir, keys[array_stages[i]])
+        if color_array is not None:
+            logger.info(f"Loaded {array_stages[i]} stage from cache.")
+            AddCounters({"cache_hits": 1})
+            start = i + 1
+            break
+
+    if start == 0:
+        AddCounters({"cache_misses": 1})
+        img, resize_value = LoadImageFile(filename, option)
+        if img is None:
+            return None
+
+        color_array = PrepareColorArray(img, option, resize_value)
+        if color_array is None:
+            return None
+        SaveCachedArray(cache_dir, keys["prepare"], color_array, max_bytes)
+
+    if start <= 1:
+        # 保存済みの配列はメモリマップで読み取り専用なので、書き換えずにコピーされる
+        color_array, background_color = QuantizeColorArray(color_array, option, in_place=True)
+        if color_array is None:
+            return None
+        SaveCachedArray(cache_dir, keys["quantize"], color_array, max_bytes)
+    else:
+        background_color = QuantizeBackgroundColor(option)
+        if background_color is None:
+            return None
+
+    if (start <= 2) and (keys["reduce"] != keys["quantize"]):
+        color_array = ReduceColorArray(color_array, option)
+        if color_array is None:
+            return None
+        SaveCachedArray(cache_dir, keys["reduce"], color_array, max_bytes)
+
+    mfm_text = EncodeColorArray(color_array, background_color, option)
+    if mfm_text is None:
+        return None
+    SaveCachedText(cache_dir, keys["encode"], mfm_text, max_bytes)
+
+    return mfm_text
+
+#==================================================
+# 文字数の上限に合わせる探索用関数
+#==================================================
+
+### @brief 候補の中から文字数の上限に収まる最初の値を二分探索で探す関数
+### @param candidates 再現度が高い順に並べた候補の値のリスト
+### @param probe 値を受け取ってMFMアートの文字列を返す関数 (失敗した場合はNone)
+### @param max_chars 文字数の上限
+### @return 見つかった値とMFMアートの文字列のタプル。どの値でも収まらない場合は最後の候補の結果を返す。失敗した場合は (None, None) を返す。
+### @details 再現度を下げるほど文字数が減る (単調である) ことを前提にしている
+def SearchFirstFit(candidates, probe, max_chars):
+    results = {}
+
+    # 同じ値を2回生成しないように結果を保存しておく
+    def Probe(index):
+        if index not in results:
+            mfm_text = probe(candidates[index])
+            results[index] = mfm_text
+            if mfm_text is not None:
+                logger.info(f"\tFit probe: {candidates[index]} -> {len(mfm_text)} chars")
+        return results[index]
+
+    # 最も再現度の高い値で収まるならそのまま使用
+    mfm_text = Probe(0)
+    if mfm_text is None:
+        return None, None
+    if len(mfm_text) <= max_chars:
+        return candidates[0], mfm_text
+
+    # 最も再現度の低い値でも収まらない場合はその結果を返す
+    last = len(candidates) - 1
+    mfm_text = Probe(last)
+    if mfm_text is None:
+        return None, None
+    if len(mfm_text) > max_chars:
+        logger.warning(f"Could not fit within {max_chars} chars. Using {candidates[last]}.")
+        return candidates[last], mfm_text
+
+    # lowは収まらない値、highは収まる値のインデックス
+    low = 0
+    high = last
+    while high - low > 1:
+        middle = (low + high) // 2
+        mfm_text = Probe(middle)
+        if mfm_text is None:
+            return None, None
+        if len(mfm_text) <= max_chars:
+            high = middle
+        else:
+            low = middle
+
+    return candidates[high], results[high]
+
+### @brief 文字数の上限に収まるようにパラメーターを探索してMFMアートに変換する関数
+### @param img 画像オブジェクト
+### @param option オプションの辞書
+### @param resize_value リサイズの値 (width, height)。Noneの場合はオプションの値から計算する
+### @return MFMアートの文字列と探索したパラメーターの値のタプル。失敗した場合は (None, None) を返す。
+### @details 探索するパラメーターより前の段階は1回だけ計算して使い回す
+def FitMaxChars(img, option, resize_value = None):
+    max_chars = option["max_chars"]
+    fit_parameter = option["fit_parameter"]
+    logger.info(f"Fitting {fit_parameter} to max chars: {max_chars}")
+
+    if fit_parameter not in fit_parameters:
+        logger.error(f"Invalid fit parameter: {fit_parameter}")
+        return None, None
+
+    if fit_parameter == "width":
+        #==================================================
+        # 横幅を探索 (すべての段階を計算し直す)
+        #==================================================
+
+        if resize_value is None:
+            resize_value = CalculateResizeValue(img.size, (option["resize_width"], option["resize_height"]))
+            if resize_value[0] is None or resize_value[1] is None:
+                logger.error("Invalid resize dimensions.")
+                return None, None
+        # リサイズしない設定の場合は元の画像サイズから探索する
+        if (resize_value[0] <= 0) and (resize_value[1] <= 0):
+            resize_value = img.size
+        max_width, max_height = resize_value
+
+        # 縦幅は横幅に合わせてアスペクト比を維持する
+        def Probe(width):
+            height = max(1, round(max_height * width / max_width))
+            return ConvertImage(img, option | {"resize_width": width, "resize_height": height})
+
+        candidates = list(range(max_width, 0, -1))
+
+    else:
+        color_array = PrepareColorArray(img, option, resize_value)
+        if color_array is None:
+            return None, None
+
+        if fit_parameter == "division":
+            #==================================================
+            # 減色値を探索 (平均化までの結果を使い回す)
+            #==================================================
+
+            def Probe(division):
+                # 使い回す配列は書き換えない
+                reduce_color_array, background_color = QuantizeColorArray(color_array, option, division)
+                if reduce_color_array is None:
+                    return None
+                reduce_color_array = ReduceColorArray(reduce_color_array, option)
+                if reduce_color_array is None:
+                    return None
+                return EncodeColorArray(reduce_color_array, background_color, option)
+
+            # 1.0刻みで255.0まで大きくする
+            division = max(1.0, option["color_division"])
+            candidates = [division + i for i in range(int(256 - division))]
+
+        else:
+            #==================================================
+            # 色の数を探索 (割り算による減色までの結果を使い回す)
+            #==================================================
+
+            color_array, background_color = QuantizeColorArray(color_array, option, in_place=True)
+            if color_array is None:
+                return None, None
+
+            def Probe(n_colors):
+                reduce_color_array = ReduceColorArray(color_array, option, n_colors)
+                if reduce_color_array is None:
+                    return None
+                return EncodeColorArray(reduce_color_array, background_color, option)
+
+            # 指定がない場合は1行のピクセル数から探索する
+            max_colors = option["global_colors"] if option["global_colors"] > 0 else option["max_row_colors"]
+            if max_colors <= 0:
+                max_colors = color_array.shape[1]
+            candidates = list(range(max_colors, 0, -1))
+
+    with StageTimer("fit"):
+        value, mfm_text = SearchFirstFit(candidates, Probe, max_chars)
+    if mfm_text is not None:
+        logger.info(f"Fit {fit_parameter}: {value} ({len(mfm_text)} chars)")
+
+    return mfm_text, value
\ No newline at end of file
@@ -0,0 +1,499 @@
+import io
+import re
+import sys
+import logging
+import argparse
+import contextlib
+import importlib.util
+import numpy as np
+from PIL import Image
+from GenerateMFM import *
+from Pipeline import *
+from MFMConverter import LoadOptions, MFMConversionError
+from Benchmark import CreateBenchmarkImage, image_kinds, alpha_kinds, source_scale, benchmark_options
+
+#==================================================
+# 生成したMFMを画像に戻すモジュール (見た目の確認と、生成結果が正しいかの検証用)
+#==================================================
+
+### @brief MFMの文字列を字句に分けるための正規表現を作る関数
+### @param space_char 空白として使用する文字
+### @return 正規表現のオブジェクト
+### @details 字句は開始タグ ($[名前.引数 )、閉じ括弧、改行、空白の連続のいずれか
+def CreateTokenPattern(space_char):
+    return re.compile(
+        r"\$\[([a-z]+)(?:\.([^ \]\n]*))? "     # 開始タグ (関数名, 引数)
+        r"|(\])"                                # 閉じ括弧
+        r"|(\n)"                                # 改行
+        r"|((?:" + re.escape(space_char) + r")+)"  # 空白の連続
+    )
+
+### @brief 色コード文字列を色に変換する関数
+### @param color_string 色コード文字列 (3桁RGB, 4桁RGBA, 6桁RGB)
+### @return 色 (R, G, B, A)
+def DecodeColorString(color_string):
+    if len(color_string) == 6:
+        return (int(color_string[0:2], 16), int(color_string[2:4], 16), int(color_string[4:6], 16), 255)
+    if len(color_string) in [3, 4]:
+        # 1桁の値は 0x11 倍すると 0x00 ～ 0xff になる
+        values = [int(c, 16) * 0x11 for c in color_string]
+        return tuple(values) + ((255,) if len(values) == 3 else ())
+    raise ValueError(f"Invalid color code: {color_string}")
+
+### @brief 重ねた色を下から順に合成する関数
+### @param colors 色 (R, G, B, A) のリスト (下から順)
+### @return 合成した色 (R, G, B, A)。色がない場合は透明
+### @details 不透明な色より下の色は見えないので、最後の不透明な色から合成する
+def CompositeColors(colors):
+    start = 0
+    for i, color in enumerate(colors):
+        if color[3] == 255:
+            start = i
+
+    out_color = [0.0, 0.0, 0.0]
+    out_alpha = 0.0
+    for r, g, b, a in colors[start:]:
+        alpha = a / 255
+        new_alpha = alpha + out_alpha * (1 - alpha)
+        if new_alpha > 0:
+            out_color = [(c * alpha + o * out_alpha * (1 - alpha)) / new_alpha for c, o in zip((r, g, b), out_color)]
+        out_alpha = new_alpha
+
+    if out_alpha <= 0:
+        return (0, 0, 0, 0)
+    return tuple(int(round(v)) for v in out_color) + (int(round(out_alpha * 255)),)
+
+### @brief MFMの文字列を読み、色が同じマスの連続 (スパン) に分ける関数
+### @param mfm_text MFMの文字列
+### @param space_char 空白として使用する文字
+### @param use_mfm 色として読むMFM ("bg" または "fg")
+### @return (スパンの配列の辞書, 行数, 1行の最大マス数, 色の最大の重ねがけ数, 縦のスケール) のタプル
+### @details スパンの配列は "rows", "starts", "lengths", "color_ids" と、色の番号から色への "colors" (n, 4)。
+###          タグはスタックで管理し、括弧の対応が取れていない場合や読めない文字がある場合は ValueError を送出する
+def TokenizeMFM(mfm_text, space_char, use_mfm = "bg"):
+    if not space_char:
+        raise ValueError("Space character is empty")
+    pattern = CreateTokenPattern(space_char)
+    space_length = len(space_char)
+
+    # スタックにはタグが色かどうかを積み、色コード文字列は別に積む
+    stack = []
+    color_stack = []
+    max_depth = 0
+    scale_y = 1.0
+
+    # 同じスタックの状態は1回だけ合成する
+    stack_ids = {}
+    colors = []
+    current_id = -1
+
+    rows = []
+    starts = []
+    lengths = []
+    color_ids = []
+
+    row = 0
+    x = 0
+    width = 0
+    position = 0
+    for match in pattern.finditer(mfm_text):
+        if match.start() != position:
+            raise ValueError(f"Unexpected text at {position}: {mfm_text[position:match.start()][:20]!r}")
+        position = match.end()
+
+        name, argument, close, newline, spaces = match.groups()
+        if spaces is not None:
+            count = len(spaces) // space_length
+            if current_id >= 0:
+                rows.append(row)
+                starts.append(x)
+                lengths.append(count)
+                color_ids.append(current_id)
+            x += count
+            continue
+
+        if name is not None:
+            if (name == use_mfm) and argument and argument.startswith("color="):
+                stack.append(True)
+                color_stack.append(argument[len("color="):])
+                max_depth = max(max_depth, len(color_stack))
+            else:
+                if (name == "scale") and argument and argument.startswith("y="):
+                    scale_y = float(argument[len("y="):])
+                stack.append(False)
+                continue
+
+        elif close is not None:
+            if not stack:
+                raise ValueError(f"Unbalanced ']' at {match.start()}")
+            if not stack.pop():
+                continue
+            color_stack.pop()
+
+        else:
+            width = max(width, x)
+            row += 1
+            x = 0
+            continue
+
+        # スタックが変わったらマスの色を決め直す
+        state = tuple(color_stack)
+        if not state:
+            current_id = -1
+        else:
+            current_id = stack_ids.get(state)
+            if current_id is None:
+                current_id = len(colors)
+                stack_ids[state] = current_id
+                colors.append(CompositeColors([DecodeColorString(color) for color in state]))
+
+    if position != len(mfm_text):
+        raise ValueError(f"Unexpected text at {position}: {mfm_text[position:position + 20]!r}")
+    if stack:
+        raise ValueError(f"{len(stack)} tags are not closed")
+
+    spans = {
+        "rows": np.array(rows, dtype=np.int64),
+        "starts": np.array(starts, dtype=np.int64),
+        "lengths": np.array(lengths, dtype=np.int64),
+        "color_ids": np.array(color_ids, dtype=np.int64),
+        "colors": np.array(colors, dtype=np.uint8).reshape(-1, 4)
+    }
+    return spans, row + 1, max(width, x), max_depth, scale_y
+
+### @brief スパンを色の配列に塗る関数
+### @param spans TokenizeMFM で作ったスパンの配列の辞書
+### @param height 行数
+### @param width 1行のマス数
+### @return 色の配列 (height, width, 4)。色のないマスは透明
+### @details すべてのスパンのマスの位置をまとめて計算し、1回の代入で塗る
+def FillSpans(spans, height, width):
+    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    lengths = spans["lengths"]
+    if len(lengths) == 0:
+        return canvas
+
+    # 各マスの位置 = スパンの先頭の位置 + スパンの中での番号
+    total = int(lengths.sum())
+    span_heads = np.repeat(spans["rows"] * width + spans["starts"], lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    canvas.reshape(-1, 4)[span_heads + offsets] = spans["colors"][np.repeat(spans["color_ids"], lengths)]
+    return canvas
+
+### @brief MFMの文字列を色の配列に変換する関数
+### @param mfm_text MFMの文字列
+### @param space_char 空白として使用する文字
+### @param use_mfm 色として読むMFM ("bg" または "fg")
+### @param width 1行のマス数。Noneの場合は最も長い行に合わせる
+### @return 色の配列 (height, width, 4)。読めない場合はNoneを返す。
+def RenderMFM(mfm_text, space_char, use_mfm = "bg", width = None):
+    try:
+        spans, height, text_width, _, _ = TokenizeMFM(mfm_text, space_char, use_mfm)
+    except ValueError as e:
+        logger.error(f"Error parsing MFM: {e}")
+        return None
+
+    return FillSpans(spans, height, text_width if width is None else max(width, text_width))
+
+### @brief MFMの文字列をPNGファイルに保存する関数
+### @param mfm_text MFMの文字列
+### @param filename 保存するファイル名
+### @param space_char 空白として使用する文字
+### @param use_mfm 色として読むMFM ("bg" または "fg")
+### @param cell_size 1マスの横のピクセル数 (縦は scale.y を掛けた値)
+### @return 保存に成功した場合はTrue
+def SaveRenderedPng(mfm_text, filename, space_char, use_mfm = "bg", cell_size = 8):
+    try:
+        spans, height, width, _, scale_y = TokenizeMFM(mfm_text, space_char, use_mfm)
+    except ValueError as e:
+        logger.error(f"Error parsing MFM: {e}")
+        return False
+
+    try:
+        img = Image.fromarray(FillSpans(spans, height, width), "RGBA")
+        cell_height = max(1, round(cell_size * scale_y))
+        img = img.resize((max(1, width * cell_size), max(1, height * cell_height)), Image.Resampling.NEAREST)
+        img.save(filename)
+        logger.info(f"Rendered MFM saved to {filename}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error saving rendered MFM: {e}")
+        return False
+
+#==================================================
+# 生成結果の検証用関数
+#==================================================
+
+### @brief 生成前の色の配列から、MFMを表示したときに見えるはずの色の配列を作る関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param color_type 色の形式（0: 6桁RGB, 1: 3桁RGB, 2: 4桁RGBA）
+### @return 色の配列 (height, width, 4)
+### @details 色の形式で表せる精度に落とす。0と1はアルファ値を使わないので不透明になり、2で透明な色は (0, 0, 0, 0) になる
+def ExpectedColorArray(color_array, color_type):
+    codes = ConvertColorArrayToCodes(color_array, color_type)
+    if codes is None:
+        return None
+
+    expected = np.empty(codes.shape + (4,), dtype=np.uint8)
+    if color_type == 0:
+        expected[..., 0] = codes >> 16
+        expected[..., 1] = (codes >> 8) & 0xff
+        expected[..., 2] = codes & 0xff
+        expected[..., 3] = 255
+        return expected
+
+    shifts = [8, 4, 0] if color_type == 1 else [12, 8, 4, 0]
+    for i, shift in enumerate(shifts):
+        expected[..., i] = ((codes >> shift) & 0xf) * 0x11
+    if color_type == 1:
+        expected[..., 3] = 255
+    else:
+        expected[expected[..., 3] == 0] = 0
+    return expected
+
+### @brief 色の配列をMFMに変換して画像に戻し、元の色と一致するかを確認する関数
+### @param color_array 色の配列 (R, G, B, A)
+### @param color_type 色の形式
+### @param background_color 背景色 (R, G, B, A)
+### @param space_char 空白として使用する文字
+### @param max_overlap_bg_color 重ねがけできる色の上限
+### @param use_mfm_char MFMの使用形式（"bg" または "fg"）
+### @param encoder_mode 生成方法（"greedy" または "planner"）
+### @param planner_beam 探索で残す状態の数
+### @return 一致した場合はNone。一致しない場合は原因の文字列
+def VerifyRoundTrip(color_array, color_type, background_color, space_char, max_overlap_bg_color, use_mfm_char, encoder_mode = "greedy", planner_beam = 16):
+    mfm_text = GenerateMFM(color_array, color_type, background_color, "1", space_char, max_overlap_bg_color, use_mfm_char, encoder_mode, planner_beam)
+    if mfm_text is None:
+        return "MFM generation failed"
+
+    try:
+        spans, height, width, max_depth, _ = TokenizeMFM(mfm_text, space_char, use_mfm_char)
+    except ValueError as e:
+        return f"Invalid MFM: {e}"
+
+    expected = ExpectedColorArray(color_array, color_type)
+    if height != expected.shape[0]:
+        return f"Row count {height} != {expected.shape[0]}"
+    if width > expected.shape[1]:
+        return f"Row width {width} > {expected.shape[1]}"
+    if max_depth > (max_overlap_bg_color if max_overlap_bg_color > 0 else 19):
+        return f"Nesting depth {max_depth} > {max_overlap_bg_color}"
+
+    # 右端の透明な部分は出力されないので、元の幅に合わせて透明で埋める
+    rendered = FillSpans(spans, height, expected.shape[1])
+    mismatch = np.argwhere(np.any(rendered != expected, axis=-1))
+    if len(mismatch) > 0:
+        y, x = mismatch[0]
+        return f"{len(mismatch)} cells differ, first at ({y}, {x}): {tuple(rendered[y, x])} != {tuple(expected[y, x])}"
+
+    return None
+
+### @brief ランダムな色の配列と設定を作るジェネレーター
+### @param count 作る数
+### @param seed 乱数のシード値
+### @param max_size 縦横の最大マス数
+### @return (色の配列, 色の形式, 背景色, 空白の文字, 重ねがけの上限, MFMの使用形式, 生成方法) を順に返す
+### @details 色の数、透明度の混ざり方、背景色の有無、重ねがけの上限などを偏りなく変える
+def FuzzCases(count, seed = 0, max_size = 24):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        height, width = rng.integers(1, max_size + 1, 2)
+        n_colors = int(rng.integers(1, 40))
+
+        # 不透明な色の割合と、完全に透明な色の割合を変える
+        palette = rng.integers(0, 256, (n_colors, 4), dtype=np.uint8)
+        palette[:, 3] = np.where(rng.random(n_colors) < rng.random(), 255, palette[:, 3])
+        palette[rng.random(n_colors) < 0.1, 3] = 0
+        color_array = palette[rng.integers(0, n_colors, (height, width))]
+
+        background_colors = [(0, 0, 0, 0), (255, 255, 255, 255), (-1, 0, 0, 0), tuple(int(v) for v in palette[0][:3]) + (255,)]
+        yield (
+            color_array,
+            int(rng.integers(0, 3)),
+            background_colors[int(rng.integers(0, len(background_colors)))],
+            str(rng.choice(["　", " ", "Ａ"])),
+            int(rng.choice([0, 1, 2, 3, 5, 19])),
+            str(rng.choice(["bg", "fg"])),
+            str(rng.choice(["greedy", "planner"]))
+        )
+
+### @brief ランダムな入力で生成と表示の結果が一致するかを確認する関数
+### @param count 確認する数
+### @param seed 乱数のシード値
+### @param max_size 縦横の最大マス数
+### @param encoder_mode 生成方法を固定する場合に指定 (Noneならランダム)
+### @return 一致しなかった (入力の番号, 設定, 原因) のリスト
+def FuzzRoundTrip(count, seed = 0, max_size = 24, encoder_mode = None):
+    failures = []
+    for i, (color_array, color_type, background_color, space_char, max_overlap, use_mfm, mode) in enumerate(FuzzCases(count, seed, max_size)):
+        mode = encoder_mode or mode
+        error = VerifyRoundTrip(color_array, color_type, background_color, space_char, max_overlap, use_mfm, mode, 8)
+        # 探索で生成した場合は、従来の方法より長くなっていないかも確認する
+        if (error is None) and (mode == "planner"):
+            planned_chars = len(GenerateMFM(color_array, color_type, background_color, "1", space_char, max_overlap, use_mfm, mode, 8))
+            greedy_chars = len(GenerateMFM(color_array, color_type, background_color, "1", space_char, max_overlap, use_mfm))
+            if planned_chars > greedy_chars:
+                error = f"Planner output {planned_chars} chars > greedy {greedy_chars} chars"
+        if error is not None:
+            settings = {"shape": color_array.shape[:2], "color_type": color_type, "background_color": background_color, "max_overlap": max_overlap, "use_mfm": use_mfm, "encoder_mode": mode}
+            failures.append((i, settings, error))
+    return failures
+
+# 以前の生成処理と比較するときの背景色 (透明、不透明)
+# 元のバージョンは色の値が無効でアルファ値だけある背景色や、重ねがけの上限が1の場合に括弧の対応しないMFMを出力するので、
+# デフォルトではその組み合わせを比較しない
+compare_background_colors = [(255, 255, 255, 0), (255, 255, 255, 255)]
+
+### @brief 比較用に以前のバージョンのGenerateMFM.pyを読み込む関数
+### @param path GenerateMFM.py のパス (例: git show <リビジョン>:GenerateMFM.py で取り出したもの)
+### @return 読み込んだモジュール
+### @details 古いバージョンは生成中の状態をモジュールの変数に持ち、呼び出しごとにリセットしないので、
+###          生成するたびに新しく読み込んだモジュールを使う必要がある
+def LoadReferenceEncoder(path):
+    spec = importlib.util.spec_from_file_location("reference_generate_mfm", path)
+    if spec is None:
+        raise ValueError(f"Not a Python file: {path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+### @brief 比較に使う減色済みの色の配列を作るジェネレーター
+### @param image_files 追加で使う画像ファイルのリスト
+### @param width 出力の幅
+### @return (名前, 色の形式, 減色済みの色の配列, 減色済みの背景色) を順に返す
+### @details ベンチマーク用の画像と指定の画像を、色の形式・背景色・減色値を変えて現在の変換処理で減色する。
+###          どちらの生成処理にも同じ色の配列を渡すので、生成処理の違いだけを比較できる
+def CompareCases(image_files, width):
+    images = [(f"{kind}-{alpha}", CreateBenchmarkImage(kind, alpha, width * source_scale)) for kind in image_kinds for alpha in alpha_kinds]
+    images += [(image_file, None) for image_file in image_files]
+
+    for name, img in images:
+        for color_type in [0, 1, 2]:
+            for background_color in compare_background_colors:
+                for division in [1, 8]:
+                    option = LoadOptions({**benchmark_options, "color_type": color_type, "background_color": background_color, "color_division": division, "resize_width": width, "resize_height": width if img is not None else 0})
+                    resize_value = None
+                    source = img
+                    if source is None:
+                        source, resize_value = LoadImageFile(name, option)
+                        if source is None:
+                            raise MFMConversionError(f"Failed to load {name}.")
+
+                    color_array = PrepareColorArray(source, option, resize_value)
+                    if color_array is not None:
+                        color_array, quantized_background = QuantizeColorArray(color_array, option)
+                    if color_array is not None:
+                        color_array = MergeColorArray(ReduceColorArray(color_array, option), option)
+                    if color_array is None:
+                        raise MFMConversionError(f"Failed to reduce colors of {name}.")
+
+                    yield f"{name} type={color_type} bg={background_color} div={division}", color_type, color_array, quantized_background
+
+### @brief 以前の生成処理と出力の文字数を比較する関数
+### @param reference_path 以前のバージョンのGenerateMFM.pyのパス
+### @param image_files 追加で使う画像ファイルのリスト
+### @param width 出力の幅
+### @param max_overlaps 比較する重ねがけの上限のリスト
+### @return (ケース名, 以前の文字数, 現在の文字数) のリスト。以前の出力が壊れている場合は以前の文字数をNoneにする
+def CompareEncoders(reference_path, image_files, width, max_overlaps):
+    results = []
+    for name, color_type, color_array, background_color in CompareCases(image_files, width):
+        for max_overlap in max_overlaps:
+            # 前の生成の状態が残らないように毎回読み込み直す
+            reference = LoadReferenceEncoder(reference_path)
+            # 古いバージョンは進捗をprintで表示するので捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                reference_text = reference.GenerateMFM(color_array, color_type, background_color, "1", "　", max_overlap, "bg")
+            current_text = GenerateMFM(color_array, color_type, background_color, "1", "　", max_overlap, "bg")
+            if (reference_text is None) or (current_text is None):
+                raise MFMConversionError(f"MFM generation failed: {name}")
+
+            # 以前のバージョンが括弧の対応しないMFMを出力した場合は、文字数を比べても意味がないので比較しない
+            try:
+                TokenizeMFM(reference_text, "　", "bg")
+            except ValueError:
+                results.append((f"{name} overlap={max_overlap}", None, len(current_text)))
+                continue
+            results.append((f"{name} overlap={max_overlap}", len(reference_text), len(current_text)))
+    return results
+
+### @brief コマンドライン引数の解析関数
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Render MFM art back to an image, or fuzz the encoder against the renderer.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render = subparsers.add_parser("render", help="render an MFM text file to PNG")
+    render.add_argument("input", help="MFM text file")
+    render.add_argument("-o", "--output", default=None, help="PNG file (default: input name with .png)")
+    render.add_argument("--space", default="　", help="space character used in the MFM (default: full-width space)")
+    render.add_argument("--mfm", default="bg", choices=["bg", "fg"], help="MFM function that holds the colors (default: bg)")
+    render.add_argument("--cell-size", type=int, default=8, help="width of one cell in pixels (default: 8)")
+
+    fuzz = subparsers.add_parser("fuzz", help="encode random images and check that rendering gives the same colors")
+    fuzz.add_argument("-n", "--count", type=int, default=2000, help="number of random images (default: 2000)")
+    fuzz.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    fuzz.add_argument("--max-size", type=int, default=24, help="maximum rows and columns (default: 24)")
+    fuzz.add_argument("--encoder-mode", default=None, choices=["greedy", "planner"], help="use only this encoder (default: both)")
+
+    compare = subparsers.add_parser("compare", help="check that the greedy encoder output is not longer than a previous version")
+    compare.add_argument("reference", help="previous GenerateMFM.py (e.g. from git show <rev>:GenerateMFM.py)")
+    compare.add_argument("images", nargs="*", help="image files to compare in addition to the benchmark images")
+    compare.add_argument("--width", type=int, default=32, help="output width (default: 32)")
+    compare.add_argument("--overlaps", default="3,19", help="comma separated max_overlap_bg_color values (default: 3,19)")
+    compare.add_argument("--max-skipped", type=float, default=0.05, help="fail if more than this ratio of reference outputs are invalid (default: 0.05)")
+
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = ParseArguments(argv)
+    ConfigureLogging(logging.INFO)
+
+    if args.command == "render":
+        try:
+            with open(args.input, "r", encoding="UTF-8") as mfm_file:
+                mfm_text = mfm_file.read()
+        except Exception as e:
+            logger.error(f"Error loading MFM text: {e}")
+            return 1
+
+        output = args.output if args.output is not None else args.input.rsplit(".", 1)[0] + ".png"
+        return 0 if SaveRenderedPng(mfm_text, output, args.space, args.mfm, args.cell_size) else 1
+
+    if args.command == "compare":
+        try:
+            # 無効な背景色の警告などが大量に出るので、失敗は例外で受け取る
+            max_overlaps = [int(value) for value in args.overlaps.split(",")]
+            with SuppressLogs(logging.CRITICAL):
+                results = CompareEncoders(args.reference, args.images, args.width, max_overlaps)
+        except Exception as e:
+            logger.error(f"Error comparing encoders: {e}")
+            return 1
+
+        compared = [result for result in results if result[1] is not None]
+        longer = [result for result in compared if result[2] > result[1]]
+        for name, reference_chars, current_chars in results:
+            if reference_chars is None:
+                print(f"\tskipped {name}: reference output is invalid")
+            elif reference_chars != current_chars:
+                print(f"\t{'LONGER ' if current_chars > reference_chars else 'shorter'} {name}: {reference_chars} -> {current_chars}")
+        skipped = len(results) - len(compared)
+        print(f"{len(longer)} of {len(compared)} outputs longer than the reference ({sum(r[1] for r in compared)} -> {sum(r[2] for r in compared)} chars, {skipped} skipped).")
+
+        # 比較できなかった割合が多い場合は、比較の結果を信用できないので失敗にする
+        if skipped > len(results) * args.max_skipped:
+            print(f"Too many invalid reference outputs: {skipped} of {len(results)} (limit {args.max_skipped:.0%}).")
+            return 1
+        return 1 if longer else 0
+
+    # 生成時の表示は多すぎるので出力しない
+    with SuppressLogs():
+        failures = FuzzRoundTrip(args.count, args.seed, args.max_size, args.encoder_mode)
+
+    for i, settings, error in failures[:10]:
+        print(f"\tcase {i} {settings}: {error}")
+    print(f"{len(failures)} of {args.count} round trips failed.")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
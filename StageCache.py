@@ -0,0 +1,159 @@
+import os
+import hashlib
+import numpy as np
+from Instrumentation import *
+
+#==================================================
+# 変換処理の各段階の結果をディスクに保存するキャッシュ用モジュール
+#==================================================
+
+# 処理の内容を変えたときに古いキャッシュを使わないようにするためのバージョン
+cache_version = 1
+
+# ファイルのハッシュを計算するときに一度に読み込むサイズ
+hash_chunk_size = 1 << 20
+
+### @brief ファイルの中身のハッシュ値を計算する関数
+### @param filename ファイルのパス
+### @return ハッシュ値の16進数文字列。失敗した場合はNoneを返す。
+def HashFileBytes(filename):
+    try:
+        file_hash = hashlib.sha256()
+        with open(filename, "rb") as file:
+            while chunk := file.read(hash_chunk_size):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    except Exception as e:
+        logger.error(f"Error hashing file: {e}")
+        return None
+
+### @brief 前の段階のキーと、その段階が使うオプションからキーを作る関数
+### @param parent_key 前の段階のキー (最初の段階では入力のハッシュ値)
+### @param stage 段階の名前
+### @param params その段階が使うオプションの辞書
+### @return キーの16進数文字列
+def CreateStageKey(parent_key, stage, params):
+    key_text = f"{cache_version}\n{parent_key}\n{stage}\n{sorted(params.items())!r}"
+    return hashlib.sha256(key_text.encode("UTF-8")).hexdigest()
+
+### @brief キャッシュのファイルパスを作る関数
+### @param cache_dir キャッシュのディレクトリ
+### @param key キー
+### @param extension 拡張子
+def CachePath(cache_dir, key, extension):
+    return os.path.join(cache_dir, f"{key}{extension}")
+
+### @brief キャッシュのファイルを最近使用したことにする関数 (更新日時で古い順に削除するため)
+### @param path ファイルのパス
+def TouchCacheFile(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+### @brief キャッシュのファイルを書き込む関数
+### @param path ファイルのパス
+### @param write ファイルオブジェクトを受け取って書き込む関数
+### @return 書き込めた場合はTrue
+### @details 途中のファイルを読み込まないように、一時ファイルに書き込んでから置き換える
+def WriteCacheFile(path, write):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(temp_path, "wb") as file:
+            write(file)
+        os.replace(temp_path, path)
+        return True
+
+    except Exception as e:
+        logger.error(f"Error writing cache: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+### @brief 配列をキャッシュから読み込む関数
+### @param cache_dir キャッシュのディレクトリ
+### @param key キー
+### @return メモリマップした読み取り専用の配列。キャッシュがない場合はNoneを返す。
+def LoadCachedArray(cache_dir, key):
+    path = CachePath(cache_dir, key, ".npy")
+    if not os.path.exists(path):
+        return None
+
+    try:
+        array = np.load(path, mmap_mode="r")
+        TouchCacheFile(path)
+        return array
+
+    except Exception as e:
+        # 壊れたキャッシュは削除して作り直す
+        logger.error(f"Error loading cached array: {e}")
+        os.remove(path)
+        return None
+
+### @brief 配列をキャッシュに保存する関数
+### @param cache_dir キャッシュのディレクトリ
+### @param key キー
+### @param array 保存する配列
+### @param max_bytes キャッシュ全体の上限サイズ (バイト)
+def SaveCachedArray(cache_dir, key, array, max_bytes):
+    if WriteCacheFile(CachePath(cache_dir, key, ".npy"), lambda file: np.save(file, np.asarray(array))):
+        EvictCache(cache_dir, max_bytes)
+
+### @brief 文字列をキャッシュから読み込む関数
+### @param cache_dir キャッシュのディレクトリ
+### @param key キー
+### @return 読み込んだ文字列。キャッシュがない場合はNoneを返す。
+def LoadCachedText(cache_dir, key):
+    path = CachePath(cache_dir, key, ".txt")
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="UTF-8", newline="") as file:
+            text = file.read()
+        TouchCacheFile(path)
+        return text
+
+    except Exception as e:
+        logger.error(f"Error loading cached text: {e}")
+        os.remove(path)
+        return None
+
+### @brief 文字列をキャッシュに保存する関数
+### @param cache_dir キャッシュのディレクトリ
+### @param key キー
+### @param text 保存する文字列
+### @param max_bytes キャッシュ全体の上限サイズ (バイト)
+def SaveCachedText(cache_dir, key, text, max_bytes):
+    if WriteCacheFile(CachePath(cache_dir, key, ".txt"), lambda file: file.write(text.encode("UTF-8"))):
+        EvictCache(cache_dir, max_bytes)
+
+### @brief キャッシュ全体が上限サイズに収まるまで、最後に使用したのが古いファイルから削除する関数
+### @param cache_dir キャッシュのディレクトリ
+### @param max_bytes キャッシュ全体の上限サイズ (バイト)
+def EvictCache(cache_dir, max_bytes):
+    try:
+        entries = []
+        total_bytes = 0
+        with os.scandir(cache_dir) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith((".npy", ".txt")):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= max_bytes:
+                break
+            # 他のプロセスが先に削除した場合もあるので、ないファイルは無視する
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    except Exception as e:
+        logger.error(f"Error evicting cache: {e}")
\ No newline at end of file
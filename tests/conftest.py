@@ -0,0 +1,5 @@
+import os
+import sys
+
+# モジュールはリポジトリの直下にあるので、どこから実行しても読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
\ No newline at end of file
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from MFMConverter import LoadOptions
+from Pipeline import ConvertImage, ConvertImageStreaming, ConvertImageFile
+from ColorReduction import ReduceColorsPerRow
+from RenderMFM import FuzzCases, FuzzRoundTrip
+from GenerateMFM import GenerateMFM
+from Benchmark import CreateBenchmarkImage
+
+#==================================================
+# 変換処理のテスト
+#==================================================
+
+# 帯ごとの変換と比較するオプション (減色の方法ごとに1つずつ)
+streaming_options = [
+    {},
+    {"max_row_colors": 4, "smooth_repeat": 1},
+    {"global_colors": 8, "color_division": 8},
+    {"dither_mode": "floyd_steinberg", "color_division": 16, "color_type": 0},
+    {"dither_mode": "bayer", "color_division": 16, "background_color": (0, 0, 0, 0), "color_type": 2}
+]
+
+### @brief ランダムな入力で、生成したMFMを表示した結果が元の色と一致するか
+def test_fuzz_round_trip():
+    assert FuzzRoundTrip(1000, seed=0) == []
+
+### @brief 探索で生成したMFMが、従来の方法で生成したMFMより長くならないか
+def test_planner_not_longer_than_greedy():
+    for color_array, color_type, background_color, space_char, max_overlap, use_mfm, _ in FuzzCases(300, seed=1):
+        greedy_text = GenerateMFM(color_array, color_type, background_color, "1", space_char, max_overlap, use_mfm)
+        planned_text = GenerateMFM(color_array, color_type, background_color, "1", space_char, max_overlap, use_mfm, "planner", 8)
+        assert len(planned_text) <= len(greedy_text)
+
+### @brief 帯ごとに変換した結果が、画像全体をまとめて変換した結果と同じになるか
+@pytest.mark.parametrize("options", streaming_options)
+def test_streaming_matches_whole_image(tmp_path, options):
+    img = CreateBenchmarkImage("photo", "soft", 64)
+    option = LoadOptions({"resize_width": 24, "stream_rows": 5, **options})
+
+    mfm_text = ConvertImage(img, option)
+    char_count = ConvertImageStreaming(img, option, str(tmp_path / "stream"))
+
+    with open(tmp_path / "stream.txt", "r", encoding="UTF-8") as mfm_file:
+        assert mfm_file.read() == mfm_text
+    assert char_count == len(mfm_text)
+
+### @brief 行ごとの減色の結果がワーカー数によって変わらないか
+def test_reduce_colors_per_row_workers():
+    color_array = np.asarray(CreateBenchmarkImage("noise", "binary", 48))
+
+    single = ReduceColorsPerRow(color_array, 6, workers=1)
+    parallel = ReduceColorsPerRow(color_array, 6, workers=4)
+    assert single is not None
+    assert np.array_equal(single, parallel)
+
+### @brief キャッシュから読み込んだ結果が、キャッシュを使わずに変換した結果と同じになるか
+def test_cache_hit_matches_miss(tmp_path):
+    image_file = str(tmp_path / "image.png")
+    CreateBenchmarkImage("pixel_art", "binary", 64).save(image_file)
+
+    uncached = ConvertImageFile(image_file, LoadOptions({"resize_width": 16, "max_row_colors": 4}))
+    option = LoadOptions({"resize_width": 16, "max_row_colors": 4, "use_cache": True, "cache_dir": str(tmp_path / "cache")})
+    miss = ConvertImageFile(image_file, option)
+    assert any((tmp_path / "cache").iterdir())
+    hit = ConvertImageFile(image_file, option)
+    assert uncached is not None
+    assert miss == uncached
+    assert hit == uncached
+
+    # 後の段階のオプションだけを変えた場合は、前の段階のキャッシュから生成する
+    option = LoadOptions({"resize_width": 16, "max_row_colors": 4, "use_cache": True, "cache_dir": str(tmp_path / "cache"), "use_space_index": 1})
+    partial = ConvertImageFile(image_file, option)
+    assert partial == ConvertImageFile(image_file, {**option, "use_cache": False})
\ No newline at end of file